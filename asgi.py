@@ -0,0 +1,614 @@
+# -*- coding: utf-8 -*-
+"""ASGI variant of the recommendation routes: uvicorn asgi:app --host 0.0.0.0 --port 7860
+
+/recommend and /recommend/stream run on the event loop:
+- Gemini is called through the SDK's async methods over its persistent channel.
+- Supabase's match_products RPC goes through a pooled keep-alive httpx.AsyncClient, retried with jittered
+  exponential backoff.
+- Embedding and reranking run on a thread pool.
+
+A request waiting on Gemini or Supabase therefore holds no thread, and one process can keep hundreds of
+recommendations in flight. Every other route (/, /health, /metrics, /recommend/batch, /admin/*) is the
+Flask app from backend.py, mounted over a WSGI bridge. Pipeline logic (caches, prompts, parsing, fusion,
+ranking) is shared with backend.py; only the I/O is reimplemented here.
+"""
+import asyncio
+import contextlib
+import contextvars
+import functools
+import logging
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Mount, Route
+
+import backend
+from backend import metrics, request_trace, trace_span
+
+# --- Configuration ---
+ASYNC_MAX_CONCURRENT_REQUESTS = int(os.getenv("ASYNC_MAX_CONCURRENT_REQUESTS", 512)) # In-flight recommendations per process
+ASYNC_MAX_QUEUED_REQUESTS = int(os.getenv("ASYNC_MAX_QUEUED_REQUESTS", 1024)) # Waiting for a slot; beyond this, 429
+SUPABASE_POOL_MAX_CONNECTIONS = int(os.getenv("SUPABASE_POOL_MAX_CONNECTIONS", 100))
+SUPABASE_POOL_MAX_KEEPALIVE = int(os.getenv("SUPABASE_POOL_MAX_KEEPALIVE", 50)) # Idle connections kept open for reuse
+SUPABASE_POOL_KEEPALIVE_EXPIRY_SECONDS = 60
+SUPABASE_CONNECT_TIMEOUT_SECONDS = 5
+EMBEDDING_EXECUTOR_WORKERS = int(os.getenv("EMBEDDING_EXECUTOR_WORKERS", os.cpu_count() or 4)) # CPU-bound encode/rerank
+RETRY_BACKOFF_BASE_SECONDS = 0.2 # First retry waits up to this long; doubles per attempt (full jitter)
+RETRY_BACKOFF_MAX_SECONDS = 2.0
+ASYNC_MAX_QUERY_RETRIES = 3 # Attempts per RPC; cheap with backoff, and the whole call is bounded by RETRIEVAL_TIMEOUT_SECONDS
+
+# --- Clients (created in the lifespan handler) ---
+supabase_http = None
+embedding_executor = None
+admission = None
+
+
+# --- Helpers ---
+def json_response(data, status_code=200, headers=None, request=None):
+    """Compact JSON with ETag and Accept-Encoding negotiation, matching backend.json_response (?pretty=1, gzip/br)."""
+    pretty = request is not None and backend.wants_pretty_json(request.query_params.get("pretty"))
+    try:
+        body, etag, memo = backend.serialize_response(data, pretty)
+    except TypeError as e:
+        logging.error(f"Failed to serialize data to JSON: {e}. Data: {data}")
+        body, etag, memo = backend.serialize_response(backend.SERIALIZATION_ERROR, pretty)
+        status_code = 500
+    content_encoding = None
+    if request is not None:
+        body, content_encoding = backend.compress_response(body, request.headers.get("accept-encoding"), memo)
+    return Response(body, status_code=status_code, media_type=backend.JSON_MIMETYPE,
+                    headers=dict(backend.response_headers(etag, status_code, content_encoding), **(headers or {})))
+
+
+async def run_blocking(fn, *args):
+    """Runs CPU-bound work on the embedding executor, carrying the request trace into the worker thread."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(embedding_executor, contextvars.copy_context().run, fn, *args)
+
+
+def backoff_delay(attempt):
+    """Full-jitter exponential backoff: uniform over [0, min(max, base * 2**attempt)]."""
+    return random.uniform(0, min(RETRY_BACKOFF_MAX_SECONDS, RETRY_BACKOFF_BASE_SECONDS * (2 ** attempt)))
+
+
+async def call_dependency_async(breaker, make_call):
+    """Async backend.call_dependency: awaits make_call() through the breaker, hedging with a second call after
+    breaker.hedge_delay() for dependencies in HEDGED_DEPENDENCIES. The slower call is cancelled."""
+    async def guarded_call():
+        with breaker.guard():
+            return await make_call()
+
+    delay = breaker.hedge_delay() if breaker.name in backend.HEDGED_DEPENDENCIES else None
+    if delay is None:
+        return await guarded_call()
+    first = asyncio.ensure_future(guarded_call())
+    done, _ = await asyncio.wait({first}, timeout=delay)
+    if done:
+        return first.result()
+    breaker.record_hedge()
+    hedge = asyncio.ensure_future(guarded_call())
+    pending = {first, hedge}
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is hedge:
+                        breaker.record_hedge(won=True)
+                    return task.result()
+                error = error or task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+class AsyncAdmissionController:
+    """Event-loop counterpart of backend.AdmissionController: bounded in-flight requests plus a bounded wait queue."""
+
+    def __init__(self, max_concurrent, max_queued, queue_timeout):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    async def acquire(self):
+        """Returns True once a slot is held (the caller must release it), False if the request should be rejected."""
+        if self._slots.locked():
+            if self.waiting >= self.max_queued:
+                self.rejected += 1
+                return False
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._slots.acquire(), timeout=self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                return False
+            finally:
+                self.waiting -= 1
+        else:
+            await self._slots.acquire()
+        self.active += 1
+        self.admitted += 1
+        return True
+
+    def release(self):
+        self.active -= 1
+        self._slots.release()
+
+
+def admission_controlled(handler):
+    """Route decorator: admission control plus the request metrics the Flask hooks record for mounted routes."""
+    @functools.wraps(handler)
+    async def wrapper(request):
+        started = time.perf_counter()
+        if not await admission.acquire():
+            logging.warning(f"Rejecting request to {request.url.path}: {admission.active} in progress, {admission.waiting} queued.")
+            metrics.inc("shl_rejected_requests_total", endpoint=request.url.path)
+            response = json_response({"error": "Server is at capacity. Please retry shortly.", "status": "overloaded"}, 429,
+                                     headers={"Retry-After": str(backend.OVERLOAD_RETRY_AFTER_SECONDS)}, request=request)
+        else:
+            try:
+                response = await handler(request)
+            except Exception:
+                admission.release()
+                raise
+            if isinstance(response, StreamingResponse):
+                response.body_iterator = release_when_done(response.body_iterator)
+            else:
+                admission.release()
+        metrics.observe("shl_request_duration_seconds", time.perf_counter() - started, endpoint=request.url.path)
+        metrics.inc("shl_requests_total", endpoint=request.url.path, status_code=str(response.status_code))
+        return response
+    return wrapper
+
+
+async def release_when_done(body_iterator):
+    # Also runs when the client disconnects and the stream is cancelled
+    try:
+        async for chunk in body_iterator:
+            yield chunk
+    finally:
+        admission.release()
+
+
+# --- Async Retrieval ---
+async def post_rpc(payload):
+    response = await supabase_http.post(f"/rpc/{backend.DB_FUNCTION_NAME}", json=payload)
+    response.raise_for_status()
+    return response
+
+
+async def search_products_rpc_async(query_embedding, match_count=backend.DB_RETRIEVAL_COUNT):
+    """match_products over the pooled HTTP client, retrying with jittered exponential backoff. Raises the last error."""
+    if supabase_http is None:
+        raise ConnectionError("Supabase HTTP client is not initialized.")
+    payload = {
+        'query_embedding': query_embedding.tolist() if hasattr(query_embedding, 'tolist') else list(query_embedding),
+        'match_threshold': backend.DB_MATCH_THRESHOLD,
+        'match_count': match_count
+    }
+    last_db_error = None
+    for attempt in range(ASYNC_MAX_QUERY_RETRIES):
+        try:
+            with trace_span("rpc"):
+                response = await call_dependency_async(backend.supabase_breaker, functools.partial(post_rpc, payload))
+            matches = response.json()
+            if not isinstance(matches, list):
+                logging.warning(f"Supabase RPC returned unexpected response structure: {type(matches)}, Content: {matches}")
+                matches = []
+            logging.info(f"Initial retrieval found {len(matches)} candidates (Attempt {attempt + 1}).")
+            return matches
+        except (httpx.HTTPError, ValueError) as e:
+            last_db_error = e
+            logging.error(f"Supabase RPC error (Attempt {attempt + 1}/{ASYNC_MAX_QUERY_RETRIES}): {e}")
+            if attempt < ASYNC_MAX_QUERY_RETRIES - 1:
+                if not backend.supabase_breaker.available():
+                    logging.warning("Supabase circuit breaker opened; not retrying.")
+                    break
+                metrics.inc("shl_rpc_retries_total")
+                with trace_span("retry_sleep"):
+                    await asyncio.sleep(backoff_delay(attempt))
+    logging.error("Supabase search failed after all retries.")
+    raise last_db_error
+
+
+async def search_products_async(query_embedding, filters=None, match_count=backend.DB_RETRIEVAL_COUNT):
+    """Top-k retrieval: local index when loaded (sub-millisecond, run inline), otherwise the RPC under RETRIEVAL_TIMEOUT_SECONDS."""
+    if backend.RETRIEVAL_MODE == "local" and backend.vector_index is not None and backend.vector_index.ready:
+        try:
+            with trace_span("local_search"):
+                matches = backend.vector_index.search(query_embedding, backend.DB_MATCH_THRESHOLD, match_count, filters)
+            logging.info(f"Local index retrieval found {len(matches)} candidates.")
+            return matches
+        except Exception as e:
+            logging.error(f"Local index search failed, falling back to RPC: {e}", exc_info=True)
+    try:
+        if not filters:
+            return await asyncio.wait_for(search_products_rpc_async(query_embedding, match_count), timeout=backend.RETRIEVAL_TIMEOUT_SECONDS)
+        # The RPC cannot filter before top-k: over-fetch, then filter
+        matches = await asyncio.wait_for(search_products_rpc_async(query_embedding, match_count * backend.FILTER_RPC_OVERFETCH),
+                                         timeout=backend.RETRIEVAL_TIMEOUT_SECONDS)
+        return backend.filter_rows(matches, filters)[:match_count]
+    except asyncio.TimeoutError:
+        raise TimeoutError(f"Retrieval did not finish within {backend.RETRIEVAL_TIMEOUT_SECONDS} seconds.")
+
+
+async def encode_async(text):
+    with trace_span("encode"):
+        return await run_blocking(backend.embed_model.encode, text)
+
+
+# --- Async Query Expansion ---
+async def expand_query_async(original_query: str, mode: str, lexical_match=False):
+    """Async backend.expand_query: same cache and skip rules. Returns (query_for_search, metadata dict)."""
+    started = time.time()
+    expanded_query, info = backend.begin_query_expansion(original_query, mode, lexical_match)
+    if expanded_query is None:
+        expanded_query = await expand_query_with_llm_async(original_query)
+    return backend.finish_query_expansion(original_query, expanded_query, info, started)
+
+
+async def expand_query_with_llm_async(original_query: str) -> str:
+    try:
+        logging.info(f"Expanding query: '{original_query}'")
+        with trace_span("expansion"):
+            response = await call_dependency_async(backend.gemini_breaker, lambda: backend.gen_model.generate_content_async(
+                backend.build_expansion_prompt(original_query),
+                generation_config=backend.gemini_generation_config(temperature=backend.GEMINI_QUERY_EXPANSION_TEMP),
+                request_options={"timeout": backend.GENERATION_TIMEOUT_SECONDS}
+            ))
+        return backend.expanded_query_from_response(original_query, response)
+    except backend.CircuitOpenError as e:
+        logging.warning(f"Query expansion skipped: {e}")
+        return original_query
+    except Exception as e:
+        metrics.inc("shl_llm_errors_total", call="expansion")
+        logging.error(f"Error during query expansion API call: {e}", exc_info=True)
+        return original_query
+
+
+# --- Async RAG Core ---
+async def retrieve_candidates_async(original_query: str, expand_mode: str, query_embedding, metadata, filters=None):
+    """Async backend.retrieve_candidates: expansion runs as a task alongside raw-query retrieval, then the
+    adaptive retrieval policy and RRF.
+
+    Returns (context_data_for_llm, None) or (None, (error dict, status_code)).
+    """
+    pipeline_started = time.time()
+    if filters:
+        metadata["filters"] = filters
+    lexical_matches, lexical_match = backend.lexical_candidates(original_query, metadata, filters=filters)
+    expansion_task = asyncio.create_task(expand_query_async(original_query, expand_mode, lexical_match))
+
+    try:
+        if query_embedding is None:
+            query_embedding = await encode_async(original_query)
+    except Exception as e:
+        logging.error(f"Failed to encode query: {e}", exc_info=True)
+        return None, ({"error": f"Failed to process query for embedding: {e}", "status": "embedding_error"}, 500)
+
+    raw_matches = None
+    last_db_error = None
+    try:
+        raw_matches = await search_products_async(query_embedding, filters, backend.retrieval_depth())
+    except Exception as e:
+        last_db_error = e
+        logging.error(f"Raw-query retrieval failed: {e}")
+    if lexical_matches:
+        backend.vector_index.fill_similarity(lexical_matches, query_embedding)
+    raw_matches, candidate_limit, confident = backend.apply_retrieval_policy(original_query, raw_matches, metadata, lexical_matches, lexical_match)
+    if confident:
+        # Early exit without waiting for expansion; a running task still fills the expansion cache
+        if expansion_task.done():
+            metadata["expansion"] = expansion_task.result()[1]
+        else:
+            metadata["expansion"] = {"mode": expand_mode, "expanded": False, "cached": False, "skipped": True,
+                                     "reason": "confident_retrieval", "duration_ms": 0.0}
+        return backend.build_llm_context(raw_matches), None
+
+    remaining = backend.EXPANSION_TIMEOUT_SECONDS - (time.time() - pipeline_started)
+    try:
+        # Shielded: a late expansion keeps running and still fills the expansion cache
+        expanded_query, metadata["expansion"] = await asyncio.wait_for(asyncio.shield(expansion_task), timeout=max(remaining, 0))
+    except asyncio.TimeoutError:
+        logging.warning(f"Query expansion missed its {backend.EXPANSION_TIMEOUT_SECONDS}s deadline; using raw-query candidates.")
+        expanded_query = original_query
+        metadata["expansion"] = {"mode": expand_mode, "expanded": False, "cached": False, "skipped": False,
+                                 "timed_out": True, "duration_ms": round((time.time() - pipeline_started) * 1000, 1)}
+
+    expanded_matches = None
+    if expanded_query != original_query:
+        try:
+            expanded_matches = await search_products_async(await encode_async(expanded_query), filters, candidate_limit)
+        except Exception as e:
+            last_db_error = last_db_error or e
+            logging.error(f"Expanded-query retrieval failed: {e}")
+
+    if raw_matches is None and expanded_matches is None and not lexical_matches:
+        return None, ({"error": f"Database search failed after {ASYNC_MAX_QUERY_RETRIES} retries: {last_db_error}", "status": "db_error"}, 503)
+
+    matches = backend.merge_candidate_lists(raw_matches, expanded_matches, lexical_matches, candidate_limit)
+    if not matches:
+        logging.warning(f"No candidates found matching threshold {backend.DB_MATCH_THRESHOLD} for expanded query '{expanded_query}'.")
+        return [], None
+    return backend.build_llm_context(matches), None
+
+
+async def generate_with_structured_fallback_async(prompt, **kwargs):
+    """Async backend.generate_with_structured_fallback: retries once prompt-only if Gemini rejects structured output."""
+    structured = backend.GEMINI_STRUCTURED_OUTPUT and backend.structured_output_supported
+    try:
+        return await backend.gen_model.generate_content_async(prompt, generation_config=backend.generation_config(), **kwargs)
+    except Exception as e:
+        if not structured or not backend.is_structured_output_rejection(e):
+            raise
+        backend.disable_structured_output(e)
+        return await backend.gen_model.generate_content_async(prompt, generation_config=backend.generation_config(), **kwargs)
+
+
+async def generate_recommendations_async(original_query: str, context_data_for_llm):
+    """Async backend.generate_recommendations. Returns (dict, status_code)."""
+    prompt, candidates = backend.build_generation_prompt(original_query, context_data_for_llm)
+    logging.info(f"Sending final generation prompt to Gemini (asking for max {backend.MAX_FINAL_RECOMMENDATIONS} results)...")
+    try:
+        with trace_span("generation"):
+            # The timeout sits inside the breaker so a hung call counts as a failure
+            gemini_response = await call_dependency_async(backend.gemini_breaker, lambda: asyncio.wait_for(
+                generate_with_structured_fallback_async(
+                    prompt,
+                    request_options={"timeout": backend.GENERATION_TIMEOUT_SECONDS}
+                ),
+                timeout=backend.GENERATION_TIMEOUT_SECONDS
+            ))
+        backend.record_generation_tokens(prompt, gemini_response)
+        if gemini_response.parts:
+            return backend.parse_generation_text(gemini_response.text, candidates)
+        return backend.empty_generation_response(gemini_response)
+    except backend.CircuitOpenError as e:
+        logging.warning(f"Final generation skipped: {e}")
+        return {"error": "The AI model is temporarily unavailable. Please retry shortly.", "status": "ai_unavailable"}, 503
+    except Exception as e:
+        metrics.inc("shl_llm_errors_total", call="generation")
+        logging.error(f"Error calling Gemini API or processing its response: {e}", exc_info=True)
+        return {"error": f"An error occurred communicating with the AI model: {e}", "status": "ai_error"}, 502
+
+
+async def select_recommendations_async(original_query: str, context_data_for_llm, mode: str, metadata):
+    if backend.is_confident_retrieval(metadata):
+        return backend.direct_recommendations(context_data_for_llm, metadata)
+    if backend.effective_ranking_mode(mode, metadata) == "fast":
+        with trace_span("rerank"):
+            return await run_blocking(backend.rank_recommendations_fast, original_query, context_data_for_llm, metadata)
+    metadata["ranking"] = {"mode": "llm"}
+    return await generate_recommendations_async(original_query, context_data_for_llm)
+
+
+async def get_product_recommendation_async(original_query: str, expand=None, mode=None, filters=None, extract_filters=None):
+    """Async backend.get_product_recommendation_cached: response cache, then the RAG pipeline. Returns (dict, status_code)."""
+    not_ready = backend.check_pipeline_ready(original_query)
+    if not_ready:
+        return not_ready
+    expand_mode = backend.parse_expand_option(expand)
+    ranking_mode = backend.parse_mode_option(mode)
+    filters = backend.resolve_filters(original_query, filters, extract_filters)
+    variant = backend.response_variant(ranking_mode, filters)
+
+    # The cache lookup encodes the query, so it runs off the event loop too
+    cached_result, cache_key, query_embedding = await run_blocking(backend.lookup_response_cache, original_query, variant)
+    if cached_result is not None:
+        return cached_result, 200
+
+    metadata = {}
+    try:
+        context_data_for_llm, error = await retrieve_candidates_async(original_query, expand_mode, query_embedding, metadata, filters)
+        if error:
+            return error
+        if not context_data_for_llm:
+            result_data, status_code = backend.no_match_response(original_query, metadata), 200
+        else:
+            result_data, status_code = await select_recommendations_async(original_query, context_data_for_llm, ranking_mode, metadata)
+            if status_code == 200:
+                result_data["metadata"] = metadata
+        backend.store_response_cache(cache_key, result_data, status_code, query_embedding, variant)
+        return result_data, status_code
+    except Exception as e:
+        logging.error(f"Unexpected error in RAG process for query '{original_query}': {e}", exc_info=True)
+        return {"error": "An internal error occurred during recommendation generation.", "status": "error"}, 500
+
+
+async def stream_recommendations_async(original_query: str, expand=None, mode=None, timings=False, filters=None, extract_filters=None):
+    """Async backend.stream_product_recommendations: the same SSE events, produced on the event loop."""
+    with request_trace() as trace:
+        started = time.time()
+        ranking_mode = backend.parse_mode_option(mode)
+        filters = backend.resolve_filters(original_query, filters, extract_filters)
+        variant = backend.response_variant(ranking_mode, filters)
+        cached_result, cache_key, query_embedding = await run_blocking(backend.lookup_response_cache, original_query, variant)
+        if cached_result is not None:
+            yield backend.sse_event("result", cached_result)
+            yield backend.sse_event("done", backend.stream_done_data(200, started, trace if timings else None))
+            return
+
+        metadata = {}
+        try:
+            context_data_for_llm, error = await retrieve_candidates_async(original_query, backend.parse_expand_option(expand), query_embedding, metadata, filters)
+            if error:
+                error_data, status_code = error
+                yield backend.sse_event("error", dict(error_data, status_code=status_code))
+                return
+            if not context_data_for_llm:
+                result_data = backend.no_match_response(original_query, metadata)
+                backend.store_response_cache(cache_key, result_data, 200, query_embedding, variant)
+                yield backend.sse_event("result", result_data)
+                yield backend.sse_event("done", backend.stream_done_data(200, started, trace if timings else None))
+                return
+
+            candidates = [dict(backend.format_assessment(candidate), similarity_score=candidate.get('similarity_score')) for candidate in context_data_for_llm]
+            yield backend.sse_event("candidates", {"status": "candidates", "candidates": candidates, "metadata": metadata,
+                                                   "retrieval_time": round(time.time() - started, 3)})
+
+            if backend.is_confident_retrieval(metadata) or backend.effective_ranking_mode(ranking_mode, metadata) == "fast":
+                result_data, status_code = await select_recommendations_async(original_query, context_data_for_llm, ranking_mode, metadata)
+                result_data["metadata"] = metadata
+                backend.store_response_cache(cache_key, result_data, status_code, query_embedding, variant)
+                yield backend.sse_event("result", result_data)
+                yield backend.sse_event("done", backend.stream_done_data(status_code, started, trace if timings else None))
+                return
+
+            metadata["ranking"] = {"mode": "llm"}
+            prompt, prompt_candidates = backend.build_generation_prompt(original_query, context_data_for_llm)
+            logging.info(f"Streaming final generation from Gemini (asking for max {backend.MAX_FINAL_RECOMMENDATIONS} results)...")
+            buffer = ""
+            emitted = 0
+            try:
+                # The span covers the whole stream; the breaker only times the Gemini side, not waits on the client
+                with trace_span("generation"), backend.gemini_breaker.guard() as call_timer:
+                    with call_timer.measure():
+                        gemini_stream = await generate_with_structured_fallback_async(
+                            prompt,
+                            stream=True,
+                            request_options={"timeout": backend.GENERATION_TIMEOUT_SECONDS}
+                        )
+                        chunks = gemini_stream.__aiter__()
+                    while True:
+                        with call_timer.measure():
+                            try:
+                                chunk = await chunks.__anext__()
+                            except StopAsyncIteration:
+                                break
+                        try:
+                            buffer += chunk.text
+                        except ValueError:
+                            continue # Chunk without text parts (e.g. safety metadata only)
+                        assessments = backend.extract_streamed_recommendations(buffer, prompt_candidates)
+                        for assessment in assessments[emitted:]:
+                            yield backend.sse_event("recommendation", assessment)
+                        emitted = len(assessments)
+            except backend.CircuitOpenError as e:
+                # The breaker opened (or another request took its half-open probe) after effective_ranking_mode
+                logging.warning(f"Streamed generation skipped, ranking locally: {e}")
+                metadata["degraded"] = "gemini_circuit_open"
+                with trace_span("rerank"):
+                    result_data, status_code = await run_blocking(backend.rank_recommendations_fast, original_query, context_data_for_llm, metadata)
+                result_data["metadata"] = metadata
+                yield backend.sse_event("result", result_data)
+                yield backend.sse_event("done", backend.stream_done_data(status_code, started, trace if timings else None))
+                return
+
+            backend.record_generation_tokens(prompt, gemini_stream)
+            if buffer.strip():
+                result_data, status_code = backend.parse_generation_text(buffer, prompt_candidates)
+            else:
+                result_data, status_code = backend.empty_generation_response(gemini_stream)
+            if status_code != 200:
+                yield backend.sse_event("error", dict(result_data, status_code=status_code))
+                return
+            result_data["metadata"] = metadata
+            backend.store_response_cache(cache_key, result_data, status_code, query_embedding, variant)
+            yield backend.sse_event("result", result_data)
+            yield backend.sse_event("done", backend.stream_done_data(200, started, trace if timings else None))
+
+        except Exception as e:
+            logging.error(f"Unexpected error while streaming recommendations for query '{original_query}': {e}", exc_info=True)
+            yield backend.sse_event("error", {"error": f"An error occurred while streaming recommendations: {e}", "status": "error", "status_code": 500})
+
+
+# --- Routes ---
+async def read_recommend_request(request, request_id):
+    """Parses and validates the JSON body. Returns (options dict, None) or (None, error response)."""
+    if request.headers.get("content-type", "").split(";")[0].strip() != "application/json":
+        logging.warning(f"[Req ID: {request_id}] Request content type is not application/json.")
+        return None, json_response({"error": "Request must be JSON.", "status": "bad_request"}, 415, request=request)
+    try:
+        data = await request.json()
+    except ValueError:
+        logging.warning(f"[Req ID: {request_id}] Request body is not valid JSON.")
+        return None, json_response({"error": "Request body is not valid JSON.", "status": "bad_request"}, 400, request=request)
+    options, error = backend.validate_recommend_body(data, request.query_params, request_id)
+    if error:
+        return None, json_response(*error, request=request)
+    return options, None
+
+
+@admission_controlled
+async def recommend_assessments(request):
+    start_time = time.time()
+    request_id = os.urandom(4).hex()
+    logging.info(f"[Req ID: {request_id}] Received request on /recommend endpoint (ASGI).")
+    options, error_response = await read_recommend_request(request, request_id)
+    if error_response:
+        return error_response
+
+    with request_trace() as trace:
+        result_data, status_code = await get_product_recommendation_async(options["query"], expand=options["expand"], mode=options["mode"],
+                                                                        filters=options["filters"], extract_filters=options["extract_filters"])
+    if options["timings"]:
+        result_data = dict(result_data, timings=trace.to_dict())
+    logging.info(f"[Req ID: {request_id}] Request processed in {time.time() - start_time:.2f} seconds. Status code: {status_code}. Result status: {result_data.get('status', 'N/A')}")
+    return json_response(result_data, status_code, request=request)
+
+
+@admission_controlled
+async def recommend_assessments_stream(request):
+    request_id = os.urandom(4).hex()
+    logging.info(f"[Req ID: {request_id}] Received request on /recommend/stream endpoint (ASGI).")
+    options, error_response = await read_recommend_request(request, request_id)
+    if error_response:
+        return error_response
+
+    not_ready = backend.check_pipeline_ready(options["query"])
+    if not_ready:
+        return json_response(*not_ready, request=request)
+    return StreamingResponse(
+        stream_recommendations_async(options["query"], expand=options["expand"], mode=options["mode"], timings=options["timings"],
+                                     filters=options["filters"], extract_filters=options["extract_filters"]),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global supabase_http, embedding_executor, admission
+    backend.start_initialization() # Models, sync clients and the local index load in the background as in backend.py
+    embedding_executor = ThreadPoolExecutor(max_workers=EMBEDDING_EXECUTOR_WORKERS, thread_name_prefix="embed")
+    admission = AsyncAdmissionController(ASYNC_MAX_CONCURRENT_REQUESTS, ASYNC_MAX_QUEUED_REQUESTS, backend.QUEUE_TIMEOUT_SECONDS)
+    if backend.SUPABASE_URL and backend.SUPABASE_KEY:
+        supabase_http = httpx.AsyncClient(
+            base_url=f"{backend.SUPABASE_URL.rstrip('/')}/rest/v1",
+            headers={"apikey": backend.SUPABASE_KEY, "Authorization": f"Bearer {backend.SUPABASE_KEY}"},
+            limits=httpx.Limits(max_connections=SUPABASE_POOL_MAX_CONNECTIONS, max_keepalive_connections=SUPABASE_POOL_MAX_KEEPALIVE,
+                                keepalive_expiry=SUPABASE_POOL_KEEPALIVE_EXPIRY_SECONDS),
+            timeout=httpx.Timeout(backend.RETRIEVAL_TIMEOUT_SECONDS, connect=SUPABASE_CONNECT_TIMEOUT_SECONDS)
+        )
+    else:
+        logging.warning("Supabase URL/Key missing; the async RPC path is disabled (local index only).")
+    try:
+        yield
+    finally:
+        if supabase_http is not None:
+            await supabase_http.aclose()
+        embedding_executor.shutdown(wait=False, cancel_futures=True)
+
+
+app = Starlette(
+    routes=[
+        Route("/recommend", recommend_assessments, methods=["POST"]),
+        Route("/recommend/stream", recommend_assessments_stream, methods=["POST"]),
+        # Everything else is served by the Flask app
+        Mount("/", app=WSGIMiddleware(backend.app)),
+    ],
+    lifespan=lifespan
+)
@@ -1,10 +1,26 @@
 # -*- coding: utf-8 -*- # Ensure UTF-8 encoding for broader character support
 import os
 import time
+_import_started = time.perf_counter() # Reported as import_timings['backend'] on /health
 import json
 import logging
+import sys
+import argparse
 import threading
-from flask import Flask, request, jsonify, Response, url_for
+import re
+import string
+import bisect
+import copy
+import hmac
+import hashlib
+import gc
+import gzip
+import functools
+import contextvars
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed, wait, FIRST_COMPLETED
+from flask import Flask, request, Response, url_for, stream_with_context, g
 from dotenv import load_dotenv
 
 # --- Set cache environment variables BEFORE importing model libraries ---
@@ -23,17 +39,27 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 APP_BASE_URL = os.getenv("APP_BASE_URL", "https://ankys34-shl-back.hf.space/").rstrip('/')
 
 
-# Now import model-related libraries AFTER setting environment variables
+# Now import model-related libraries AFTER setting environment variables. The heavy client libraries
+# (sentence_transformers/torch, supabase, google.generativeai) are imported by the initialization stages that
+# use them (see timed_import), so importing this module stays fast and the server binds its port right away.
 try:
-    from supabase import create_client, Client
-    from sentence_transformers import SentenceTransformer
-    import google.generativeai as genai
+    import numpy as np
 except ImportError as e:
     logging.critical(f"Failed to import required libraries: {e}. Ensure dependencies are installed.")
     # Exit or handle gracefully if essential libraries are missing
     # For now, we'll let the initialization fail later, but logging it here is crucial.
     pass
 
+# Optional: faster JSON encoding and Brotli compression; the standard library json and gzip are used without them
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 
 # --- Configuration ---
 EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
@@ -46,410 +72,3562 @@ MAX_QUERY_RETRIES = 2
 RETRY_QUERY_DELAY = 3
 GEMINI_QUERY_EXPANSION_TEMP = 0.6
 GEMINI_JSON_GENERATION_TEMP = 0.1 # Keep low for structured JSON
+GENERATION_PROMPT_STYLE = os.getenv("GENERATION_PROMPT_STYLE", "compact").lower() # "compact" (candidate table in, refs out) or "full" (JSON in, JSON objects out)
+GENERATION_PROMPT_TOKEN_BUDGET = int(os.getenv("GENERATION_PROMPT_TOKEN_BUDGET", 1200)) # Estimated input tokens for the compact prompt
+GENERATION_DESCRIPTION_MAX_CHARS = int(os.getenv("GENERATION_DESCRIPTION_MAX_CHARS", 240)) # Per-candidate description cap in the compact prompt
+GENERATION_DESCRIPTION_MIN_CHARS = 60 # Over budget, descriptions shrink down to this before low-ranked candidates are dropped
+GEMINI_STRUCTURED_OUTPUT = os.getenv("GEMINI_STRUCTURED_OUTPUT", "true").lower() == "true" # response_mime_type JSON with a response schema for the final call
+CHARS_PER_TOKEN = 4 # Token estimate used for budgeting; Gemini's own counts are logged from usage metadata
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "local").lower() # "local" (in-process index, RPC fallback) or "rpc"
+DB_PRODUCTS_TABLE = "products"
+DB_EMBEDDING_COLUMN = "embedding"
+DB_PAGE_SIZE = 1000 # Rows per page when loading the catalogue snapshot
+INDEX_REFRESH_INTERVAL = int(os.getenv("INDEX_REFRESH_INTERVAL", 900)) # Seconds between catalogue snapshot refreshes
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 512))
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", 3600))
+RESPONSE_CACHE_SIMILARITY_THRESHOLD = float(os.getenv("RESPONSE_CACHE_SIMILARITY_THRESHOLD", 0.92)) # Min cosine for a semantic hit
+QUERY_EXPANSION_MODE = os.getenv("QUERY_EXPANSION_MODE", "always").lower() # "always", "auto" (skip long/keyword-rich queries) or "never"
+EXPANSION_CACHE_MAX_ENTRIES = int(os.getenv("EXPANSION_CACHE_MAX_ENTRIES", 1024))
+EXPANSION_CACHE_TTL_SECONDS = int(os.getenv("EXPANSION_CACHE_TTL_SECONDS", 86400))
+EXPANSION_SKIP_MIN_WORDS = 12    # "auto" skips expansion for queries at least this long
+EXPANSION_SKIP_MIN_KEYWORDS = 5  # ...or with at least this many distinct content words
+EXPANSION_SKIP_KEYWORD_RATIO = 0.6 # ...making up at least this share of the query
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", 16)) # Recommendation requests processed at once per process
+MAX_QUEUED_REQUESTS = int(os.getenv("MAX_QUEUED_REQUESTS", 32)) # Further requests that may wait for a slot; beyond this, 429
+QUEUE_TIMEOUT_SECONDS = float(os.getenv("QUEUE_TIMEOUT_SECONDS", 10)) # Max wait for a slot before answering 429
+OVERLOAD_RETRY_AFTER_SECONDS = 2 # Retry-After header on 429 responses
+# Each admitted request can have expansion and retrieval in flight at once, so size the I/O pool to match
+PIPELINE_MAX_WORKERS = int(os.getenv("PIPELINE_MAX_WORKERS", 2 * MAX_CONCURRENT_REQUESTS)) # Threads shared by concurrent pipeline stages
+EXPANSION_TIMEOUT_SECONDS = float(os.getenv("EXPANSION_TIMEOUT_SECONDS", 8)) # After this, answer from the raw-query branch
+RETRIEVAL_TIMEOUT_SECONDS = float(os.getenv("RETRIEVAL_TIMEOUT_SECONDS", 10)) # Covers RPC retries
+GENERATION_TIMEOUT_SECONDS = float(os.getenv("GENERATION_TIMEOUT_SECONDS", 60))
+CIRCUIT_BREAKER_ENABLED = os.getenv("CIRCUIT_BREAKER_ENABLED", "true").lower() == "true" # Fail fast while Supabase or Gemini is failing or slow
+CIRCUIT_WINDOW_SIZE = int(os.getenv("CIRCUIT_WINDOW_SIZE", 20)) # Recent calls per dependency the failure rate is computed over
+CIRCUIT_MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", 5)) # Calls needed in the window before the breaker may open
+CIRCUIT_FAILURE_RATE = float(os.getenv("CIRCUIT_FAILURE_RATE", 0.5)) # Share of failed or slow calls in the window that opens the breaker
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", 30)) # Fail fast this long, then let one probe call through
+SUPABASE_SLOW_CALL_SECONDS = float(os.getenv("SUPABASE_SLOW_CALL_SECONDS", 2)) # Slower RPC calls count as failures for the breaker
+GEMINI_SLOW_CALL_SECONDS = float(os.getenv("GEMINI_SLOW_CALL_SECONDS", 20)) # Slower Gemini calls count as failures for the breaker
+HEDGED_DEPENDENCIES = {name.strip() for name in os.getenv("HEDGED_DEPENDENCIES", "").lower().split(",") if name.strip()} # "supabase", "gemini": send a second call when the first is slow
+HEDGE_QUANTILE = float(os.getenv("HEDGE_QUANTILE", 0.95)) # The second call starts once the first has run longer than this latency quantile
+HEDGE_MIN_SAMPLES = 20 # Successful calls needed before the quantile is trusted; no hedging until then
+HEDGE_LATENCY_WINDOW = 200 # Recent successful call latencies kept per dependency
+HEDGE_MIN_DELAY_SECONDS = 0.02
+COALESCE_REQUESTS = os.getenv("COALESCE_REQUESTS", "true").lower() == "true" # Identical concurrent requests share one pipeline run
+RRF_K = 60 # Reciprocal rank fusion constant for merging raw, expanded and lexical candidate lists
+LEXICAL_SEARCH_ENABLED = os.getenv("LEXICAL_SEARCH_ENABLED", "true").lower() == "true" # BM25 over the local catalogue, fused with vector results
+BM25_K1 = 1.2
+BM25_B = 0.75
+LEXICAL_NAME_BOOST = 3 # Product-name terms count this many times in a product's BM25 document
+LEXICAL_PREFIX_MIN_CHARS = 3 # Unknown query terms at least this long match the index terms they prefix ('opq32' -> 'opq32r')
+LEXICAL_PREFIX_MAX_TERMS = 5
+LEXICAL_PRECISE_MAX_DOC_RATIO = 0.05 # A precise name match needs a query term found in at most this share of products
+FILTER_EXTRACTION = os.getenv("FILTER_EXTRACTION", "false").lower() == "true" # Default for 'extract_filters': read duration/remote/adaptive constraints from the query text
+FILTER_RPC_OVERFETCH = 5 # The RPC cannot filter before top-k, so filtered RPC searches fetch this many times DB_RETRIEVAL_COUNT
+ADAPTIVE_RETRIEVAL = os.getenv("ADAPTIVE_RETRIEVAL", "true").lower() == "true" # Pick retrieval depth and early exit from the raw-query score distribution
+ADAPTIVE_MAX_RETRIEVAL_COUNT = int(os.getenv("ADAPTIVE_MAX_RETRIEVAL_COUNT", 12)) # Depth fetched for the policy; kept in full only when scores are flat
+CONFIDENT_MIN_SIMILARITY = float(os.getenv("CONFIDENT_MIN_SIMILARITY", 0.75)) # Early exit: every direct pick scores at least this...
+CONFIDENT_MIN_MARGIN = float(os.getenv("CONFIDENT_MIN_MARGIN", 0.1)) # ...and the picks lead the next candidate by at least this
+FLAT_MAX_SPREAD = float(os.getenv("FLAT_MAX_SPREAD", 0.05)) # Top DB_RETRIEVAL_COUNT scores within this spread are flat: widen k
+BATCH_MAX_QUERIES = int(os.getenv("BATCH_MAX_QUERIES", 1000)) # Per /recommend/batch request
+BATCH_LLM_CONCURRENCY = int(os.getenv("BATCH_LLM_CONCURRENCY", 4)) # Concurrent Gemini calls per batch
+BATCH_ENCODE_SIZE = 64 # SentenceTransformer.encode batch_size for batch requests
+RANKING_MODE = os.getenv("RANKING_MODE", "llm").lower() # "llm" (Gemini selects and formats) or "fast" (local reranker)
+RERANKER_MODEL_NAME = os.getenv("RERANKER_MODEL_NAME", "") # Optional CrossEncoder for "fast" mode; lexical reranker if empty
+RERANK_SIMILARITY_WEIGHT = 0.6 # Lexical reranker: share of the score taken from vector similarity
+FAST_MODE_MIN_SCORE = float(os.getenv("FAST_MODE_MIN_SCORE", 0.0)) # Below this best score, "fast" mode reports no relevant match
+GEMINI_MODEL_NAME = 'gemini-2.5-pro-preview-03-25'
+# Prebuilt startup artifact (see `python backend.py build-snapshot`): saved model weights plus catalogue embeddings
+WARM_START_DIR = os.getenv("WARM_START_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "warm_start"))
+WARM_START_MODEL_SUBDIR = "model"
+WARM_START_CATALOGUE_FILE = "catalogue.npz"
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch").lower() # "torch" (SentenceTransformer), "onnx" or "onnx-int8"
+EMBEDDING_MAX_SEQ_LENGTH = 256 # all-MiniLM-L6-v2 truncation length
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", os.path.join(WARM_START_DIR, "onnx")) # Written by `python backend.py export-onnx`
+ONNX_MODEL_FILE = "model.onnx"
+ONNX_INT8_MODEL_FILE = "model_int8.onnx"
+ONNX_INTRA_OP_THREADS = int(os.getenv("ONNX_INTRA_OP_THREADS", 0)) # 0 lets ONNX Runtime decide
+EMBEDDING_PARITY_MIN_COSINE = 0.99 # ONNX backends must match the PyTorch vectors at least this closely
+DB_EMBEDDING_HASH_COLUMN = "embedding_hash" # sha256 of the embedding text; unchanged rows are not re-embedded
+DB_CONTENT_HASH_COLUMN = "content_hash"     # sha256 of the whole record; unchanged rows are not written at all
+INGEST_ENCODE_BATCH_SIZE = 256
+INGEST_UPSERT_CHUNK_SIZE = 500
+ADMIN_API_KEY = os.getenv("ADMIN_API_KEY") # Required for /admin routes; they are disabled when unset
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true" # Exposes /metrics (Prometheus text format)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0) # Histogram buckets, seconds
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESSION_MIN_BYTES", 1024)) # Smaller JSON bodies are sent uncompressed
+RESPONSE_GZIP_LEVEL = 6
+RESPONSE_BROTLI_QUALITY = 5 # Brotli is used over gzip when the client accepts it and the brotli package is installed
+RESPONSE_CACHE_CONTROL = os.getenv("RESPONSE_CACHE_CONTROL", "no-cache") # Cache-Control for successful JSON responses; clients revalidate with the ETag
+
+# --- Initialize Clients (Global Scope) ---
+supabase_client = None
+embed_model = None
+gen_model = None
+initialization_error_message = None
+initialization_complete = False
+initialization_thread = None
+initialization_stages = {} # stage name -> {"status", "duration_seconds", "error"} for /health
+gemini_error_message = None # Gemini failures degrade to "fast" ranking instead of failing initialization
+ingestion_lock = threading.Lock()
+ingestion_status = {"state": "idle"} # Last/current admin ingestion job, for /admin/ingest/status
+vector_index = None
+index_refresh_thread = None
+response_cache = None
+expansion_cache = None
+pipeline_executor = None
+hedge_executor = None
+reranker_model = None
+reranker_load_failed = False
+reranker_lock = threading.Lock()
+admission_controller = None
+request_coalescer = None
+structured_output_supported = True # Cleared if the installed SDK rejects response_mime_type/response_schema
+genai = None # google.generativeai, imported by _init_gemini
+import_timings = {} # component -> import seconds, for /health and /metrics
+
+# --- Flask App Definition ---
+app = Flask(__name__)
+app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False # Responses are compact; pretty-printed only with ?pretty=1
+app.config['JSON_SORT_KEYS'] = False  # Preserve the order of keys in the JSON response
+app.config['JSONIFY_MIMETYPE'] = 'application/json; charset=utf-8'  # Ensure proper content type
+
+# --- JSON Response Encoding ---
+JSON_MIMETYPE = 'application/json; charset=utf-8'
+SERIALIZATION_ERROR = {"error": "Internal server error: Failed to serialize response.", "status": "internal_error"}
+
+
+def encode_json(data, pretty=False) -> bytes:
+    """Serializes data to UTF-8 JSON bytes: compact by default, indented when pretty. Uses orjson when installed."""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY | (orjson.OPT_INDENT_2 if pretty else 0)
+        try:
+            return orjson.dumps(data, option=option)
+        except TypeError:
+            pass # orjson is stricter (e.g. integers beyond 64 bits); let the standard encoder decide
+    if pretty:
+        return json.dumps(data, indent=2, ensure_ascii=False).encode("utf-8")
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def wants_pretty_json(value) -> bool:
+    """True for a truthy ?pretty= query parameter."""
+    return isinstance(value, str) and value.lower() in ("1", "true", "yes")
+
+
+def json_etag(body: bytes) -> str:
+    """Weak validator for a JSON body; weak because gzip and brotli representations of it differ byte for byte."""
+    return f'W/"{hashlib.blake2b(body, digest_size=12).hexdigest()}"'
+
+
+def etag_matches(if_none_match, etag) -> bool:
+    """If-None-Match comparison (weak, as RFC 9110 requires for this header)."""
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or etag.removeprefix("W/") in {tag.removeprefix("W/") for tag in candidates}
+
+
+def negotiate_encoding(accept_encoding, body_size):
+    """Picks 'br' or 'gzip' from an Accept-Encoding header for a body of body_size bytes, or None to send it as is."""
+    if not accept_encoding or body_size < RESPONSE_COMPRESSION_MIN_BYTES:
+        return None
+    weights = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        weight = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key.lower() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[name.strip().lower()] = weight
+    wildcard = weights.get("*", 0.0)
+    offers = ["br", "gzip"] if brotli is not None else ["gzip"] # Preference order on equal weights
+    best = max(offers, key=lambda encoding: weights.get(encoding, wildcard)) # max keeps the first of equal weights
+    return best if weights.get(best, wildcard) > 0 else None
+
+
+def compress_body(body: bytes, encoding) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=RESPONSE_BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=RESPONSE_GZIP_LEVEL, mtime=0)
+
+
+def serialize_response(data, pretty=False):
+    """Returns (body, etag, memo). Cached results (see CachedResponse) reuse the compact bytes kept on their cache entry.
+
+    memo is that entry's dict of encoded forms (None for uncached data); pass it on to compress_response.
+    """
+    memo = data.encodings if isinstance(data, CachedResponse) and not pretty else None
+    if memo is not None and "identity" in memo:
+        return memo["identity"], memo["etag"], memo
+    body = encode_json(data, pretty)
+    etag = json_etag(body)
+    if memo is not None:
+        memo["etag"] = etag
+        memo["identity"] = body
+    return body, etag, memo
+
+
+def compress_response(body: bytes, accept_encoding, memo=None):
+    """Compresses body as negotiated from Accept-Encoding. Returns (body, content_encoding or None)."""
+    encoding = negotiate_encoding(accept_encoding, len(body))
+    if encoding is None:
+        return body, None
+    if memo is None:
+        return compress_body(body, encoding), encoding
+    if encoding not in memo:
+        memo[encoding] = compress_body(body, encoding)
+    return memo[encoding], encoding
+
+
+def response_headers(etag, status_code, content_encoding=None):
+    """ETag, Cache-Control and Vary headers shared by the Flask and ASGI JSON responses."""
+    headers = {"ETag": etag, "Cache-Control": RESPONSE_CACHE_CONTROL if status_code < 400 else "no-store", "Vary": "Accept-Encoding"}
+    if content_encoding:
+        headers["Content-Encoding"] = content_encoding
+    return headers
+
+
+def json_response(data, status_code=200, headers=None):
+    """Compact JSON response (indented with ?pretty=1), compressed when the client accepts gzip or br.
+
+    Successful GET responses carry an ETag and answer a matching If-None-Match with 304.
+    """
+    pretty = wants_pretty_json(request.args.get("pretty"))
+    try:
+        body, etag, memo = serialize_response(data, pretty)
+    except TypeError as e:
+        logging.error(f"Failed to serialize data to JSON: {e}. Data: {data}")
+        body, etag, memo = serialize_response(SERIALIZATION_ERROR, pretty)
+        status_code = 500
+
+    if status_code == 200 and request.method in ("GET", "HEAD") and etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(status=304, headers=dict(response_headers(etag, status_code), **(headers or {})))
+    body, content_encoding = compress_response(body, request.headers.get("Accept-Encoding"), memo)
+    return Response(body, status=status_code, mimetype=JSON_MIMETYPE,
+                    headers=dict(response_headers(etag, status_code, content_encoding), **(headers or {})))
+
+
+# --- Request Tracing and Metrics ---
+class MetricsRegistry:
+    """Thread-safe counters and latency histograms rendered in the Prometheus text exposition format."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._counters = {}   # (name, labels) -> value
+        self._histograms = {} # (name, labels) -> [per-bucket counts, sum, count]
+        self._help = {}       # name -> (type, help text)
+        self._lock = threading.Lock()
+
+    def describe(self, name, metric_type, help_text):
+        self._help[name] = (metric_type, help_text)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][idx] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self, gauges=()):
+        """Returns the exposition text. gauges is an iterable of (name, help, value, labels dict) read at scrape time."""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(value[0]), value[1], value[2]) for key, value in self._histograms.items()}
+        lines = []
+        described = set()
+
+        def header(name, metric_type, help_text=None):
+            if name not in described:
+                described.add(name)
+                default_type, default_help = self._help.get(name, (metric_type, name))
+                lines.append(f"# HELP {name} {help_text or default_help}")
+                lines.append(f"# TYPE {name} {default_type}")
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name, "counter")
+            lines.append(f"{name}{format_metric_labels(dict(labels))} {value}")
+        for (name, labels), (bucket_counts, total, count) in sorted(histograms.items()):
+            header(name, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{format_metric_labels(dict(labels, le=repr(bound)))} {cumulative}")
+            lines.append(f"{name}_bucket{format_metric_labels(dict(labels, le='+Inf'))} {count}")
+            lines.append(f"{name}_sum{format_metric_labels(dict(labels))} {round(total, 6)}")
+            lines.append(f"{name}_count{format_metric_labels(dict(labels))} {count}")
+        for name, help_text, value, labels in gauges:
+            metric_type = "counter" if name.endswith("_total") else "gauge"
+            header(name, metric_type, help_text)
+            lines.append(f"{name}{format_metric_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def format_metric_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels.keys(), escaped)) + "}"
+
+
+metrics = MetricsRegistry()
+metrics.describe("shl_stage_duration_seconds", "histogram", "Duration of one pipeline stage: cache_lookup, encode, expansion, lexical_search, local_search, rpc, retry_sleep, generation or rerank.")
+metrics.describe("shl_request_duration_seconds", "histogram", "Time to produce a response, by endpoint (streaming endpoints: time to first byte).")
+metrics.describe("shl_requests_total", "counter", "Requests by endpoint and HTTP status code.")
+metrics.describe("shl_rpc_retries_total", "counter", "Supabase match_products RPC attempts that failed and were retried.")
+metrics.describe("shl_llm_blocked_total", "counter", "Gemini responses blocked by the safety filter, by call.")
+metrics.describe("shl_llm_errors_total", "counter", "Gemini calls that raised or returned no usable text, by call.")
+metrics.describe("shl_json_parse_failures_total", "counter", "Final Gemini responses that could not be parsed as JSON.")
+metrics.describe("shl_json_repairs_total", "counter", "Final Gemini responses with invalid or truncated JSON that were repaired locally.")
+metrics.describe("shl_llm_tokens_total", "counter", "Gemini tokens by call and kind (prompt or output). Prompt tokens are estimated when the response has no usage metadata.")
+metrics.describe("shl_retrieval_policy_total", "counter", "Adaptive retrieval decisions by policy: confident (answered without Gemini), flat (widened k) or default.")
+metrics.describe("shl_coalesced_requests_total", "counter", "Requests that waited on an identical in-flight request instead of running the pipeline.")
+metrics.describe("shl_circuit_opened_total", "counter", "Times a dependency's circuit breaker opened, by dependency (supabase or gemini).")
+metrics.describe("shl_circuit_rejected_total", "counter", "Calls failed fast because the dependency's circuit breaker was open.")
+metrics.describe("shl_hedged_requests_total", "counter", "Dependency calls that started a hedge (second) call after the latency quantile delay.")
+metrics.describe("shl_hedge_wins_total", "counter", "Hedge calls that returned a result before the original call.")
+metrics.describe("shl_rejected_requests_total", "counter", "Requests answered 429 because the admission queue was full or timed out.")
+
+_current_trace = contextvars.ContextVar("request_trace", default=None) # Per thread, and per asyncio task in asgi.py
+
+
+class RequestTrace:
+    """Spans recorded for one request. Spans may be added from pipeline worker threads."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, name, started, duration):
+        with self._lock:
+            self.spans.append((name, started - self.started, duration))
+
+    def to_dict(self):
+        """The 'timings' block: total plus each span's offset and duration in milliseconds, in start order."""
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span[1])
+        return {
+            "total_ms": round((time.perf_counter() - self.started) * 1000, 1),
+            "spans": [{"stage": name, "start_ms": round(offset * 1000, 1), "duration_ms": round(duration * 1000, 1)} for name, offset, duration in spans]
+        }
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextmanager
+def request_trace(trace=None):
+    """Makes a trace current for this thread (or asyncio task) for the duration of the block, restoring the previous one afterwards."""
+    previous = _current_trace.get()
+    trace = trace if trace is not None else RequestTrace()
+    _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.set(previous)
+
+
+@contextmanager
+def trace_span(stage):
+    """Times a pipeline stage into the stage histogram and, if one is active, the current request trace."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started
+        metrics.observe("shl_stage_duration_seconds", duration, stage=stage)
+        trace = current_trace()
+        if trace is not None:
+            trace.add(stage, started, duration)
+
+
+def submit_traced(executor, fn, *args):
+    """executor.submit that carries the caller's request trace into the worker thread."""
+    trace = current_trace()
+    if trace is None:
+        return executor.submit(fn, *args)
+
+    def run_with_trace():
+        with request_trace(trace):
+            return fn(*args)
+    return executor.submit(run_with_trace)
+
+
+# --- Async Initialization Function ---
+@contextmanager
+def timed_import(component):
+    """Records how long the imports in the block take under import_timings[component]."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        import_timings[component] = round(time.perf_counter() - started, 3)
+        logging.info(f"Imported {component} in {import_timings[component]:.2f} seconds.")
+
+
+def _run_init_stage(name, stage_function):
+    """Runs one initialization stage, recording its status and duration for /health. Returns True on success."""
+    initialization_stages[name] = {"status": "running"}
+    started = time.time()
+    try:
+        status = stage_function() or "ready"
+        initialization_stages[name] = {"status": status, "duration_seconds": round(time.time() - started, 2)}
+        logging.info(f"Initialization stage '{name}' {status} in {time.time() - started:.2f} seconds.")
+        return status in ("ready", "preloaded")
+    except Exception as e:
+        logging.error(f"Initialization stage '{name}' failed: {e}", exc_info=True)
+        initialization_stages[name] = {"status": "failed", "duration_seconds": round(time.time() - started, 2), "error": str(e)}
+        return False
+
+
+def _init_supabase():
+    global supabase_client
+    logging.info("Initializing Supabase client...")
+    if not SUPABASE_URL or not SUPABASE_KEY:
+        raise ValueError("Supabase URL/Key missing in environment variables.")
+    with timed_import("supabase"):
+        from supabase import create_client
+    supabase_client = create_client(SUPABASE_URL, SUPABASE_KEY)
+
+
+def _init_embedding_model():
+    global embed_model
+    if embed_model is not None:
+        return "preloaded" # Loaded in the gunicorn master before fork (see preload_shared_state)
+    model = load_embedding_model(EMBEDDING_BACKEND)
+    actual_dimension = model.get_sentence_embedding_dimension()
+    if actual_dimension != EXPECTED_EMBEDDING_DIMENSION:
+        raise ValueError(f"Embedding model dimension mismatch! Expected {EXPECTED_EMBEDDING_DIMENSION}, but got {actual_dimension}.")
+    embed_model = model
+
+
+def _init_gemini():
+    global gen_model, genai
+    logging.info("Initializing Gemini client...")
+    if not GEMINI_API_KEY:
+        raise ValueError("Gemini API Key missing in environment variables.")
+    with timed_import("google.generativeai"):
+        import google.generativeai as genai
+    genai.configure(api_key=GEMINI_API_KEY)
+    # It's good practice to specify the model generation configuration here if needed
+    gen_model = genai.GenerativeModel(
+         model_name=GEMINI_MODEL_NAME, # Using gemini-1.5-flash as 2.0 isn't a standard public name yet
+         # generation_config=genai.types.GenerationConfig(...) # Can be set here or per-call
+         # safety_settings=... # Consider configuring safety settings
+    )
+
+
+def _init_catalogue_snapshot():
+    if vector_index is not None and vector_index.ready:
+        return "preloaded"
+    snapshot_path = os.path.join(WARM_START_DIR, WARM_START_CATALOGUE_FILE)
+    if not os.path.isfile(snapshot_path):
+        return "skipped"
+    load_catalogue_snapshot(snapshot_path)
+
+
+def _init_vector_index():
+    if not refresh_vector_index():
+        raise RuntimeError(f"Local vector index unavailable; falling back to '{DB_FUNCTION_NAME}' RPC for retrieval.")
+
+
+def async_initialize():
+    """Loads all components in parallel stages. Serving starts once retrieval is ready, even if Gemini is not."""
+    global initialization_error_message, initialization_complete, gemini_error_message
+    started = time.time()
+    use_local_index = RETRIEVAL_MODE == "local"
+    with ThreadPoolExecutor(max_workers=4, thread_name_prefix="init") as executor:
+        supabase_future = executor.submit(_run_init_stage, "supabase", _init_supabase)
+        embedding_future = executor.submit(_run_init_stage, "embedding_model", _init_embedding_model)
+        gemini_future = executor.submit(_run_init_stage, "gemini", _init_gemini)
+        snapshot_future = executor.submit(_run_init_stage, "catalogue_snapshot", _init_catalogue_snapshot) if use_local_index else None
+
+        supabase_ready = supabase_future.result()
+        snapshot_loaded = snapshot_future.result() if snapshot_future else False
+        if use_local_index and supabase_ready and not snapshot_loaded:
+            # No warm-start artifact: build the index from Supabase before serving
+            _run_init_stage("vector_index", _init_vector_index)
+        embedding_ready = embedding_future.result()
+
+        index_ready = vector_index is not None and vector_index.ready
+        if embedding_ready and (supabase_ready or index_ready):
+            initialization_complete = True
+            logging.info(f"Retrieval ready after {time.time() - started:.2f} seconds; serving requests.")
+        else:
+            failed = {name: stage.get("error") for name, stage in initialization_stages.items() if stage.get("status") == "failed"}
+            initialization_error_message = f"Server initialization failed: {failed or 'no retrieval source available'}"
+            logging.critical(f"CRITICAL ERROR DURING INITIALIZATION: {initialization_error_message}")
+            return
+
+        if not gemini_future.result():
+            gemini_error_message = initialization_stages["gemini"].get("error")
+            logging.warning(f"Gemini unavailable ({gemini_error_message}); serving in degraded mode with LLM-free ranking.")
+
+    if use_local_index:
+        # A warm-start snapshot may be older than the database, so refresh it right away in the background
+        start_index_refresh(refresh_now=snapshot_loaded)
+    logging.info(f"Initialization completed in {time.time() - started:.2f} seconds")
+
+def preload_shared_state():
+    """Loads the embedding model and warm-start catalogue in the gunicorn master, before workers fork.
+
+    Forked workers then share the weights and the index matrix copy-on-write instead of each loading its own.
+    Network clients and threads do not survive fork, so each worker still runs start_initialization() for
+    Supabase, Gemini and the refresh loop; its embedding/snapshot stages find the preloaded state and skip.
+    """
+    if EMBEDDING_BACKEND.startswith("onnx"):
+        # ONNX Runtime sessions own native thread pools that would be dead in the children
+        logging.info("ONNX embedding backend: loading the model in each worker instead of preloading.")
+    else:
+        _run_init_stage("embedding_model", _init_embedding_model)
+    if RETRIEVAL_MODE == "local":
+        _run_init_stage("catalogue_snapshot", _init_catalogue_snapshot)
+    # Move everything loaded so far out of the collector's reach so GC passes in the workers don't touch
+    # (and so copy) the shared pages
+    gc.collect()
+    gc.freeze()
+
+
+# --- Start initialization in background thread ---
+def start_initialization():
+    global initialization_thread
+    # Prevent starting multiple threads if called again
+    if initialization_thread is None or not initialization_thread.is_alive():
+        logging.info("Starting initialization in background thread")
+        initialization_thread = threading.Thread(target=async_initialize)
+        initialization_thread.daemon = True # Ensure thread exits when main process exits
+        initialization_thread.start()
+    else:
+        logging.info("Initialization thread already running.")
+
+
+# --- Helper Function for Embedding Text ---
+def get_embedding_text(product):
+    """Combines important fields for richer embedding context."""
+    # Improved handling for potentially missing or None values
+    parts = [
+        f"Product: {product.get('product_name', '')}",
+        f"Type: {', '.join(product.get('product_type', [])) if product.get('product_type') else ''}",
+        f"Solution Type: {product.get('solution_type', '')}",
+        f"Description: {product.get('description', '')}",
+        f"Measures: {', '.join(product.get('measured_constructs', [])) if product.get('measured_constructs') else ''}",
+        # Robust handling for job_roles and target_audience which might contain non-strings or None
+        f"Roles: {', '.join(str(item).strip() for item in product.get('job_roles', []) if item and isinstance(str(item).strip(), str) and str(item).strip())}",
+        f"Target Audience: {', '.join(str(item).strip() for item in product.get('target_audience', []) if item and isinstance(str(item).strip(), str) and str(item).strip())}"
+    ]
+    # Filter out parts that are empty after formatting (e.g., "Roles: ")
+    return " | ".join(part for part in parts if ': ' in part and len(part.split(': ', 1)) > 1 and part.split(': ', 1)[1].strip())
+
+
+# --- Embedding Backends ---
+class OnnxEmbeddingModel:
+    """SentenceTransformer-compatible encoder (mean pooling + L2 norm) on ONNX Runtime, without importing torch."""
+
+    def __init__(self, model_dir, quantized=False, max_seq_length=EMBEDDING_MAX_SEQ_LENGTH):
+        with timed_import("onnxruntime"):
+            import onnxruntime as ort
+            from tokenizers import Tokenizer
+
+        model_file = os.path.join(model_dir, ONNX_INT8_MODEL_FILE if quantized else ONNX_MODEL_FILE)
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if ONNX_INTRA_OP_THREADS:
+            options.intra_op_num_threads = ONNX_INTRA_OP_THREADS
+        self.session = ort.InferenceSession(model_file, sess_options=options, providers=["CPUExecutionProvider"])
+        self.backend = "onnx-int8" if quantized else "onnx"
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=max_seq_length)
+        pad_id = self.tokenizer.token_to_id("[PAD]")
+        self.tokenizer.enable_padding(pad_id=pad_id if pad_id is not None else 0, pad_token="[PAD]")
+
+        hidden_size = self.session.get_outputs()[0].shape[-1]
+        self._dimension = hidden_size if isinstance(hidden_size, int) else len(self.encode("dimension probe"))
+
+    def get_sentence_embedding_dimension(self):
+        return self._dimension
+
+    def encode(self, sentences, batch_size=32, **kwargs):
+        """Encodes a string (returns a 1-D array) or a list of strings (returns a 2-D array)."""
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        batches = []
+        for start in range(0, len(texts), batch_size):
+            encodings = self.tokenizer.encode_batch(texts[start:start + batch_size])
+            attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+            feeds = {"input_ids": np.array([encoding.ids for encoding in encodings], dtype=np.int64), "attention_mask": attention_mask}
+            if "token_type_ids" in self.input_names:
+                feeds["token_type_ids"] = np.array([encoding.type_ids for encoding in encodings], dtype=np.int64)
+            token_embeddings = self.session.run(None, feeds)[0]
+
+            # Mean pooling over real tokens, then L2 normalisation (matches the sentence-transformers pipeline)
+            mask = attention_mask[..., None].astype(np.float32)
+            pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            batches.append(pooled.astype(np.float32))
+        embeddings = np.concatenate(batches) if batches else np.zeros((0, self._dimension), dtype=np.float32)
+        return embeddings[0] if single else embeddings
+
+
+def load_embedding_model(backend):
+    """Returns an encoder for EMBEDDING_MODEL_NAME on the given backend ('torch', 'onnx' or 'onnx-int8')."""
+    if backend in ("onnx", "onnx-int8"):
+        model_file = os.path.join(ONNX_MODEL_DIR, ONNX_INT8_MODEL_FILE if backend == "onnx-int8" else ONNX_MODEL_FILE)
+        if os.path.isfile(model_file):
+            logging.info(f"Loading '{backend}' embedding model from '{model_file}'...")
+            return OnnxEmbeddingModel(ONNX_MODEL_DIR, quantized=backend == "onnx-int8")
+        logging.warning(f"ONNX model '{model_file}' not found (run `python backend.py export-onnx`); falling back to the torch backend.")
+    elif backend != "torch":
+        logging.warning(f"Unknown EMBEDDING_BACKEND '{backend}'; using the torch backend.")
+
+    with timed_import("sentence_transformers"):
+        from sentence_transformers import SentenceTransformer
+    # Prefer the weights saved in the warm-start artifact over a hub lookup/download
+    model_path = os.path.join(WARM_START_DIR, WARM_START_MODEL_SUBDIR)
+    model_source = model_path if os.path.isdir(model_path) else EMBEDDING_MODEL_NAME
+    logging.info(f"Loading embedding model from '{model_source}'...")
+    return SentenceTransformer(model_source)
+
+
+def export_onnx_embedding_model(output_dir=ONNX_MODEL_DIR):
+    """Exports EMBEDDING_MODEL_NAME to ONNX plus a dynamically quantized int8 copy. Needs torch at build time only."""
+    import torch
+    from sentence_transformers import SentenceTransformer
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    model = SentenceTransformer(EMBEDDING_MODEL_NAME, device="cpu")
+    pooling = model[1] if len(model) > 1 else None
+    if pooling is not None and not getattr(pooling, "pooling_mode_mean_tokens", True):
+        raise ValueError(f"'{EMBEDDING_MODEL_NAME}' does not use mean pooling, which OnnxEmbeddingModel assumes.")
+    transformer = model[0].auto_model.eval()
+    tokenizer = model[0].tokenizer
+
+    os.makedirs(output_dir, exist_ok=True)
+    tokenizer.save_pretrained(output_dir) # Writes tokenizer.json for the `tokenizers` runtime
+    sample = tokenizer(["Warm up sentence for export."], return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+
+    class _LastHiddenState(torch.nn.Module):
+        def __init__(self, wrapped):
+            super().__init__()
+            self.wrapped = wrapped
+
+        def forward(self, *inputs):
+            return self.wrapped(**dict(zip(input_names, inputs))).last_hidden_state
+
+    model_path = os.path.join(output_dir, ONNX_MODEL_FILE)
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names + ["last_hidden_state"]}
+    with torch.no_grad():
+        torch.onnx.export(_LastHiddenState(transformer), tuple(sample[name] for name in input_names), model_path,
+                          input_names=input_names, output_names=["last_hidden_state"], dynamic_axes=dynamic_axes, opset_version=14)
+    quantize_dynamic(model_path, os.path.join(output_dir, ONNX_INT8_MODEL_FILE), weight_type=QuantType.QInt8)
+    logging.info(f"Exported ONNX embedding models to '{output_dir}'.")
+
+
+EMBEDDING_PARITY_SAMPLES = [
+    "java developer test",
+    "assessment for collaborative software engineers",
+    "personality questionnaire for sales managers",
+    "numerical reasoning under 30 minutes, remote",
+    "OPQ32",
+    "entry-level customer service simulation with situational judgement",
+    "Product: Verbal Reasoning | Type: Ability & Aptitude | Description: Measures the ability to evaluate written information."
+]
+
+
+def check_embedding_backend(backend, iterations=50):
+    """Parity check (cosine vs. the PyTorch vectors) and single-query encode microbenchmark. Returns True if parity holds."""
+    from sentence_transformers import SentenceTransformer
+
+    texts = list(EMBEDDING_PARITY_SAMPLES)
+    snapshot_path = os.path.join(WARM_START_DIR, WARM_START_CATALOGUE_FILE)
+    if os.path.isfile(snapshot_path):
+        with np.load(snapshot_path, allow_pickle=False) as snapshot:
+            texts.extend(get_embedding_text(row) for row in json.loads(str(snapshot["rows"]))[:200])
+
+    reference = SentenceTransformer(EMBEDDING_MODEL_NAME, device="cpu")
+    candidate = load_embedding_model(backend)
+    reference_vectors = reference.encode(texts, normalize_embeddings=True)
+    candidate_vectors = np.asarray(candidate.encode(texts), dtype=np.float32)
+    candidate_vectors /= np.clip(np.linalg.norm(candidate_vectors, axis=1, keepdims=True), 1e-12, None)
+    cosines = (reference_vectors * candidate_vectors).sum(axis=1)
+
+    def single_query_latency_ms(model):
+        model.encode(texts[0]) # Warm-up
+        timings = []
+        for idx in range(iterations):
+            started = time.perf_counter()
+            model.encode(texts[idx % len(texts)])
+            timings.append((time.perf_counter() - started) * 1000)
+        return np.percentile(timings, 50), np.percentile(timings, 95)
+
+    reference_p50, reference_p95 = single_query_latency_ms(reference)
+    candidate_p50, candidate_p95 = single_query_latency_ms(candidate)
+    passed = float(cosines.min()) >= EMBEDDING_PARITY_MIN_COSINE
+    print(f"Embedding backend '{backend}' vs torch on {len(texts)} texts")
+    print(f"  cosine: min {cosines.min():.4f}  mean {cosines.mean():.4f}  (required >= {EMBEDDING_PARITY_MIN_COSINE}) {'PASS' if passed else 'FAIL'}")
+    print(f"  single-query encode: torch p50 {reference_p50:.2f} ms / p95 {reference_p95:.2f} ms, {backend} p50 {candidate_p50:.2f} ms / p95 {candidate_p95:.2f} ms")
+    for label, filename in (("onnx", ONNX_MODEL_FILE), ("onnx-int8", ONNX_INT8_MODEL_FILE)):
+        path = os.path.join(ONNX_MODEL_DIR, filename)
+        if os.path.isfile(path):
+            print(f"  {label} model size: {os.path.getsize(path) / 1e6:.1f} MB")
+    return passed
+
+
+# --- Lexical Index (BM25) ---
+def lexical_terms(text: str):
+    return [term for term in tokenize(text) if term not in QUERY_STOPWORDS]
+
+
+class LexicalIndex:
+    """BM25 inverted index over the get_embedding_text fields of catalogue rows, with product-name terms weighted up.
+
+    Built alongside each local vector index snapshot; per-document term weights are precomputed, so a
+    search is a handful of array additions.
+    """
+
+    def __init__(self, rows):
+        term_counts = {} # term -> {position: term frequency}
+        document_lengths = np.zeros(len(rows), dtype=np.float32)
+        self.name_terms = []
+        for position, row in enumerate(rows):
+            name_terms = lexical_terms(row.get('product_name') or "")
+            terms = lexical_terms(get_embedding_text(row)) + name_terms * (LEXICAL_NAME_BOOST - 1)
+            self.name_terms.append(frozenset(name_terms))
+            document_lengths[position] = len(terms)
+            for term in terms:
+                counts = term_counts.setdefault(term, {})
+                counts[position] = counts.get(position, 0) + 1
+
+        self.size = len(rows)
+        average_length = max(float(document_lengths.mean()) if self.size else 0.0, 1.0)
+        self.document_frequency = {}
+        self._postings = {} # term -> (positions, BM25 weights)
+        for term, counts in term_counts.items():
+            positions = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+            frequencies = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+            idf = np.log(1 + (self.size - len(counts) + 0.5) / (len(counts) + 0.5))
+            length_norms = BM25_K1 * (1 - BM25_B + BM25_B * document_lengths[positions] / average_length)
+            self._postings[term] = (positions, (idf * frequencies * (BM25_K1 + 1) / (frequencies + length_norms)).astype(np.float32))
+            self.document_frequency[term] = len(counts)
+        self._vocabulary = sorted(self._postings)
+
+    def index_terms(self, query_term):
+        """Index terms a query term matches: itself, or if unknown, up to LEXICAL_PREFIX_MAX_TERMS terms it prefixes."""
+        if query_term in self._postings:
+            return [query_term]
+        if len(query_term) < LEXICAL_PREFIX_MIN_CHARS:
+            return []
+        matches = []
+        for term in self._vocabulary[bisect.bisect_left(self._vocabulary, query_term):]:
+            if not term.startswith(query_term) or len(matches) >= LEXICAL_PREFIX_MAX_TERMS:
+                break
+            matches.append(term)
+        return matches
+
+    def search(self, query: str, count: int, mask=None):
+        """Top-count (position, score) pairs for the query, best first, among the products allowed by mask."""
+        scores = np.zeros(self.size, dtype=np.float32)
+        for query_term in dict.fromkeys(lexical_terms(query)):
+            for term in self.index_terms(query_term):
+                positions, weights = self._postings[term]
+                scores[positions] += weights
+        if mask is not None:
+            scores[~mask] = 0.0
+        count = min(count, int(np.count_nonzero(scores)))
+        if count <= 0:
+            return []
+        top_positions = np.argpartition(-scores, count - 1)[:count]
+        top_positions = top_positions[np.argsort(-scores[top_positions], kind="stable")]
+        return [(int(position), float(scores[position])) for position in top_positions]
+
+    def is_precise_match(self, query: str, position: int) -> bool:
+        """True if the product's name covers every query keyword and at least one of them is rare in the catalogue."""
+        keywords = set(lexical_terms(query))
+        if not keywords:
+            return False
+        rare = False
+        for keyword in keywords:
+            matched = [term for term in self.index_terms(keyword) if term in self.name_terms[position]]
+            if not matched:
+                return False
+            rare = rare or any(self.document_frequency[term] <= max(1, LEXICAL_PRECISE_MAX_DOC_RATIO * self.size) for term in matched)
+        return rare
+
+
+# --- Structured Filters ---
+FILTER_KEYS = ("max_duration", "remote", "adaptive", "test_type")
+# Extraction only reacts to constraint phrasing: "remote teams", "adaptive leadership" or "finish in 20 minutes"
+# describe the role or the job, not the assessment, and must not become hard filters
+DURATION_LIMIT_RE = re.compile(
+    r"\b(?:under|less than|fewer than|shorter than|below|within|at most|max(?:imum)?(?: of)?|up to|"
+    r"no (?:more|longer) than|not (?:more|longer) than|time limit(?: of| is)?)\s+(\d+(?:\.\d+)?)\s*(minutes?|mins?|hours?|hrs?)\b",
+    re.IGNORECASE)
+REMOTE_FILTER_RE = re.compile(
+    r"\bremote(?:ly)?[ -](?:test(?:s|ing)?|assessments?|administ(?:ered|ration)|proctor(?:ed|ing)|deliver(?:ed|y))\b|"
+    r"\b(?:taken|completed|done|administered|delivered)\s+remotely\b",
+    re.IGNORECASE)
+ADAPTIVE_FILTER_RE = re.compile(
+    r"\birt\b|\b(?:computer[ -])?adaptive[ -](?:test(?:s|ing)?|assessments?|format)\b|\b(?:must|should|needs? to) be adaptive\b",
+    re.IGNORECASE)
+EXTRACTED_DURATION_KEY = "allow_unknown_duration" # Set with an extracted max_duration: products of unknown length still pass
+
+
+def parse_filters_option(value):
+    """Validates a request 'filters' object. Returns (normalized filters dict, None) or (None, error message)."""
+    if value is None:
+        return {}, None
+    if not isinstance(value, dict):
+        return None, "'filters' must be an object."
+    unknown = sorted(set(value) - set(FILTER_KEYS))
+    if unknown:
+        return None, f"Unknown filter(s): {', '.join(unknown)}. Supported: {', '.join(FILTER_KEYS)}."
+    filters = {}
+    max_duration = value.get("max_duration")
+    if max_duration is not None:
+        if isinstance(max_duration, bool) or not isinstance(max_duration, (int, float)) or max_duration <= 0:
+            return None, "'filters.max_duration' must be a positive number of minutes."
+        filters["max_duration"] = max_duration
+    for key in ("remote", "adaptive"):
+        if value.get(key) is not None:
+            if not isinstance(value[key], bool):
+                return None, f"'filters.{key}' must be true or false."
+            filters[key] = value[key]
+    test_type = value.get("test_type")
+    if test_type is not None:
+        test_types = [test_type] if isinstance(test_type, str) else test_type
+        if not isinstance(test_types, list) or not test_types or not all(isinstance(item, str) and item.strip() for item in test_types):
+            return None, "'filters.test_type' must be a non-empty string or list of strings."
+        filters["test_type"] = sorted({item.strip() for item in test_types})
+    return filters, None
+
+
+def extract_query_filters(original_query: str):
+    """Filters stated as constraints in the query text: a duration limit ('under 30 minutes'), remote testing
+    ('remote testing', 'taken remotely') and adaptive testing ('adaptive test', 'IRT', 'must be adaptive').
+
+    Test types are never extracted; words like 'personality' usually describe what to measure, not a hard constraint.
+    """
+    filters = {}
+    limits = [float(amount) * (60 if unit.lower().startswith("h") else 1) for amount, unit in DURATION_LIMIT_RE.findall(original_query)]
+    if limits:
+        limit = min(limits)
+        filters["max_duration"] = int(limit) if limit.is_integer() else limit
+    if REMOTE_FILTER_RE.search(original_query):
+        filters["remote"] = True
+    if ADAPTIVE_FILTER_RE.search(original_query):
+        filters["adaptive"] = True
+    return filters
+
+
+def resolve_filters(original_query: str, filters=None, extract=None):
+    """Effective filters for a request: those extracted from the query (if enabled), overridden by explicit ones.
+
+    An extracted duration limit is a guess at intent, so it keeps products whose duration is unknown.
+    """
+    if extract is None:
+        extract = FILTER_EXTRACTION
+    filters = filters or {}
+    extracted = extract_query_filters(original_query) if extract and isinstance(original_query, str) else {}
+    if "max_duration" in extracted and "max_duration" not in filters:
+        extracted[EXTRACTED_DURATION_KEY] = True
+    return dict(extracted, **filters)
+
+
+def response_variant(ranking_mode: str, filters) -> str:
+    """Response cache variant: the ranking mode plus the effective filters, so constrained answers are kept apart."""
+    if not filters:
+        return ranking_mode
+    return f"{ranking_mode}|{json.dumps(filters, sort_keys=True)}"
+
+
+class FilterColumns:
+    """Per-product filter columns of a catalogue snapshot, combined into a boolean mask before top-k search."""
+
+    def __init__(self, rows):
+        self.size = len(rows)
+        self.duration = np.array([_duration_value(row.get('duration_minutes')) for row in rows], dtype=np.float32)
+        self.remote = np.array([_to_yes_no(row.get('remote_testing')) == "Yes" for row in rows], dtype=bool)
+        self.adaptive = np.array([_to_yes_no(row.get('adaptive_irt')) == "Yes" for row in rows], dtype=bool)
+        self.test_types = {} # lowercased test type -> mask
+        for position, row in enumerate(rows):
+            for test_type in candidate_test_types(row):
+                self.test_types.setdefault(test_type.strip().lower(), np.zeros(self.size, dtype=bool))[position] = True
+
+    def mask(self, filters):
+        """Boolean mask of the products passing every filter, or None if no filter is set.
+
+        Products with an unknown duration fail a max_duration filter, unless it was extracted from the query text.
+        """
+        if not filters:
+            return None
+        mask = np.ones(self.size, dtype=bool)
+        if "max_duration" in filters:
+            with np.errstate(invalid="ignore"):
+                duration_mask = self.duration <= filters["max_duration"]
+            if filters.get(EXTRACTED_DURATION_KEY):
+                duration_mask |= np.isnan(self.duration)
+            mask &= duration_mask
+        if "remote" in filters:
+            mask &= self.remote == filters["remote"]
+        if "adaptive" in filters:
+            mask &= self.adaptive == filters["adaptive"]
+        if "test_type" in filters:
+            type_mask = np.zeros(self.size, dtype=bool)
+            for test_type in filters["test_type"]:
+                if test_type.lower() in self.test_types:
+                    type_mask |= self.test_types[test_type.lower()]
+            mask &= type_mask
+        return mask
+
+
+def _duration_value(value):
+    try:
+        return float(value) if value is not None and not isinstance(value, bool) else np.nan
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def filter_rows(rows, filters):
+    """Rows passing the filters, in order (used for RPC results, which cannot be filtered before top-k)."""
+    mask = FilterColumns(rows).mask(filters)
+    if mask is None:
+        return rows
+    return [row for row, keep in zip(rows, mask) if keep]
+
+
+# --- Catalogue Store ---
+CONTEXT_FIELDS = ("product_id", "url", "adaptive_irt", "description", "duration_minutes", "remote_testing", "product_type", "product_name")
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class ProductRecord:
+    """One catalogue product as served, shared read-only by every request for the life of its snapshot.
+
+    Holds the context fields build_llm_context would copy out of a match row, plus the public Assessment
+    (format_assessment) with its Yes/No flags and test_type list precomputed.
+    """
+    __slots__ = CONTEXT_FIELDS + ("position", "assessment")
+
+    def __init__(self, position, row):
+        self.position = position
+        self.product_id = _intern(row.get('product_id'))
+        self.product_name = _intern(row.get('product_name'))
+        self.url = _intern(row.get('url'))
+        self.description = row.get('description')
+        self.duration_minutes = row.get('duration_minutes')
+        self.adaptive_irt = row.get('adaptive_irt')
+        self.remote_testing = row.get('remote_testing')
+        self.product_type = [_intern(test_type) for test_type in candidate_test_types(row)]
+        self.assessment = {
+            "product_id": self.product_id,
+            "product_name": self.product_name,
+            "url": self.url or "",
+            "adaptive_support": _to_yes_no(self.adaptive_irt),
+            "description": self.description or "",
+            "duration": self.duration_minutes,
+            "remote_support": _to_yes_no(self.remote_testing),
+            "test_type": self.product_type
+        }
+
+
+class Candidate:
+    """A product retrieved for one request: its shared ProductRecord plus this request's scores.
+
+    Reads like the match and context dicts of the RPC path (get('product_name'), get('similarity_score'), ...)
+    without copying the product's fields.
+    """
+    __slots__ = ("record", "similarity", "lexical_score")
+
+    def __init__(self, record, similarity=None, lexical_score=None):
+        self.record = record
+        self.similarity = similarity
+        self.lexical_score = lexical_score
+
+    def get(self, key, default=None):
+        if key in ("similarity", "similarity_score"):
+            return self.similarity
+        if key == "lexical_score":
+            return self.lexical_score
+        if key in CONTEXT_FIELDS:
+            return getattr(self.record, key)
+        return default
+
+    def as_context(self):
+        """The plain dict build_llm_context makes from an RPC match, for prompts that embed candidates as JSON."""
+        return dict({field: getattr(self.record, field) for field in CONTEXT_FIELDS}, similarity_score=self.similarity)
+
+
+class CatalogueStore:
+    """ProductRecords of a catalogue snapshot, addressed by the row position used by the embedding matrix and indexes."""
+
+    def __init__(self, rows):
+        self.records = [ProductRecord(position, row) for position, row in enumerate(rows)]
+        self.positions = {record.product_id: record.position for record in self.records}
+
+    def __len__(self):
+        return len(self.records)
+
+    def candidates(self, positions, scores=None):
+        """Candidates for row positions, with their similarity scores if given."""
+        records = self.records
+        if scores is None:
+            return [Candidate(records[position]) for position in positions]
+        return [Candidate(records[position], float(score)) for position, score in zip(positions, scores)]
+
+
+# --- Local Vector Index ---
+class LocalVectorIndex:
+    """In-memory snapshot of the product catalogue for local cosine top-k search."""
+
+    def __init__(self):
+        # (matrix, rows, lexical index, filter columns, catalogue store) is swapped as a single tuple so readers
+        # never see a half-built snapshot
+        self._snapshot = (None, [], None, None, None)
+        self._lock = threading.Lock()
+        self.loaded_at = None
+
+    @property
+    def ready(self):
+        return self._snapshot[0] is not None
+
+    def __len__(self):
+        return len(self._snapshot[1])
+
+    def load(self, rows):
+        """Builds a normalised embedding matrix from catalogue rows and swaps it in."""
+        vectors = []
+        kept_rows = []
+        for row in rows:
+            embedding = _parse_embedding(row.get(DB_EMBEDDING_COLUMN))
+            if embedding is None or len(embedding) != EXPECTED_EMBEDDING_DIMENSION:
+                logging.warning(f"Skipping product without a valid embedding: {row.get('product_id')}")
+                continue
+            vectors.append(embedding)
+            # Keep the row as the RPC would return it, minus the raw vector
+            kept_rows.append({key: value for key, value in row.items() if key != DB_EMBEDDING_COLUMN})
+
+        if not vectors:
+            raise ValueError("Catalogue snapshot contains no usable embeddings.")
+        return self.load_matrix(np.asarray(vectors, dtype=np.float32), kept_rows)
+
+    def load_matrix(self, matrix, rows):
+        """Swaps in an (n, dim) embedding matrix with its n rows; normalises the matrix in place."""
+        if matrix.ndim != 2 or matrix.shape[0] != len(rows) or matrix.shape[1] != EXPECTED_EMBEDDING_DIMENSION:
+            raise ValueError(f"Embedding matrix shape {matrix.shape} does not match {len(rows)} rows of dimension {EXPECTED_EMBEDDING_DIMENSION}.")
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        matrix /= norms
+        lexical = LexicalIndex(rows) if LEXICAL_SEARCH_ENABLED else None
+        columns = FilterColumns(rows)
+        store = CatalogueStore(rows)
+
+        with self._lock:
+            self._snapshot = (matrix, rows, lexical, columns, store)
+            self.loaded_at = time.time()
+        return len(rows)
+
+    def save(self, path):
+        """Writes the current snapshot as a warm-start artifact."""
+        matrix, rows, _, _, _ = self._snapshot
+        if matrix is None:
+            raise RuntimeError("Local vector index is not loaded.")
+        np.savez(path, embeddings=matrix, rows=np.array(json.dumps(rows, ensure_ascii=False)),
+                 model_name=np.array(EMBEDDING_MODEL_NAME), built_at=np.array(time.time()))
+
+    def search(self, query_embedding, match_threshold, match_count, filters=None):
+        """Returns up to match_count Candidates passing filters with cosine similarity above match_threshold, best first."""
+        return self.search_batch([query_embedding], match_threshold, match_count, [filters])[0]
+
+    def search_batch(self, query_embeddings, match_threshold, match_count, filters_list=None):
+        """Vectorised search for several queries at once: one matrix product, then a top-k cut per query.
+
+        filters_list holds each query's filters (or None); excluded products are masked out before the cut.
+        Matches are Candidates over the snapshot's shared CatalogueStore, so no product fields are copied.
+        """
+        matrix, rows, _, columns, store = self._snapshot
+        if matrix is None:
+            raise RuntimeError("Local vector index is not loaded.")
+
+        queries = np.asarray(query_embeddings, dtype=np.float32).reshape(-1, matrix.shape[1])
+        query_norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        zero_queries = (query_norms == 0).ravel()
+        query_norms[query_norms == 0] = 1.0
+        similarities = (queries / query_norms) @ matrix.T # (queries, products)
+
+        results = []
+        for query_idx, scores in enumerate(similarities):
+            count = min(match_count, len(rows))
+            mask = columns.mask(filters_list[query_idx]) if filters_list else None
+            if mask is not None:
+                scores = np.where(mask, scores, -np.inf)
+                count = min(count, int(mask.sum()))
+            if count <= 0 or zero_queries[query_idx]:
+                results.append([])
+                continue
+            # argpartition keeps this O(n) for the candidate cut, then sort only the top slice
+            top_indices = np.argpartition(-scores, count - 1)[:count]
+            top_indices = top_indices[np.argsort(-scores[top_indices])]
+            top_indices = top_indices[scores[top_indices] > match_threshold]
+            results.append(store.candidates(top_indices.tolist(), scores[top_indices].tolist()))
+        return results
+
+    def lexical_search(self, query: str, match_count: int, query_embedding=None, filters=None):
+        """BM25 matches for the query text passing filters, best first, and whether the top one is a precise product-name match.
+
+        Lexical matches skip the cosine threshold; with query_embedding their 'similarity' is filled from the snapshot.
+        """
+        matrix, rows, lexical, columns, store = self._snapshot
+        if lexical is None:
+            return [], False
+        hits = lexical.search(query, match_count, columns.mask(filters))
+        matches = [Candidate(store.records[position], lexical_score=round(score, 4)) for position, score in hits]
+        if query_embedding is not None:
+            self.fill_similarity(matches, query_embedding)
+        return matches, bool(hits) and lexical.is_precise_match(query, hits[0][0])
+
+    def fill_similarity(self, matches, query_embedding):
+        """Sets each lexical Candidate's cosine similarity to the query from the stored embeddings."""
+        matrix, _, _, _, store = self._snapshot
+        if matrix is None or not matches:
+            return
+        query = np.asarray(query_embedding, dtype=np.float32).ravel()
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        for match in matches:
+            # Looked up by product_id: a refresh may have swapped in a new snapshot since the lexical search
+            position = store.positions.get(match.get('product_id'))
+            if position is not None:
+                match.similarity = float(matrix[position] @ query)
+
+
+def _parse_embedding(value):
+    """Accepts a pgvector value as returned by PostgREST (list or '[...]' string)."""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except json.JSONDecodeError:
+            return None
+    if not isinstance(value, (list, tuple)):
+        return None
+    return value
+
+
+def load_catalogue_snapshot(path):
+    """Loads a warm-start catalogue artifact into the local vector index."""
+    global vector_index
+    with np.load(path, allow_pickle=False) as snapshot:
+        if str(snapshot["model_name"]) != EMBEDDING_MODEL_NAME:
+            raise ValueError(f"Snapshot was built with '{snapshot['model_name']}', expected '{EMBEDDING_MODEL_NAME}'.")
+        matrix = snapshot["embeddings"].astype(np.float32)
+        rows = json.loads(str(snapshot["rows"]))
+        built_at = float(snapshot["built_at"])
+    index = vector_index or LocalVectorIndex()
+    loaded = index.load_matrix(matrix, rows)
+    vector_index = index
+    logging.info(f"Loaded warm-start catalogue snapshot with {loaded} products (built {(time.time() - built_at) / 3600:.1f} hours ago).")
+    return loaded
+
+
+def build_warm_start_artifact(output_dir=WARM_START_DIR):
+    """Builds the warm-start artifact: embedding model weights plus the catalogue embedding snapshot."""
+    os.makedirs(output_dir, exist_ok=True)
+    _init_supabase()
+    _init_embedding_model()
+    index = LocalVectorIndex()
+    loaded = index.load(fetch_catalogue_rows())
+    index.save(os.path.join(output_dir, WARM_START_CATALOGUE_FILE))
+    if hasattr(embed_model, "save"): # ONNX backends already load from their own artifact directory
+        embed_model.save(os.path.join(output_dir, WARM_START_MODEL_SUBDIR))
+    logging.info(f"Warm-start artifact with {loaded} products written to '{output_dir}'.")
+    return loaded
+
+
+def fetch_catalogue_rows():
+    """Pages through the products table and returns every row including its embedding."""
+    rows = []
+    start = 0
+    while True:
+        response = supabase_client.table(DB_PRODUCTS_TABLE).select("*").range(start, start + DB_PAGE_SIZE - 1).execute()
+        page = response.data or []
+        rows.extend(page)
+        if len(page) < DB_PAGE_SIZE:
+            break
+        start += DB_PAGE_SIZE
+    return rows
+
+
+def refresh_vector_index():
+    """Reloads the catalogue snapshot into the local index. Returns True on success."""
+    global vector_index
+    if not supabase_client:
+        logging.warning("Cannot refresh local vector index: Supabase client not initialized.")
+        return False
+    try:
+        started = time.time()
+        rows = fetch_catalogue_rows()
+        index = vector_index or LocalVectorIndex()
+        loaded = index.load(rows)
+        vector_index = index
+        logging.info(f"Local vector index loaded with {loaded} products in {time.time() - started:.2f} seconds.")
+        return True
+    except Exception as e:
+        # Keep serving the previous snapshot (or the RPC fallback) if the refresh fails
+        logging.error(f"Failed to refresh local vector index: {e}", exc_info=True)
+        return False
+
+
+def _index_refresh_loop(refresh_now):
+    if refresh_now:
+        refresh_vector_index()
+    while True:
+        time.sleep(INDEX_REFRESH_INTERVAL)
+        refresh_vector_index()
+
+
+def start_index_refresh(refresh_now=False):
+    global index_refresh_thread
+    if INDEX_REFRESH_INTERVAL <= 0:
+        if refresh_now:
+            threading.Thread(target=refresh_vector_index, daemon=True).start()
+        return
+    if index_refresh_thread is None or not index_refresh_thread.is_alive():
+        index_refresh_thread = threading.Thread(target=_index_refresh_loop, args=(refresh_now,))
+        index_refresh_thread.daemon = True
+        index_refresh_thread.start()
+
+
+# --- Catalogue Ingestion ---
+def iter_product_records(path):
+    """Streams product dicts from a JSON Lines file, or from a JSON array / {"products": [...]} file."""
+    with open(path, encoding="utf-8") as f:
+        if path.endswith((".jsonl", ".ndjson")):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+        data = json.load(f)
+    yield from (data.get("products", []) if isinstance(data, dict) else data)
+
+
+def _sha256(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def product_hashes(product):
+    """Returns (embedding_hash, content_hash) for a product record."""
+    # The model name is part of the embedding hash so switching models re-embeds everything
+    embedding_hash = _sha256(f"{EMBEDDING_MODEL_NAME}\n{get_embedding_text(product)}")
+    content = {key: value for key, value in product.items() if key not in (DB_EMBEDDING_COLUMN, DB_EMBEDDING_HASH_COLUMN, DB_CONTENT_HASH_COLUMN)}
+    content_hash = _sha256(json.dumps(content, sort_keys=True, ensure_ascii=False, default=str))
+    return embedding_hash, content_hash
+
+
+def fetch_stored_hashes():
+    """Returns {product_id: (embedding_hash, content_hash)} for every stored product."""
+    hashes = {}
+    start = 0
+    columns = f"product_id, {DB_EMBEDDING_HASH_COLUMN}, {DB_CONTENT_HASH_COLUMN}"
+    while True:
+        response = supabase_client.table(DB_PRODUCTS_TABLE).select(columns).range(start, start + DB_PAGE_SIZE - 1).execute()
+        page = response.data or []
+        for row in page:
+            hashes[row.get('product_id')] = (row.get(DB_EMBEDDING_HASH_COLUMN), row.get(DB_CONTENT_HASH_COLUMN))
+        if len(page) < DB_PAGE_SIZE:
+            break
+        start += DB_PAGE_SIZE
+    return hashes
+
+
+def ingest_products(records, encode_batch_size=INGEST_ENCODE_BATCH_SIZE, upsert_chunk_size=INGEST_UPSERT_CHUNK_SIZE, dry_run=False):
+    """Upserts changed products: re-embeds only rows whose embedding text changed, in large encode batches and chunked bulk writes.
+
+    Rows whose embedding text is unchanged but whose other fields changed are written without a new embedding.
+    Returns a stats dict.
+    """
+    if not supabase_client or not embed_model:
+        raise RuntimeError("Ingestion needs the Supabase client and the embedding model.")
+    started = time.time()
+    stats = {"seen": 0, "invalid": 0, "unchanged": 0, "metadata_only": 0, "embedded": 0, "upserted": 0, "chunks": 0, "dry_run": dry_run}
+    stored_hashes = fetch_stored_hashes()
+    to_embed = []     # (record, embedding text, embedding hash, content hash)
+    embedded_rows = []
+    metadata_rows = []
+
+    def write(rows, flush=False):
+        # Rows in one bulk upsert must share the same columns, so embedded and metadata-only rows go in separate chunks
+        while len(rows) >= upsert_chunk_size or (rows and flush):
+            chunk = rows[:upsert_chunk_size]
+            del rows[:upsert_chunk_size]
+            if not dry_run:
+                supabase_client.table(DB_PRODUCTS_TABLE).upsert(chunk, on_conflict="product_id").execute()
+            stats["upserted"] += len(chunk)
+            stats["chunks"] += 1
+
+    def encode_pending():
+        if not to_embed:
+            return
+        vectors = embed_model.encode([text for _, text, _, _ in to_embed], batch_size=BATCH_ENCODE_SIZE)
+        for (record, _, embedding_hash, content_hash), vector in zip(to_embed, vectors):
+            embedded_rows.append(dict(record, **{DB_EMBEDDING_COLUMN: np.asarray(vector).tolist(),
+                                                 DB_EMBEDDING_HASH_COLUMN: embedding_hash, DB_CONTENT_HASH_COLUMN: content_hash}))
+        stats["embedded"] += len(to_embed)
+        to_embed.clear()
+
+    for record in records:
+        stats["seen"] += 1
+        if not isinstance(record, dict) or not record.get('product_id'):
+            stats["invalid"] += 1
+            continue
+        embedding_hash, content_hash = product_hashes(record)
+        stored_embedding_hash, stored_content_hash = stored_hashes.get(record['product_id'], (None, None))
+        if stored_content_hash == content_hash and stored_embedding_hash == embedding_hash:
+            stats["unchanged"] += 1
+        elif stored_embedding_hash == embedding_hash:
+            metadata_rows.append(dict(record, **{DB_CONTENT_HASH_COLUMN: content_hash}))
+            stats["metadata_only"] += 1
+        else:
+            to_embed.append((record, get_embedding_text(record), embedding_hash, content_hash))
+            if len(to_embed) >= encode_batch_size:
+                encode_pending()
+        write(embedded_rows)
+        write(metadata_rows)
+
+    encode_pending()
+    write(embedded_rows, flush=True)
+    write(metadata_rows, flush=True)
+
+    stats["duration_seconds"] = round(time.time() - started, 2)
+    logging.info(f"Ingestion finished: {stats}")
+    if stats["upserted"] and not dry_run:
+        # Serve the new catalogue immediately rather than at the next scheduled refresh
+        if RETRIEVAL_MODE == "local":
+            refresh_vector_index()
+        if response_cache is not None:
+            response_cache.clear()
+    return stats
+
+
+def _run_ingestion_job(records, dry_run):
+    global ingestion_status
+    try:
+        stats = ingest_products(records, dry_run=dry_run)
+        ingestion_status = {"state": "finished", "finished_at": time.time(), "stats": stats}
+    except Exception as e:
+        logging.error(f"Ingestion job failed: {e}", exc_info=True)
+        ingestion_status = {"state": "failed", "finished_at": time.time(), "error": str(e)}
+    finally:
+        ingestion_lock.release()
+
+
+def start_ingestion_job(records, dry_run=False):
+    """Runs ingest_products in a background thread. Returns False if a job is already running."""
+    global ingestion_status
+    if not ingestion_lock.acquire(blocking=False):
+        return False
+    ingestion_status = {"state": "running", "started_at": time.time(), "records": len(records)}
+    threading.Thread(target=_run_ingestion_job, args=(records, dry_run), daemon=True).start()
+    return True
+
+
+# --- Dependency Circuit Breakers and Hedging ---
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling a dependency whose circuit breaker is open."""
+
+
+class CallTimer:
+    """Sums the time spent inside measure() blocks, for calls that interleave dependency work with other waits."""
+
+    def __init__(self):
+        self.elapsed = None
+
+    @contextmanager
+    def measure(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.elapsed = (self.elapsed or 0.0) + time.perf_counter() - started
+
+
+class CircuitBreaker:
+    """Tracks recent calls to one dependency and fails fast while it is unhealthy.
+
+    A call fails if it raises or takes longer than slow_call_seconds. Once CIRCUIT_FAILURE_RATE of the last
+    CIRCUIT_WINDOW_SIZE calls (and at least CIRCUIT_MIN_CALLS) failed, the breaker opens and rejects calls
+    with CircuitOpenError for CIRCUIT_OPEN_SECONDS. It then half-opens: a single probe call goes through and
+    closes the breaker on success or reopens it on failure. Successful call latencies also set the hedge delay.
+    """
+
+    def __init__(self, name, slow_call_seconds, enabled=True):
+        self.name = name
+        self.slow_call_seconds = slow_call_seconds
+        self.enabled = enabled
+        self.state = "closed"
+        self.opened_at = None
+        self._outcomes = deque(maxlen=CIRCUIT_WINDOW_SIZE) # True for each failed or slow call
+        self._latencies = deque(maxlen=HEDGE_LATENCY_WINDOW)
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+        self.times_opened = 0
+        self.rejected = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def available(self):
+        """True if a call would be let through now. Unlike guard(), does not claim the half-open probe."""
+        with self._lock:
+            return self._available()
+
+    @contextmanager
+    def guard(self):
+        """Wraps one call: raises CircuitOpenError instead of running it while open, then records its outcome.
+
+        Yields a CallTimer. If the block times any part of its work with it (e.g. only the chunk reads of a
+        stream that is relayed to a client), that time is recorded instead of the whole block's.
+        """
+        probe = self._acquire()
+        timer = CallTimer()
+        started = time.perf_counter()
+
+        def duration():
+            return timer.elapsed if timer.elapsed is not None else time.perf_counter() - started
+
+        try:
+            yield timer
+        except Exception:
+            self._record(False, duration(), probe)
+            raise
+        except BaseException:
+            # Cancelled or abandoned (e.g. the client went away): says nothing about the dependency
+            self._record(None, duration(), probe)
+            raise
+        self._record(True, duration(), probe)
+
+    def hedge_delay(self):
+        """HEDGE_QUANTILE of recent successful call latencies in seconds, or None until there are HEDGE_MIN_SAMPLES."""
+        with self._lock:
+            return self._hedge_delay()
+
+    def record_hedge(self, won=False):
+        with self._lock:
+            if won:
+                self.hedge_wins += 1
+            else:
+                self.hedged += 1
+        metrics.inc("shl_hedge_wins_total" if won else "shl_hedged_requests_total", dependency=self.name)
+
+    def stats(self):
+        with self._lock:
+            hedge_delay = self._hedge_delay()
+            return {
+                "enabled": self.enabled,
+                "state": self.state,
+                "failure_rate": round(sum(self._outcomes) / len(self._outcomes), 4) if self._outcomes else 0.0,
+                "window_calls": len(self._outcomes),
+                "slow_call_seconds": self.slow_call_seconds,
+                "retry_in_seconds": round(max(0.0, self.opened_at + CIRCUIT_OPEN_SECONDS - time.time()), 1) if self.state == "open" else None,
+                "times_opened": self.times_opened,
+                "rejected": self.rejected,
+                "hedging": self.name in HEDGED_DEPENDENCIES,
+                "hedge_delay_ms": round(hedge_delay * 1000, 1) if hedge_delay is not None else None,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins
+            }
+
+    def _available(self):
+        # Caller holds the lock
+        if not self.enabled or self.state == "closed":
+            return True
+        if self.state == "open":
+            return time.time() - self.opened_at >= CIRCUIT_OPEN_SECONDS
+        return not self._probe_in_flight
+
+    def _hedge_delay(self):
+        # Caller holds the lock
+        if len(self._latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        latencies = sorted(self._latencies)
+        return max(HEDGE_MIN_DELAY_SECONDS, latencies[min(len(latencies) - 1, int(HEDGE_QUANTILE * len(latencies)))])
+
+    def _acquire(self):
+        """Returns True if this call is the half-open probe. Raises CircuitOpenError if the call is not allowed."""
+        with self._lock:
+            if not self._available():
+                self.rejected += 1
+                metrics.inc("shl_circuit_rejected_total", dependency=self.name)
+                raise CircuitOpenError(f"The {self.name} circuit breaker is open; failing fast.")
+            if not self.enabled or self.state == "closed":
+                return False
+            self.state = "half_open"
+            self._probe_in_flight = True
+            return True
+
+    def _record(self, ok, duration, probe):
+        with self._lock:
+            if ok:
+                self._latencies.append(duration)
+            if not self.enabled:
+                return
+            if probe:
+                self._probe_in_flight = False
+            if ok is None:
+                return
+            failed = not ok or duration > self.slow_call_seconds
+            if probe:
+                if failed:
+                    self._open()
+                else:
+                    logging.info(f"The {self.name} circuit breaker closed after a successful probe call.")
+                    self.state = "closed"
+                return
+            if self.state != "closed":
+                return # A call that started before the breaker opened
+            self._outcomes.append(failed)
+            if len(self._outcomes) >= CIRCUIT_MIN_CALLS and sum(self._outcomes) >= CIRCUIT_FAILURE_RATE * len(self._outcomes):
+                self._open()
+
+    def _open(self):
+        # Caller holds the lock
+        self.state = "open"
+        self.opened_at = time.time()
+        self._outcomes.clear()
+        self.times_opened += 1
+        metrics.inc("shl_circuit_opened_total", dependency=self.name)
+        logging.warning(f"The {self.name} circuit breaker opened; failing fast for {CIRCUIT_OPEN_SECONDS}s.")
+
+
+supabase_breaker = CircuitBreaker("supabase", SUPABASE_SLOW_CALL_SECONDS, CIRCUIT_BREAKER_ENABLED)
+gemini_breaker = CircuitBreaker("gemini", GEMINI_SLOW_CALL_SECONDS, CIRCUIT_BREAKER_ENABLED)
+
+
+def get_hedge_executor():
+    global hedge_executor
+    if hedge_executor is None:
+        hedge_executor = ThreadPoolExecutor(max_workers=PIPELINE_MAX_WORKERS, thread_name_prefix="hedge")
+    return hedge_executor
+
+
+def call_dependency(breaker, call):
+    """Runs call() (no arguments) through the dependency's circuit breaker.
+
+    For dependencies in HEDGED_DEPENDENCIES, a second identical call starts once the first has run longer than
+    breaker.hedge_delay(); the first successful result wins and the slower call finishes in the background.
+    """
+    def guarded_call():
+        with breaker.guard():
+            return call()
+
+    delay = breaker.hedge_delay() if breaker.name in HEDGED_DEPENDENCIES else None
+    if delay is None:
+        return guarded_call()
+    executor = get_hedge_executor()
+    first = submit_traced(executor, guarded_call)
+    try:
+        return first.result(timeout=delay)
+    except FutureTimeoutError:
+        pass
+    breaker.record_hedge()
+    hedge = submit_traced(executor, guarded_call)
+    pending = {first, hedge}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is hedge:
+                    breaker.record_hedge(won=True)
+                return future.result()
+            error = error or future.exception()
+    raise error
+
+
+# --- Retrieval Functions ---
+def search_products_rpc(query_embedding, match_count=DB_RETRIEVAL_COUNT):
+    """Runs the match_products RPC with retries. Raises the last error if every attempt fails."""
+    query_embedding = query_embedding.tolist() if hasattr(query_embedding, 'tolist') else list(query_embedding)
+    last_db_error = None
+    for attempt in range(MAX_QUERY_RETRIES):
+        try:
+            # Ensure supabase_client is valid before calling rpc
+            if not supabase_client:
+                 raise ConnectionError("Supabase client is not initialized.")
+
+            with trace_span("rpc"):
+                response = call_dependency(supabase_breaker, lambda: supabase_client.rpc(
+                    DB_FUNCTION_NAME,
+                    {
+                        'query_embedding': query_embedding,
+                        'match_threshold': DB_MATCH_THRESHOLD,
+                        'match_count': match_count
+                    }
+                ).execute())
+
+            # Check response structure (depends on Supabase client version)
+            if hasattr(response, 'data') and response.data is not None:
+                matches = response.data
+            elif isinstance(response, list): # Handle cases where it might return a list directly
+                 matches = response
+            else:
+                 # Log unexpected response structure
+                 logging.warning(f"Supabase RPC returned unexpected response structure: {type(response)}, Content: {response}")
+                 matches = [] # Assume no matches if structure is wrong
+
+            logging.info(f"Initial retrieval found {len(matches)} candidates (Attempt {attempt + 1}).")
+            return matches
+        except CircuitOpenError as e:
+            logging.warning(f"Supabase RPC skipped: {e}")
+            raise
+        except Exception as e:
+            last_db_error = e
+            logging.error(f"Supabase RPC error (Attempt {attempt + 1}/{MAX_QUERY_RETRIES}): {e}", exc_info=True)
+            if attempt < MAX_QUERY_RETRIES - 1:
+                if not supabase_breaker.available():
+                    logging.warning("Supabase circuit breaker opened; not retrying.")
+                    break
+                metrics.inc("shl_rpc_retries_total")
+                logging.info(f"Retrying Supabase query in {RETRY_QUERY_DELAY} seconds...")
+                with trace_span("retry_sleep"):
+                    time.sleep(RETRY_QUERY_DELAY)
+    logging.error("Supabase search failed after all retries.")
+    raise last_db_error
+
+
+def search_products(query_embedding, filters=None, match_count=DB_RETRIEVAL_COUNT):
+    """Top-k retrieval: local index when loaded (filters masked before top-k), otherwise the Supabase RPC (over-fetched, then filtered)."""
+    if RETRIEVAL_MODE == "local" and vector_index is not None and vector_index.ready:
+        try:
+            with trace_span("local_search"):
+                matches = vector_index.search(query_embedding, DB_MATCH_THRESHOLD, match_count, filters)
+            logging.info(f"Local index retrieval found {len(matches)} candidates.")
+            return matches
+        except Exception as e:
+            logging.error(f"Local index search failed, falling back to RPC: {e}", exc_info=True)
+    if not filters:
+        return search_products_rpc(query_embedding, match_count)
+    return filter_rows(search_products_rpc(query_embedding, match_count * FILTER_RPC_OVERFETCH), filters)[:match_count]
+
+
+# --- Response Cache ---
+def normalize_query(query: str) -> str:
+    """Lowercases, collapses whitespace and trims surrounding punctuation so trivial variants share a key."""
+    return re.sub(r'\s+', ' ', query.lower()).strip(' \t\n.,;:!?"\'')
+
+
+class CachedResponse(dict):
+    """A response cache hit: the stored result plus {"response_cache": kind} metadata.
+
+    Nested values are shared with the cache entry, so treat a hit as read-only; build a new dict (dict(hit, ...))
+    to change it, which also drops encodings. encodings memoizes the serialized and compressed bodies of this
+    kind of hit on the entry (see serialize_response), so repeat hits skip JSON encoding and compression.
+    """
+
+    def __init__(self, result, kind, encodings):
+        super().__init__(result)
+        self["metadata"] = {"response_cache": kind}
+        self.encodings = encodings
+
+
+class ResponseCache:
+    """Bounded TTL/LRU cache of recommendation results with exact and embedding-similarity lookup."""
+
+    def __init__(self, max_entries, ttl_seconds, similarity_threshold):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self._entries = OrderedDict() # cache key -> (expires_at, unit embedding or None, result, variant, encodings by hit kind)
+        self._matrix = None           # Stacked embeddings for the semantic lookup, rebuilt lazily
+        self._matrix_keys = []
+        self._lock = threading.Lock()
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_exact(self, key):
+        """Returns the cached result (a CachedResponse) for a normalized query, or None. Misses are counted by get_similar."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            self.exact_hits += 1
+            return self._hit(entry, "exact")
+
+    def get_similar(self, query_embedding, variant=None):
+        """Returns the result of the nearest live entry of the same variant above the similarity threshold, or None."""
+        now = time.time()
+        with self._lock:
+            match_key = self._nearest(query_embedding, now, variant) if query_embedding is not None and self._entries else None
+            if match_key is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(match_key)
+            self.semantic_hits += 1
+            return self._hit(self._entries[match_key], "semantic")
+
+    def put(self, key, result, query_embedding=None, variant=None):
+        unit_embedding = None
+        if query_embedding is not None:
+            unit_embedding = np.asarray(query_embedding, dtype=np.float32).ravel()
+            norm = np.linalg.norm(unit_embedding)
+            unit_embedding = unit_embedding / norm if norm else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.time() + self.ttl_seconds, unit_embedding, copy.deepcopy(result), variant, {"exact": {}, "semantic": {}})
+            self._matrix = None
+            while len(self._entries) > self.max_entries:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+
+    def stats(self):
+        with self._lock:
+            lookups = self.exact_hits + self.semantic_hits + self.misses
+            return {
+                "enabled": True,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "similarity_threshold": self.similarity_threshold,
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round((self.exact_hits + self.semantic_hits) / lookups, 4) if lookups else 0.0
+            }
+
+    def _remove(self, key):
+        del self._entries[key]
+        self._matrix = None
+
+    @staticmethod
+    def _hit(entry, kind):
+        return CachedResponse(entry[2], kind, entry[4][kind])
+
+    def _nearest(self, query_embedding, now, variant):
+        # Caller holds the lock
+        if self._matrix is None:
+            self._matrix_keys = [key for key, entry in self._entries.items() if entry[1] is not None]
+            if not self._matrix_keys:
+                return None
+            self._matrix = np.stack([self._entries[key][1] for key in self._matrix_keys])
+        query = np.asarray(query_embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(query)
+        if not norm:
+            return None
+        similarities = self._matrix @ (query / norm)
+        for idx in np.argsort(-similarities):
+            if similarities[idx] < self.similarity_threshold:
+                break
+            key = self._matrix_keys[idx]
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now and entry[3] == variant:
+                return key
+        return None
+
+
+def response_cache_key(original_query: str, variant: str) -> str:
+    """Cache key for a query under a response variant (see response_variant), so 'llm' requests never get a 'fast' answer."""
+    return f"{variant}:{normalize_query(original_query)}"
+
+
+def get_response_cache():
+    global response_cache
+    if response_cache is None and RESPONSE_CACHE_ENABLED:
+        response_cache = ResponseCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL_SECONDS, RESPONSE_CACHE_SIMILARITY_THRESHOLD)
+    return response_cache
+
+
+def search_products_batch(query_embeddings, filters_list=None, match_count=DB_RETRIEVAL_COUNT):
+    """Batched top-k retrieval with optional per-query filters. Returns one list per query, or an Exception in its place if that query failed."""
+    if RETRIEVAL_MODE == "local" and vector_index is not None and vector_index.ready:
+        try:
+            with trace_span("local_search"):
+                results = vector_index.search_batch(query_embeddings, DB_MATCH_THRESHOLD, match_count, filters_list)
+            logging.info(f"Local index batch retrieval for {len(results)} queries.")
+            return results
+        except Exception as e:
+            logging.error(f"Local index batch search failed, falling back to RPC: {e}", exc_info=True)
+    results = []
+    for query_idx, query_embedding in enumerate(query_embeddings):
+        filters = filters_list[query_idx] if filters_list else None
+        try:
+            if filters:
+                results.append(filter_rows(search_products_rpc(query_embedding, match_count * FILTER_RPC_OVERFETCH), filters)[:match_count])
+            else:
+                results.append(search_products_rpc(query_embedding, match_count))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+# --- Query Expansion Function ---
+QUERY_STOPWORDS = frozenset((
+    "a", "an", "the", "and", "or", "for", "of", "to", "in", "on", "with", "at", "by", "from", "is", "are", "be",
+    "i", "we", "my", "our", "me", "you", "need", "want", "looking", "some", "any", "that", "this", "who", "which",
+    "what", "can", "should", "would", "like", "please", "find", "give", "recommend", "test", "tests", "assessment", "assessments"
+))
+
+
+class LRUCache:
+    """Small thread-safe LRU cache with per-entry TTL."""
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict() # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "max_entries": self.max_entries, "hits": self.hits, "misses": self.misses}
+
+
+def get_expansion_cache():
+    global expansion_cache
+    if expansion_cache is None:
+        expansion_cache = LRUCache(EXPANSION_CACHE_MAX_ENTRIES, EXPANSION_CACHE_TTL_SECONDS)
+    return expansion_cache
+
+
+def parse_expand_option(value):
+    """Maps a request/env 'expand' value to 'always', 'auto' or 'never'. Returns None if invalid."""
+    if value is None:
+        value = QUERY_EXPANSION_MODE
+    if isinstance(value, bool):
+        return "always" if value else "never"
+    if isinstance(value, str):
+        value = value.strip().lower()
+        if value in ("always", "true", "yes", "1"):
+            return "always"
+        if value in ("never", "false", "no", "0"):
+            return "never"
+        if value == "auto":
+            return "auto"
+    return None
+
+
+def parse_mode_option(value):
+    """Maps a request/env ranking 'mode' value to 'llm' or 'fast'. Returns None if invalid."""
+    if value is None:
+        value = RANKING_MODE
+    if isinstance(value, str) and value.strip().lower() in ("llm", "fast"):
+        return value.strip().lower()
+    return None
+
+
+def tokenize(text: str):
+    """Lowercase word tokens, keeping skill names like 'c++', 'c#' and 'node.js' intact."""
+    return re.findall(r"[\w+#]+(?:\.[\w+#]+)*", text.lower())
+
+
+def should_expand_query(original_query: str) -> bool:
+    """Heuristic for 'auto' mode: short, vague queries benefit from expansion; long or keyword-rich ones do not."""
+    words = tokenize(original_query)
+    if len(words) >= EXPANSION_SKIP_MIN_WORDS:
+        return False
+    keywords = {word for word in words if word not in QUERY_STOPWORDS and len(word) > 1}
+    if len(keywords) >= EXPANSION_SKIP_MIN_KEYWORDS and len(keywords) / max(len(words), 1) >= EXPANSION_SKIP_KEYWORD_RATIO:
+        return False
+    return True
+
+
+def expand_query(original_query: str, mode: str, lexical_match=False):
+    """Expands the query through the expansion cache according to mode. Returns (query_for_search, metadata dict)."""
+    started = time.time()
+    expanded_query, info = begin_query_expansion(original_query, mode, lexical_match)
+    if expanded_query is None:
+        expanded_query = expand_query_with_llm(original_query)
+    return finish_query_expansion(original_query, expanded_query, info, started)
+
+
+def begin_query_expansion(original_query: str, mode: str, lexical_match=False):
+    """Handles skips and expansion cache hits. Returns (query_for_search or None if the LLM must be asked, metadata dict).
+
+    lexical_match marks a query that precisely names a product (see lexical_candidates); it is never expanded.
+    """
+    info = {"mode": mode, "expanded": False, "cached": False, "skipped": False}
+    if gen_model is None and mode != "never":
+        info["skipped"] = True
+        info["reason"] = "gemini_unavailable"
+        return original_query, info
+    if mode == "never" or (mode == "auto" and not should_expand_query(original_query)):
+        info["skipped"] = True
+        logging.info(f"Skipping query expansion (mode '{mode}').")
+        return original_query, info
+    if lexical_match:
+        info["skipped"] = True
+        info["reason"] = "lexical_match"
+        logging.info("Skipping query expansion: the query precisely names a product.")
+        return original_query, info
+
+    expanded_terms = get_expansion_cache().get(normalize_query(original_query))
+    if expanded_terms is None:
+        if not gemini_breaker.available():
+            info["skipped"] = True
+            info["reason"] = "gemini_circuit_open"
+            return original_query, info
+        return None, info
+    info["cached"] = True
+    expanded_query = f"{original_query} | Relevant concepts: {expanded_terms}"
+    logging.info(f"Query expansion cache hit: '{expanded_query}'")
+    return expanded_query, info
+
+
+def finish_query_expansion(original_query: str, expanded_query: str, info, started):
+    """Caches a freshly generated expansion and completes the metadata. Returns (query_for_search, metadata dict)."""
+    if expanded_query != original_query and not info["cached"] and not info["skipped"]:
+        # Store only the generated terms so the cached entry pairs with this request's original wording
+        get_expansion_cache().put(normalize_query(original_query), expanded_query.split(" | Relevant concepts: ", 1)[1])
+    info["expanded"] = expanded_query != original_query
+    info["duration_ms"] = 0.0 if info["skipped"] else round((time.time() - started) * 1000, 1)
+    return expanded_query, info
+
+
+def expand_query_with_llm(original_query: str) -> str:
+    """Uses Gemini to expand the user query with related terms for better retrieval."""
+    if not gen_model or not initialization_complete: # Also check initialization_complete
+        logging.error("Gemini client not available for query expansion.")
+        return original_query
+
+    prompt = build_expansion_prompt(original_query)
+    try:
+        logging.info(f"Expanding query: '{original_query}'")
+        with trace_span("expansion"):
+            response = call_dependency(gemini_breaker, lambda: gen_model.generate_content(
+                prompt,
+                generation_config=gemini_generation_config(temperature=GEMINI_QUERY_EXPANSION_TEMP)
+            ))
+        return expanded_query_from_response(original_query, response)
+    except CircuitOpenError as e:
+        logging.warning(f"Query expansion skipped: {e}")
+        return original_query
+    except Exception as e:
+        metrics.inc("shl_llm_errors_total", call="expansion")
+        logging.error(f"Error during query expansion API call: {e}", exc_info=True)
+        return original_query
+
+
+def build_expansion_prompt(original_query: str) -> str:
+    return f"""Analyze the following user query about SHL assessments. Identify the core concepts, skills, or job roles mentioned. Generate a list of related keywords or synonyms that would be useful for searching a database of assessment product descriptions. Output ONLY the keywords, separated by commas. User Query: "{original_query}" Keywords only, comma-separated:"""
+
+
+def expanded_query_from_response(original_query: str, response) -> str:
+    """Combines the original query with the keywords in a Gemini expansion response; the original query if there are none."""
+    try:
+        # Check for content safely
+        if response.parts:
+            expanded_terms = response.text.strip()
+            if expanded_terms: # Ensure terms are not empty
+                combined_query = f"{original_query} | Relevant concepts: {expanded_terms}"
+                logging.info(f"Expanded query for search: '{combined_query}'")
+                return combined_query
+            else:
+                logging.warning("Query expansion resulted in empty terms. Falling back to original query.")
+                return original_query
+        # Handle blocked responses more explicitly
+        elif hasattr(response, 'prompt_feedback') and response.prompt_feedback and response.prompt_feedback.block_reason:
+             metrics.inc("shl_llm_blocked_total", call="expansion")
+             logging.warning(f"Query expansion failed. Reason: Response blocked ({response.prompt_feedback.block_reason}). Falling back.")
+             return original_query
+        else:
+            metrics.inc("shl_llm_errors_total", call="expansion")
+            logging.warning(f"Query expansion failed. Unknown reason (empty response?). Falling back.")
+            return original_query
+    except Exception as e:
+        metrics.inc("shl_llm_errors_total", call="expansion")
+        logging.error(f"Error reading query expansion response: {e}", exc_info=True)
+        return original_query
+
+# --- Concurrent Pipeline Helpers ---
+def get_pipeline_executor():
+    global pipeline_executor
+    if pipeline_executor is None:
+        pipeline_executor = ThreadPoolExecutor(max_workers=PIPELINE_MAX_WORKERS, thread_name_prefix="pipeline")
+    return pipeline_executor
+
+
+def search_products_with_timeout(query_embedding, filters=None, match_count=DB_RETRIEVAL_COUNT):
+    """Runs search_products on the pipeline executor, raising TimeoutError past RETRIEVAL_TIMEOUT_SECONDS."""
+    future = submit_traced(get_pipeline_executor(), search_products, query_embedding, filters, match_count)
+    try:
+        return future.result(timeout=RETRIEVAL_TIMEOUT_SECONDS)
+    except FutureTimeoutError:
+        raise TimeoutError(f"Retrieval did not finish within {RETRIEVAL_TIMEOUT_SECONDS} seconds.")
+
+
+def reciprocal_rank_fusion(result_lists, limit, k=RRF_K):
+    """Merges ranked match lists by summed 1/(k + rank), keeping the best similarity seen per product."""
+    scores = {}
+    best_match = {}
+    for matches in result_lists:
+        for rank, match in enumerate(matches or []):
+            if not isinstance(match, (dict, Candidate)) or not match.get('product_id'):
+                continue
+            product_id = match.get('product_id')
+            scores[product_id] = scores.get(product_id, 0.0) + 1.0 / (k + rank + 1)
+            current = best_match.get(product_id)
+            if current is None or (match.get('similarity') or 0) > (current.get('similarity') or 0):
+                best_match[product_id] = match
+    ranked_ids = sorted(scores, key=lambda product_id: scores[product_id], reverse=True)
+    return [best_match[product_id] for product_id in ranked_ids[:limit]]
+
+
+def merge_candidate_lists(raw_matches, expanded_matches, lexical_matches=None, limit=DB_RETRIEVAL_COUNT):
+    """Combines raw-query, expanded-query and lexical results; any may be None if that branch did not run or failed."""
+    if not lexical_matches:
+        if expanded_matches is None:
+            return raw_matches
+        if raw_matches is None:
+            return expanded_matches
+    result_lists = [matches for matches in (expanded_matches, raw_matches, lexical_matches) if matches is not None]
+    matches = reciprocal_rank_fusion(result_lists, limit)
+    logging.info(f"Fused {sum(len(matches) for matches in result_lists)} candidates from {len(result_lists)} retrieval lists into {len(matches)}.")
+    return matches
+
+
+def lexical_candidates(original_query: str, metadata, query_embedding=None, filters=None):
+    """BM25 candidates from the local index. Returns (matches or None if unavailable, whether the top match precisely names a product)."""
+    if not LEXICAL_SEARCH_ENABLED or vector_index is None or not vector_index.ready:
+        return None, False
+    try:
+        with trace_span("lexical_search"):
+            matches, precise = vector_index.lexical_search(original_query, DB_RETRIEVAL_COUNT, query_embedding, filters)
+    except Exception as e:
+        logging.error(f"Lexical search failed, using vector retrieval only: {e}", exc_info=True)
+        return None, False
+    metadata["lexical"] = {"matches": len(matches), "precise_match": precise}
+    if precise:
+        logging.info(f"Query '{original_query}' precisely matches product '{matches[0].get('product_name')}'.")
+    return matches, precise
+
+
+# --- Adaptive Retrieval Policy ---
+def retrieval_depth():
+    """Raw-query candidates to fetch: enough for retrieval_policy to see the shape of the score distribution."""
+    return max(ADAPTIVE_MAX_RETRIEVAL_COUNT, DB_RETRIEVAL_COUNT) if ADAPTIVE_RETRIEVAL else DB_RETRIEVAL_COUNT
+
+
+def retrieval_policy(matches):
+    """Classifies raw-query matches (best first) by their similarity scores. Returns (decision, k, stats).
+
+    'confident': the first k picks (k <= MAX_FINAL_RECOMMENDATIONS) all score at least CONFIDENT_MIN_SIMILARITY
+    and lead the next candidate by at least CONFIDENT_MIN_MARGIN, so they are returned without the final Gemini
+    call. 'flat': the top DB_RETRIEVAL_COUNT scores lie within FLAT_MAX_SPREAD, so every fetched candidate is
+    kept. Otherwise 'default' keeps DB_RETRIEVAL_COUNT.
+    """
+    scores = [float(match.get('similarity') or 0.0) for match in matches]
+    if not scores:
+        return "default", DB_RETRIEVAL_COUNT, {"top_similarity": None}
+    # A short list means nothing else cleared the threshold; a full one says nothing about the next score
+    scores_after = scores[1:] + [DB_MATCH_THRESHOLD if len(scores) < retrieval_depth() else scores[-1]]
+    picks, margin = 0, 0.0
+    for count in range(1, min(MAX_FINAL_RECOMMENDATIONS, len(scores)) + 1):
+        if scores[count - 1] < CONFIDENT_MIN_SIMILARITY:
+            break
+        if scores[count - 1] - scores_after[count - 1] > margin:
+            picks, margin = count, scores[count - 1] - scores_after[count - 1]
+    # Rounded so scores exactly at a threshold (0.85 - 0.75) are not lost to float error
+    margin, spread = round(margin, 6), round(scores[0] - scores[min(DB_RETRIEVAL_COUNT, len(scores)) - 1], 6)
+    stats = {"top_similarity": round(scores[0], 4), "margin": round(margin, 4), "spread": round(spread, 4)}
+    if picks and margin >= CONFIDENT_MIN_MARGIN:
+        return "confident", picks, stats
+    if len(scores) > DB_RETRIEVAL_COUNT and spread <= FLAT_MAX_SPREAD:
+        return "flat", len(scores), stats
+    return "default", DB_RETRIEVAL_COUNT, stats
+
+
+def apply_retrieval_policy(original_query: str, raw_matches, metadata, lexical_matches=None, lexical_match=False):
+    """Runs retrieval_policy on the raw-query matches and records the decision.
+
+    Returns (raw matches to keep, candidate limit for fusion, whether to answer directly from the matches).
+    """
+    if not ADAPTIVE_RETRIEVAL or not raw_matches:
+        return raw_matches, DB_RETRIEVAL_COUNT, False
+    decision, k, stats = retrieval_policy(raw_matches)
+    if decision == "confident" and lexical_match and lexical_matches[0].get('product_id') not in {match.get('product_id') for match in raw_matches[:k]}:
+        # The query names a product the vector picks do not include; let the full pipeline weigh both
+        decision, k = "default", DB_RETRIEVAL_COUNT
+        stats["overridden_by"] = "lexical_match"
+    metadata["retrieval"] = {"policy": decision, "k": min(k, len(raw_matches)), "fetched": len(raw_matches), **stats}
+    metrics.inc("shl_retrieval_policy_total", policy=decision)
+    logging.info(f"Retrieval policy: {json.dumps({'query': original_query, **metadata['retrieval']})}")
+    return raw_matches[:k], max(k, DB_RETRIEVAL_COUNT), decision == "confident"
+
+
+def is_confident_retrieval(metadata):
+    return metadata.get("retrieval", {}).get("policy") == "confident"
+
+
+def direct_recommendations(context_data_for_llm, metadata):
+    """Early exit for confident retrieval: the leading candidates are the answer, in similarity order. Returns (dict, 200)."""
+    metadata["ranking"] = {"mode": "direct"}
+    return recommendation_response(context_data_for_llm[:MAX_FINAL_RECOMMENDATIONS]), 200
+
+
+# --- RAG Core Function ---
+def check_pipeline_ready(original_query):
+    """Returns an (error dict, status_code) tuple if the pipeline cannot serve this query, otherwise None."""
+    # Check if initialization is complete or failed
+    if not initialization_complete:
+        if initialization_error_message:
+            logging.error(f"Initialization previously failed: {initialization_error_message}")
+            return {"error": f"Server is unavailable due to initialization failure: {initialization_error_message}", "status": "unavailable"}, 503
+        else:
+            logging.warning("Initialization not yet complete.")
+            return {"error": "Server is still initializing. Please try again shortly.", "status": "initializing"}, 503
+
+    # Check required clients are available (belt-and-suspenders check). Gemini is optional: without it the
+    # pipeline runs degraded (no expansion, "fast" ranking).
+    if not embed_model or not (supabase_client or (vector_index is not None and vector_index.ready)):
+         logging.critical("A required component (Embed, Supabase/local index) is None despite initialization supposedly complete.")
+         return {"error": "Internal server error: Core components missing.", "status": "internal_error"}, 500
+
+    if not original_query or not isinstance(original_query, str) or original_query.isspace():
+        logging.warning("Received invalid query.")
+        return {"error": "Query parameter is missing, empty, or not a string.", "status": "bad_request"}, 400
+    return None
+
+
+def no_match_response(original_query, metadata):
+    return {
+        "status": "no_match",
+        "message": f"No products found matching the initial criteria for query: '{original_query}'. Try rephrasing or broadening your search.",
+        "recommended_assessments": [],
+        "metadata": metadata
+    }
+
+
+def retrieve_candidates(original_query: str, expand_mode: str, query_embedding, metadata, filters=None):
+    """Expand -> Retrieve -> Format context. Returns (context_data_for_llm, None) or (None, (error dict, status_code)).
+
+    filters (see resolve_filters) are applied to every retrieval branch before its top-k cut.
+
+    Query expansion runs on the pipeline executor while the raw query is embedded and searched; the
+    candidate lists (raw, expanded and BM25) are merged with reciprocal rank fusion. A query that precisely
+    names a product is not expanded. If expansion misses EXPANSION_TIMEOUT_SECONDS the other candidates are
+    used on their own. The raw-query score distribution sets the depth (apply_retrieval_policy): a confident
+    lead returns only the leading picks without waiting for expansion, flat scores widen k. An empty context
+    list means nothing matched.
+    """
+    # 1. Lexical search over the local catalogue (sub-millisecond); decides whether expansion is needed
+    pipeline_started = time.time()
+    if filters:
+        metadata["filters"] = filters
+    lexical_matches, lexical_match = lexical_candidates(original_query, metadata, filters=filters)
+
+    # 2. Start query expansion in the background (cached; may be skipped depending on mode)
+    expansion_future = None
+    if expand_mode == "never" or lexical_match or (expand_mode == "auto" and not should_expand_query(original_query)):
+        expanded_query, metadata["expansion"] = expand_query(original_query, expand_mode, lexical_match)
+    else:
+        expansion_future = submit_traced(get_pipeline_executor(), expand_query, original_query, expand_mode)
+
+    # 3. Embed and search the raw query while expansion is in flight
+    logging.info(f"Embedding original query for retrieval...")
+    try:
+        if query_embedding is None:
+            with trace_span("encode"):
+                query_embedding = embed_model.encode(original_query)
+    except Exception as e:
+        logging.error(f"Failed to encode query: {e}", exc_info=True)
+        return None, ({"error": f"Failed to process query for embedding: {e}", "status": "embedding_error"}, 500)
+
+    depth = retrieval_depth()
+    logging.info(f"Searching for top {depth} relevant products...")
+    raw_matches = None
+    last_db_error = None
+    try:
+        raw_matches = search_products_with_timeout(query_embedding, filters, depth)
+    except Exception as e:
+        last_db_error = e
+        logging.error(f"Raw-query retrieval failed: {e}")
+    if lexical_matches:
+        vector_index.fill_similarity(lexical_matches, query_embedding)
+    raw_matches, candidate_limit, confident = apply_retrieval_policy(original_query, raw_matches, metadata, lexical_matches, lexical_match)
+    if confident:
+        # Early exit: the expanded branch is not waited for (a running call still fills the expansion cache)
+        if expansion_future is not None:
+            expansion_future.cancel()
+            metadata["expansion"] = {"mode": expand_mode, "expanded": False, "cached": False, "skipped": True,
+                                     "reason": "confident_retrieval", "duration_ms": 0.0}
+        return build_llm_context(raw_matches), None
+
+    # 4. Wait for expansion up to its deadline, then retrieve with the expanded query and fuse
+    expanded_matches = None
+    if expansion_future is not None:
+        remaining = EXPANSION_TIMEOUT_SECONDS - (time.time() - pipeline_started)
+        try:
+            expanded_query, metadata["expansion"] = expansion_future.result(timeout=max(remaining, 0))
+        except FutureTimeoutError:
+            # The call keeps running in the background and still fills the expansion cache
+            logging.warning(f"Query expansion missed its {EXPANSION_TIMEOUT_SECONDS}s deadline; using raw-query candidates.")
+            expanded_query = original_query
+            metadata["expansion"] = {"mode": expand_mode, "expanded": False, "cached": False, "skipped": False,
+                                     "timed_out": True, "duration_ms": round((time.time() - pipeline_started) * 1000, 1)}
+
+        if expanded_query != original_query:
+            try:
+                with trace_span("encode"):
+                    expanded_embedding = embed_model.encode(expanded_query)
+                expanded_matches = search_products_with_timeout(expanded_embedding, filters, candidate_limit)
+            except Exception as e:
+                last_db_error = last_db_error or e
+                logging.error(f"Expanded-query retrieval failed: {e}")
+
+    if raw_matches is None and expanded_matches is None and not lexical_matches:
+        return None, ({"error": f"Database search failed after {MAX_QUERY_RETRIES} retries: {last_db_error}", "status": "db_error"}, 503)
+
+    matches = merge_candidate_lists(raw_matches, expanded_matches, lexical_matches, candidate_limit)
+
+    if not matches:
+        logging.warning(f"No candidates found matching threshold {DB_MATCH_THRESHOLD} for expanded query '{expanded_query}'.")
+        return [], None # It's not an error, just no matches found
+
+    # 5. Format Context for Final LLM
+    return build_llm_context(matches), None
+
+
+def build_llm_context(matches):
+    """Turns retrieved match rows into the de-duplicated candidate list sent to the final LLM step.
+
+    Local-index Candidates are used as they are; RPC match dicts are copied into context dicts.
+    """
+    logging.info(f"Preparing context with {len(matches)} candidates for AI selection...")
+    context_data_for_llm = []
+    seen_product_ids = set() # Avoid duplicates if DB returns them somehow
+    for match in matches:
+        if isinstance(match, Candidate):
+            if match.get('product_id') and match.get('product_id') not in seen_product_ids:
+                context_data_for_llm.append(match)
+                seen_product_ids.add(match.get('product_id'))
+        elif isinstance(match, dict) and match.get('product_id') not in seen_product_ids:
+            product_id = match.get('product_id') # Get product_id for the JSON output
+            if not product_id:
+                logging.warning(f"Skipping match due to missing 'product_id': {match.get('product_name')}")
+                continue
+
+            context_data_for_llm.append({
+                # Ensure all required fields for the final JSON are present here
+                "product_id": product_id, # Use product_id from the match
+                "url": match.get('url'),
+                "adaptive_irt": match.get('adaptive_irt'), # Keep boolean or source format
+                "description": match.get('description'),
+                "duration_minutes": match.get('duration_minutes'), # Keep number or None
+                "remote_testing": match.get('remote_testing'), # Keep boolean or source format
+                "product_type": match.get('product_type', []),
+                "product_name": match.get('product_name'),
+                # Include similarity score for context, though not required in final JSON
+                "similarity_score": match.get('similarity')
+            })
+            seen_product_ids.add(product_id)
+        else:
+            if not isinstance(match, dict):
+                 logging.warning(f"Skipping unexpected match item format: {type(match)}, Content: {match}")
+            # else: duplicate product_id, already logged if needed
+
+    if not context_data_for_llm:
+         logging.warning("No valid candidates remaining after filtering for context.")
+    return context_data_for_llm
+
+
+def _to_yes_no(value):
+    """'Yes' for true/non-empty source values, 'No' otherwise (including 'no'/'false' strings)."""
+    if isinstance(value, str):
+        return "No" if value.strip().lower() in ("", "no", "n", "false", "0", "none", "null") else "Yes"
+    return "Yes" if value else "No"
+
+
+def candidate_test_types(candidate):
+    test_type = candidate.get('product_type') or []
+    return [test_type] if isinstance(test_type, str) else list(test_type)
+
+
+def format_assessment(candidate):
+    """Maps a context candidate to the public Assessment shape (see src/types/api.ts)."""
+    if isinstance(candidate, Candidate):
+        # Precomputed in the catalogue store; only the outer dict is new
+        return dict(candidate.record.assessment)
+    return {
+        "product_id": candidate.get('product_id'),
+        "product_name": candidate.get('product_name'),
+        "url": candidate.get('url') or "",
+        "adaptive_support": _to_yes_no(candidate.get('adaptive_irt')),
+        "description": candidate.get('description') or "",
+        "duration": candidate.get('duration_minutes'),
+        "remote_support": _to_yes_no(candidate.get('remote_testing')),
+        "test_type": candidate_test_types(candidate)
+    }
+
+
+def estimate_tokens(text: str) -> int:
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def truncate_text(text, max_chars: int) -> str:
+    """Collapses whitespace and cuts text at a word boundary to at most max_chars, marking the cut with an ellipsis."""
+    text = " ".join(str(text or "").split())
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max_chars - 1].rsplit(" ", 1)[0] or text[:max_chars - 1]
+    return cut + "\u2026"
+
+
+def test_type_codes(candidates):
+    """Short codes (A, B, ...) for the distinct test types of the candidates, in order of first appearance."""
+    codes = {}
+    for candidate in candidates:
+        for test_type in candidate_test_types(candidate):
+            if test_type not in codes:
+                # Past Z the type name itself is used; the SHL catalogue has far fewer types
+                codes[test_type] = string.ascii_uppercase[len(codes)] if len(codes) < len(string.ascii_uppercase) else test_type
+    return codes
+
+
+def compact_candidate_row(ref: int, candidate, type_codes, description_chars: int) -> str:
+    """One 'ref|name|test types|minutes|remote|adaptive|description' line of the compact prompt."""
+    duration = candidate.get('duration_minutes')
+    cells = (
+        ref,
+        truncate_text(candidate.get('product_name'), 120),
+        ",".join(type_codes[test_type] for test_type in candidate_test_types(candidate)),
+        "" if duration is None else duration,
+        _to_yes_no(candidate.get('remote_testing'))[0],
+        _to_yes_no(candidate.get('adaptive_irt'))[0],
+        truncate_text(candidate.get('description'), description_chars),
+    )
+    return "|".join(str(cell).replace("|", "/") for cell in cells)
+
+
+def render_compact_generation_prompt(original_query: str, candidates, description_chars: int) -> str:
+    type_codes = test_type_codes(candidates)
+    legend = "; ".join(f"{code}={test_type}" for test_type, code in type_codes.items() if code != test_type) or "none"
+    rows = "\n".join(compact_candidate_row(ref, candidate, type_codes, description_chars) for ref, candidate in enumerate(candidates, start=1))
+    return f"""You select SHL assessments for a user query from the candidates below.
+
+Query: "{original_query}"
+
+Candidates, best retrieval match first. Columns: ref|name|test types|minutes|remote|adaptive|description
+Test types: {legend}
+{rows}
+
+Pick AT MOST {MAX_FINAL_RECOMMENDATIONS} refs that directly address the query, best first. Prefer relevance to the query over list order. For a broad query (e.g. 'technical skills') include candidates that clearly fit that category. If none fit, return an empty list.
+Reply with ONLY this JSON, no markdown: {{"recommended": [ref, ...]}}"""
+
+
+def build_compact_generation_prompt(original_query: str, context_data_for_llm):
+    """Compact prompt within GENERATION_PROMPT_TOKEN_BUDGET. Returns (prompt, candidates included, in ref order).
+
+    Over budget, descriptions are shortened first, then the lowest-ranked candidates are dropped.
+    """
+    candidates = list(context_data_for_llm)
+    description_chars = GENERATION_DESCRIPTION_MAX_CHARS
+    while True:
+        prompt = render_compact_generation_prompt(original_query, candidates, description_chars)
+        if estimate_tokens(prompt) <= GENERATION_PROMPT_TOKEN_BUDGET:
+            return prompt, candidates
+        if description_chars > GENERATION_DESCRIPTION_MIN_CHARS:
+            description_chars = max(GENERATION_DESCRIPTION_MIN_CHARS, description_chars * 2 // 3)
+        elif len(candidates) > 1:
+            candidates = candidates[:-1]
+        else:
+            logging.warning(f"Generation prompt is over the {GENERATION_PROMPT_TOKEN_BUDGET}-token budget even with a single candidate.")
+            return prompt, candidates
+
+
+def build_generation_prompt(original_query: str, context_data_for_llm):
+    """Builds the final generation prompt in GENERATION_PROMPT_STYLE. Returns (prompt, candidates the answer refers to)."""
+    # 5. Construct Prompt for Final JSON Generation
+    if GENERATION_PROMPT_STYLE == "full":
+        prompt, candidates = build_full_generation_prompt(original_query, context_data_for_llm), context_data_for_llm
+    else:
+        prompt, candidates = build_compact_generation_prompt(original_query, context_data_for_llm)
+    logging.info(f"Generation prompt ({GENERATION_PROMPT_STYLE}): {len(candidates)}/{len(context_data_for_llm)} candidates, ~{estimate_tokens(prompt)} tokens.")
+    return prompt, candidates
+
+
+def build_full_generation_prompt(original_query: str, context_data_for_llm):
+    """Builds the original JSON-in, JSON-out generation prompt (GENERATION_PROMPT_STYLE=full)."""
+    context_json_string = json.dumps([candidate.as_context() if isinstance(candidate, Candidate) else candidate for candidate in context_data_for_llm],
+                                     indent=2, ensure_ascii=False) # ensure_ascii=False here too
+
+    # Updated prompt asking for specific conversion and explicit no-match JSON
+    return f"""You are an AI assistant generating JSON recommendations for SHL assessments based on provided context.
+        Analyze the user's original query and the provided context, which contains potentially relevant products found in the database.
+
+        Original User Query: "{original_query}"
+
+        Product Data Context (Top candidates retrieved, sorted by relevance):
+        ```json
+        {context_json_string}
+        ```
+
+        Your Task:
+        1. Select the **BEST** and **MOST RELEVANT** products from the context that directly address the *original user query*.
+        2. Choose **AT MOST {MAX_FINAL_RECOMMENDATIONS}** products. Prioritize direct relevance to the original query over similarity score alone.
+        3. If the original query was broad (e.g., 'technical skills'), include products from the context that clearly fit that category (like specific coding tests, technical simulations), up to the limit of {MAX_FINAL_RECOMMENDATIONS}.
+        4. Generate **ONLY** a single, valid JSON object as your response. Do not include any text before or after the JSON object, including markdown fences like ```json or ```.
+
+        JSON Output Instructions:
+        - The JSON object MUST have a top-level key: "recommended_assessments", which is a JSON array.
+        - The array should contain **0 to {MAX_FINAL_RECOMMENDATIONS}** product objects, ordered by relevance to the original query.
+        - Each product object MUST have these keys IN THIS EXACT ORDER:
+          - "product_id": string (from context's 'product_id')
+          - "product_name": string (from context's 'product_name')
+          - "url": string (from context's 'url', ensure it's not null, use "" if missing)
+          - "adaptive_support": string ("Yes" if context 'adaptive_irt' is true/non-empty, otherwise "No")
+          - "description": string (from context's 'description')
+          - "duration": number or null (from context's 'duration_minutes')
+          - "remote_support": string ("Yes" if context 'remote_testing' is true/non-empty, otherwise "No")
+          - "test_type": array of strings (from context's 'product_type', ensure it's an array)
+        - Use ONLY data provided in the context. Convert boolean/source values for 'adaptive_support' and 'remote_support' to "Yes" or "No" strings. Ensure 'test_type' is always an array. Handle nulls appropriately for 'duration' and provide default "" for missing 'url'.
+
+        - **Crucially**: If *none* of the products in the provided context are a good match for the *original user query*, output EXACTLY this JSON object:
+          `{{"status": "no_relevant_match_in_context", "message": "While related products were retrieved, none closely matched the specific request.", "recommended_assessments": []}}`
+
+        Generate the JSON output now.
+        """
+
+
+# --- Response Schema and JSON Repair ---
+# Gemini response schemas (OpenAPI subset). RECOMMENDATION_RESPONSE_SCHEMA mirrors RecommendationResponse in src/types/api.ts
+ASSESSMENT_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "product_id": {"type": "STRING"},
+        "product_name": {"type": "STRING"},
+        "url": {"type": "STRING"},
+        "adaptive_support": {"type": "STRING", "enum": ["Yes", "No"]},
+        "description": {"type": "STRING"},
+        "duration": {"type": "NUMBER", "nullable": True},
+        "remote_support": {"type": "STRING", "enum": ["Yes", "No"]},
+        "test_type": {"type": "ARRAY", "items": {"type": "STRING"}},
+    },
+    "required": ["product_id", "product_name", "url", "adaptive_support", "description", "duration", "remote_support", "test_type"],
+}
+RECOMMENDATION_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "recommended_assessments": {"type": "ARRAY", "items": ASSESSMENT_SCHEMA},
+        "status": {"type": "STRING"},
+        "message": {"type": "STRING"},
+    },
+    "required": ["recommended_assessments", "status", "message"],
+}
+# Answer schema of the compact prompt: candidate refs only, expanded locally into RecommendationResponse
+RECOMMENDED_REFS_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {"recommended": {"type": "ARRAY", "items": {"type": "INTEGER"}}},
+    "required": ["recommended"],
+}
+JSON_TYPE_CHECKS = {
+    "OBJECT": lambda value: isinstance(value, dict),
+    "ARRAY": lambda value: isinstance(value, list),
+    "STRING": lambda value: isinstance(value, str),
+    "NUMBER": lambda value: isinstance(value, (int, float)) and not isinstance(value, bool),
+    "INTEGER": lambda value: isinstance(value, int) and not isinstance(value, bool),
+    "BOOLEAN": lambda value: isinstance(value, bool),
+}
+TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+
+
+def schema_errors(value, schema, path="$"):
+    """Validates value against a response schema. Returns a list of 'path: problem' strings (empty when valid)."""
+    if value is None:
+        return [] if schema.get("nullable") else [f"{path}: is null"]
+    if not JSON_TYPE_CHECKS[schema["type"]](value):
+        return [f"{path}: expected {schema['type'].lower()}"]
+    if "enum" in schema and value not in schema["enum"]:
+        return [f"{path}: not one of {schema['enum']}"]
+    errors = []
+    if schema["type"] == "OBJECT":
+        for key in schema.get("required", []):
+            if key not in value:
+                errors.append(f"{path}.{key}: missing")
+        for key, property_schema in schema.get("properties", {}).items():
+            if key in value:
+                errors.extend(schema_errors(value[key], property_schema, f"{path}.{key}"))
+    elif schema["type"] == "ARRAY":
+        for index, item in enumerate(value):
+            errors.extend(schema_errors(item, schema["items"], f"{path}[{index}]"))
+    return errors
+
+
+def clean_json_text(text: str) -> str:
+    """Strips whitespace and markdown fences around a model's JSON answer."""
+    # --- Robust JSON Cleaning ---
+    cleaned_json_string = text.strip()
+    # Remove potential markdown fences (```json ... ``` or ``` ... ```)
+    if cleaned_json_string.startswith("```json"):
+        cleaned_json_string = cleaned_json_string[7:]
+    elif cleaned_json_string.startswith("```"):
+         cleaned_json_string = cleaned_json_string[3:]
+
+    if cleaned_json_string.endswith("```"):
+        cleaned_json_string = cleaned_json_string[:-3]
+
+    # Final strip after removing fences
+    cleaned_json_string = cleaned_json_string.strip()
+    # --- End JSON Cleaning ---
+    return cleaned_json_string
+
+
+def close_truncated_json(text: str):
+    """Parses JSON cut off mid-answer: backs up to the last complete element and closes the open brackets. Returns the value or None."""
+    cut_points = [] # (end position, closers needed there)
+    stack = []
+    in_string = False
+    escaped = False
+    for pos, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+            continue
+        if char == '"':
+            in_string = True
+        elif char in '{[':
+            stack.append('}' if char == '{' else ']')
+        elif char in '}]':
+            if not stack:
+                break
+            stack.pop()
+            cut_points.append((pos + 1, "".join(reversed(stack))))
+        elif char == ',':
+            cut_points.append((pos, "".join(reversed(stack))))
+    if not in_string:
+        cut_points.append((len(text), "".join(reversed(stack))))
+
+    for end, closers in reversed(cut_points[-50:]):
+        try:
+            return json.loads(TRAILING_COMMA_RE.sub(r"\1", text[:end].rstrip().rstrip(',') + closers))
+        except json.JSONDecodeError:
+            continue
+    return None
+
+
+def repair_json_text(text: str):
+    """Cheap local repair of an invalid JSON answer: drops text around the object, trailing commas and truncation. Returns the value or None."""
+    start = text.find('{')
+    if start == -1:
+        return None
+    text = text[start:]
+    end = text.rfind('}')
+    if end != -1:
+        try:
+            return json.loads(TRAILING_COMMA_RE.sub(r"\1", text[:end + 1]))
+        except json.JSONDecodeError:
+            pass
+    return close_truncated_json(text)
+
+
+def load_model_json(recommendation_json_string: str):
+    """Parses the model's JSON answer, repairing it locally if needed. Returns (value, None) or (None, (dict, status_code))."""
+    cleaned_json_string = clean_json_text(recommendation_json_string)
+    logging.debug(f"Cleaned JSON string attempt: '{cleaned_json_string}'") # Log the cleaned string
+    if not cleaned_json_string:
+        metrics.inc("shl_json_parse_failures_total")
+        logging.error("Gemini response was empty after cleaning attempts.")
+        return None, ({"error": "AI model returned an empty response after cleaning.", "status": "ai_error"}, 502)
+    try:
+        return json.loads(cleaned_json_string), None
+    except json.JSONDecodeError as json_e:
+        repaired = repair_json_text(cleaned_json_string)
+        if isinstance(repaired, dict):
+            metrics.inc("shl_json_repairs_total")
+            logging.warning(f"Gemini returned invalid JSON ({json_e}); using the locally repaired answer.")
+            return repaired, None
+        metrics.inc("shl_json_parse_failures_total")
+        logging.error(f"Gemini did not return valid JSON after cleaning and repair: {json_e}. Raw Response (start): '{recommendation_json_string[:200]}...'")
+        return None, ({"error": "AI model returned text that could not be parsed as JSON after cleaning. Check logs for details.", "raw_start": recommendation_json_string[:200], "status": "ai_error"}, 502)
+
+
+def recommendation_response(selected):
+    """RecommendationResponse for the selected context candidates (the no-match answer when empty)."""
+    if not selected:
+        return {
+            "status": "no_relevant_match_in_context",
+            "message": "While related products were retrieved, none closely matched the specific request.",
+            "recommended_assessments": []
+        }
+    return {
+        "recommended_assessments": [format_assessment(candidate) for candidate in selected],
+        "status": "success",
+        "message": "Successfully retrieved recommendations."
+    }
+
+
+def parse_recommendation_text(recommendation_json_string: str, candidates=None):
+    """Parses a full-style answer and validates it against RECOMMENDATION_RESPONSE_SCHEMA. Returns (dict, status_code).
+
+    Assessments that fail validation are rebuilt from the matching context candidate, or dropped if there is none.
+    """
+    logging.info("Received text response from Gemini, attempting to parse as JSON.")
+    parsed_json, error = load_model_json(recommendation_json_string)
+    if error:
+        return error
+    if not isinstance(parsed_json.get("recommended_assessments"), list):
+        metrics.inc("shl_json_parse_failures_total")
+        logging.error(f"Parsed JSON lacks 'recommended_assessments' list. Parsed: {parsed_json}")
+        return {"error": "AI model returned JSON without a 'recommended_assessments' list.", "status": "ai_error"}, 502
+
+    # --- Add status and message if missing (and recommendations exist) ---
+    if "status" not in parsed_json:
+        if parsed_json["recommended_assessments"]:
+             parsed_json["status"] = "success"
+             parsed_json["message"] = "Successfully retrieved recommendations."
+        else:
+             # If recommendations array is empty, assume no relevant match based on prompt instructions
+             parsed_json["status"] = "no_relevant_match_in_context"
+             parsed_json["message"] = parsed_json.get("message", "AI selected no relevant products from the provided context.")
+    parsed_json.setdefault("message", "")
+    # --- End status handling ---
+
+    by_product_id = {candidate.get('product_id'): candidate for candidate in candidates or []}
+    assessments = []
+    for assessment in parsed_json["recommended_assessments"][:MAX_FINAL_RECOMMENDATIONS]:
+        errors = schema_errors(assessment, ASSESSMENT_SCHEMA)
+        if not errors:
+            assessments.append(assessment)
+            continue
+        candidate = by_product_id.get(assessment.get('product_id')) if isinstance(assessment, dict) else None
+        logging.warning(f"Model assessment failed schema validation ({'; '.join(errors[:3])}); {'rebuilt from context' if candidate else 'dropped'}.")
+        if candidate:
+            assessments.append(format_assessment(candidate))
+    parsed_json["recommended_assessments"] = assessments
+    if not assessments and parsed_json["status"] == "success":
+        parsed_json.update(recommendation_response([]))
+
+    errors = schema_errors(parsed_json, RECOMMENDATION_RESPONSE_SCHEMA)
+    if errors:
+        metrics.inc("shl_json_parse_failures_total")
+        logging.error(f"Gemini answer does not match the response schema: {'; '.join(errors[:5])}")
+        return {"error": "AI model returned JSON that does not match the response schema.", "status": "ai_error"}, 502
+    logging.info("Response successfully parsed as JSON.")
+    return parsed_json, 200
+
+
+def resolve_candidate_refs(refs, candidates):
+    """Maps the model's 1-based refs (ints or numeric strings; product_ids also accepted) to candidates.
+
+    Unknown and repeated refs are skipped; at most MAX_FINAL_RECOMMENDATIONS are kept.
+    """
+    positions = {candidate.get('product_id'): index for index, candidate in enumerate(candidates)}
+    selected = []
+    seen = set()
+    for ref in refs:
+        index = None
+        if isinstance(ref, int) and not isinstance(ref, bool):
+            index = ref - 1
+        elif isinstance(ref, str):
+            index = positions.get(ref.strip())
+            if index is None and ref.strip().isdigit():
+                index = int(ref.strip()) - 1
+        if index is None or not 0 <= index < len(candidates) or index in seen:
+            logging.warning(f"Ignoring unknown or repeated candidate ref in model answer: {ref!r}")
+            continue
+        seen.add(index)
+        selected.append(candidates[index])
+    return selected[:MAX_FINAL_RECOMMENDATIONS]
+
+
+def parse_compact_recommendation_text(recommendation_json_string: str, candidates):
+    """Parses an ID-only answer ({"recommended": [refs]}) and re-expands it into full Assessment objects. Returns (dict, status_code)."""
+    parsed_json, error = load_model_json(recommendation_json_string)
+    if error:
+        return error
+    refs = parsed_json.get("recommended")
+    if not isinstance(refs, list):
+        metrics.inc("shl_json_parse_failures_total")
+        logging.error(f"Parsed JSON lacks 'recommended' list. Parsed: {parsed_json}")
+        return {"error": "AI model returned JSON without a 'recommended' list.", "status": "ai_error"}, 502
+    return recommendation_response(resolve_candidate_refs(refs, candidates)), 200
+
+
+def parse_generation_text(recommendation_json_string: str, candidates):
+    """Parses the final answer for GENERATION_PROMPT_STYLE; candidates is the list returned by build_generation_prompt."""
+    if GENERATION_PROMPT_STYLE == "full":
+        return parse_recommendation_text(recommendation_json_string, candidates)
+    return parse_compact_recommendation_text(recommendation_json_string, candidates)
+
+
+def record_generation_tokens(prompt: str, gemini_response):
+    """Logs and counts the tokens of one generation call, from usage metadata when the response carries it."""
+    usage = getattr(gemini_response, "usage_metadata", None)
+    prompt_tokens = getattr(usage, "prompt_token_count", None)
+    output_tokens = getattr(usage, "candidates_token_count", None)
+    source = "reported"
+    if not isinstance(prompt_tokens, int) or not prompt_tokens:
+        prompt_tokens, source = estimate_tokens(prompt), "estimated"
+    metrics.inc("shl_llm_tokens_total", prompt_tokens, call="generation", kind="prompt")
+    if isinstance(output_tokens, int):
+        metrics.inc("shl_llm_tokens_total", output_tokens, call="generation", kind="output")
+    logging.info(f"Generation tokens: prompt={prompt_tokens} ({source}), output={output_tokens if isinstance(output_tokens, int) else 'unknown'}.")
+
+
+def empty_generation_response(gemini_response):
+    """Error (dict, status_code) for a Gemini response without usable text: blocked or empty."""
+    # Handle blocked responses explicitly
+    if hasattr(gemini_response, 'prompt_feedback') and gemini_response.prompt_feedback and gemini_response.prompt_feedback.block_reason:
+         block_reason = gemini_response.prompt_feedback.block_reason
+         metrics.inc("shl_llm_blocked_total", call="generation")
+         logging.warning(f"Gemini response blocked. Reason: {block_reason}")
+         return {"error": f"AI response blocked by content safety filter ({block_reason}). Try rephrasing query or check context.", "status": "ai_blocked"}, 400
+    # Handle other unexpected empty responses
+    metrics.inc("shl_llm_errors_total", call="generation")
+    logging.warning("Gemini returned an empty or unexpected response structure.")
+    return {"error": "AI model returned an empty or unparseable response.", "status": "ai_error"}, 502
+
+
+def gemini_generation_config(**settings):
+    """A GenerationConfig for generate_content, or the same settings as a dict (which the SDK also accepts) while
+    google.generativeai is not imported yet, e.g. before _init_gemini finishes or with a stand-in model."""
+    if genai is None:
+        return dict(settings)
+    return genai.types.GenerationConfig(**settings)
+
+
+def generation_config():
+    """Final-generation config. With GEMINI_STRUCTURED_OUTPUT, Gemini returns JSON constrained to the answer schema of GENERATION_PROMPT_STYLE."""
+    global structured_output_supported
+    if GEMINI_STRUCTURED_OUTPUT and structured_output_supported:
+        try:
+            return gemini_generation_config(
+                temperature=GEMINI_JSON_GENERATION_TEMP,
+                response_mime_type="application/json",
+                response_schema=RECOMMENDATION_RESPONSE_SCHEMA if GENERATION_PROMPT_STYLE == "full" else RECOMMENDED_REFS_SCHEMA
+            )
+        except (TypeError, ValueError) as e:
+            structured_output_supported = False
+            logging.warning(f"Installed google-generativeai does not support structured output, using prompt-only JSON: {e}")
+    return gemini_generation_config(temperature=GEMINI_JSON_GENERATION_TEMP)
+
+
+def is_structured_output_rejection(error) -> bool:
+    """True for a Gemini 400 (e.g. InvalidArgument) naming the structured-output settings: the model or API
+    version does not support response_mime_type/response_schema, or rejects the schema itself."""
+    if type(error).__name__ not in ("InvalidArgument", "BadRequest") and getattr(error, "code", None) != 400:
+        return False
+    message = str(error).lower()
+    return any(term in message for term in ("response_schema", "response_mime_type", "schema", "mime type", "json mode"))
+
+
+def disable_structured_output(error):
+    global structured_output_supported
+    structured_output_supported = False
+    logging.warning(f"Gemini rejected structured output, retrying and continuing with prompt-only JSON: {error}")
+
+
+def generate_with_structured_fallback(prompt, **kwargs):
+    """gen_model.generate_content with generation_config(). If Gemini rejects the structured-output settings, clears
+    structured_output_supported and retries once prompt-only, inside the same breaker call."""
+    structured = GEMINI_STRUCTURED_OUTPUT and structured_output_supported
+    try:
+        return gen_model.generate_content(prompt, generation_config=generation_config(), **kwargs)
+    except Exception as e:
+        if not structured or not is_structured_output_rejection(e):
+            raise
+        disable_structured_output(e)
+        return gen_model.generate_content(prompt, generation_config=generation_config(), **kwargs)
+
+
+def generate_recommendations(original_query: str, context_data_for_llm):
+    """Step 6: asks Gemini to select and format the final recommendations. Returns (dict, status_code)."""
+    prompt, candidates = build_generation_prompt(original_query, context_data_for_llm)
+    logging.info(f"Sending final generation prompt to Gemini (asking for max {MAX_FINAL_RECOMMENDATIONS} results)...")
+    try:
+        with trace_span("generation"):
+            gemini_response = call_dependency(gemini_breaker, lambda: generate_with_structured_fallback(
+                prompt,
+                request_options={"timeout": GENERATION_TIMEOUT_SECONDS}
+            ))
+        # logging.debug(f"Raw Gemini Response Text: {gemini_response.text}") # Be cautious logging potentially large/sensitive raw responses
+        record_generation_tokens(prompt, gemini_response)
+
+        if gemini_response.parts:
+            return parse_generation_text(gemini_response.text, candidates)
+        return empty_generation_response(gemini_response)
+
+    except CircuitOpenError as e:
+        logging.warning(f"Final generation skipped: {e}")
+        return {"error": "The AI model is temporarily unavailable. Please retry shortly.", "status": "ai_unavailable"}, 503
+    except Exception as e:
+        # Catch potential errors during the API call itself
+        metrics.inc("shl_llm_errors_total", call="generation")
+        logging.error(f"Error calling Gemini API or processing its response: {e}", exc_info=True)
+        # Return error dictionary
+        return {"error": f"An error occurred communicating with the AI model: {e}", "status": "ai_error"}, 502
+
+
+# --- Fast (LLM-free) Ranking ---
+def get_reranker():
+    """Lazily loads the optional CrossEncoder named by RERANKER_MODEL_NAME. Returns None to use the lexical reranker."""
+    global reranker_model, reranker_load_failed
+    if not RERANKER_MODEL_NAME or reranker_load_failed:
+        return None
+    if reranker_model is None:
+        with reranker_lock:
+            if reranker_model is None and not reranker_load_failed:
+                try:
+                    from sentence_transformers import CrossEncoder
+                    logging.info(f"Loading reranker model '{RERANKER_MODEL_NAME}'...")
+                    reranker_model = CrossEncoder(RERANKER_MODEL_NAME)
+                    logging.info("Reranker model loaded.")
+                except Exception as e:
+                    logging.error(f"Failed to load reranker model, using lexical reranker: {e}", exc_info=True)
+                    reranker_load_failed = True
+    return reranker_model
+
+
+def lexical_rerank_scores(original_query: str, candidates):
+    """Blends vector similarity with weighted query-term overlap on name, test type and description."""
+    query_terms = {term for term in tokenize(original_query) if term not in QUERY_STOPWORDS}
+    scores = []
+    for candidate in candidates:
+        name_terms = set(tokenize(candidate.get('product_name') or ""))
+        product_type = candidate.get('product_type') or []
+        type_terms = set(tokenize(" ".join(product_type) if isinstance(product_type, list) else str(product_type)))
+        description_terms = set(tokenize(candidate.get('description') or ""))
+        overlap = 0.0
+        for term in query_terms:
+            if term in name_terms:
+                overlap += 1.0
+            elif term in type_terms:
+                overlap += 0.6
+            elif term in description_terms:
+                overlap += 0.4
+        lexical = overlap / len(query_terms) if query_terms else 0.0
+        similarity = candidate.get('similarity_score') or 0.0
+        scores.append(RERANK_SIMILARITY_WEIGHT * similarity + (1 - RERANK_SIMILARITY_WEIGHT) * lexical)
+    return scores
+
+
+def rank_recommendations_fast(original_query: str, context_data_for_llm, metadata):
+    """Selects and formats up to MAX_FINAL_RECOMMENDATIONS candidates locally, without a Gemini call. Returns (dict, status_code)."""
+    reranker = get_reranker()
+    scores = None
+    if reranker is not None:
+        try:
+            pairs = [(original_query, get_embedding_text(candidate)) for candidate in context_data_for_llm]
+            # Squash logits to 0..1 so FAST_MODE_MIN_SCORE means the same thing for both rerankers
+            scores = [float(1 / (1 + np.exp(-score))) for score in reranker.predict(pairs)]
+            metadata["ranking"] = {"mode": "fast", "reranker": "cross-encoder"}
+        except Exception as e:
+            logging.error(f"Cross-encoder reranking failed, using lexical reranker: {e}", exc_info=True)
+    if scores is None:
+        scores = lexical_rerank_scores(original_query, context_data_for_llm)
+        metadata["ranking"] = {"mode": "fast", "reranker": "lexical"}
+
+    # Stable sort keeps retrieval order for ties
+    ranked = sorted(zip(scores, range(len(context_data_for_llm))), key=lambda item: -item[0])
+    selected = [context_data_for_llm[idx] for score, idx in ranked[:MAX_FINAL_RECOMMENDATIONS] if score >= FAST_MODE_MIN_SCORE]
+    return recommendation_response(selected), 200
+
+
+def effective_ranking_mode(mode: str, metadata):
+    """Falls back to 'fast' ranking while Gemini is unavailable or its circuit breaker is open, flagging the response as degraded."""
+    if mode == "llm" and gen_model is None:
+        metadata["degraded"] = "gemini_unavailable"
+        return "fast"
+    if mode == "llm" and not gemini_breaker.available():
+        metadata["degraded"] = "gemini_circuit_open"
+        return "fast"
+    return mode
+
+
+def select_recommendations(original_query: str, context_data_for_llm, mode: str, metadata):
+    """Final selection step: Gemini for 'llm' mode, the local reranker for 'fast' mode. Returns (dict, status_code)."""
+    if is_confident_retrieval(metadata):
+        return direct_recommendations(context_data_for_llm, metadata)
+    if effective_ranking_mode(mode, metadata) == "fast":
+        with trace_span("rerank"):
+            return rank_recommendations_fast(original_query, context_data_for_llm, metadata)
+    metadata["ranking"] = {"mode": "llm"}
+    return generate_recommendations(original_query, context_data_for_llm)
+
+
+def get_product_recommendation_backend_robust(original_query: str, expand=None, query_embedding=None, mode=None, filters=None):
+    """Performs the enhanced RAG process: Expand -> Retrieve -> Select -> Generate JSON. Returns (dict, status_code)
+
+    query_embedding may carry a precomputed raw-query vector (e.g. from the response cache lookup).
+    filters are the request's effective structured filters (see resolve_filters).
+    """
+    not_ready = check_pipeline_ready(original_query)
+    if not_ready:
+        return not_ready
+
+    expand_mode = parse_expand_option(expand)
+    if expand_mode is None:
+        logging.warning(f"Invalid expand option: {expand!r}")
+        return {"error": "'expand' must be true, false or \"auto\".", "status": "bad_request"}, 400
+
+    ranking_mode = parse_mode_option(mode)
+    if ranking_mode is None:
+        logging.warning(f"Invalid mode option: {mode!r}")
+        return {"error": "'mode' must be \"llm\" or \"fast\".", "status": "bad_request"}, 400
+
+    # Pipeline metadata returned alongside successful responses
+    metadata = {}
+
+    # Default responses defined once
+    default_error_response = {"error": "An internal error occurred during recommendation generation.", "status": "error"}
+    default_error_code = 500
+
+    try:
+        context_data_for_llm, error = retrieve_candidates(original_query, expand_mode, query_embedding, metadata, filters)
+        if error:
+            return error
+        if not context_data_for_llm:
+            # Return the structured no-match response
+            return no_match_response(original_query, metadata), 200
+
+        result_data, status_code = select_recommendations(original_query, context_data_for_llm, ranking_mode, metadata)
+        if status_code == 200:
+            result_data["metadata"] = metadata
+        return result_data, status_code
+
+    except Exception as e:
+        # Catch-all for unexpected errors in the main RAG flow
+        logging.error(f"Unexpected error in RAG process for query '{original_query}': {e}", exc_info=True)
+        # Return default error dictionary
+        return default_error_response, default_error_code
+
+
+# --- Cached Recommendation Entry Point ---
+def lookup_response_cache(original_query: str, variant: str):
+    """Returns (cached_result or None, cache_key, raw query embedding or None). The embedding is reused on a miss."""
+    cache = get_response_cache()
+    if cache is None or not initialization_complete or not embed_model or not isinstance(original_query, str) or not original_query.strip():
+        return None, None, None
+
+    cache_key = response_cache_key(original_query, variant)
+    cached_result = cache.get_exact(cache_key)
+    if cached_result is not None:
+        logging.info(f"Response cache hit (exact) for query '{cache_key[:100]}'.")
+        return cached_result, cache_key, None
+
+    # Semantic lookup uses the raw query embedding, not the LLM-expanded one
+    query_embedding = None
+    try:
+        with trace_span("encode"):
+            query_embedding = embed_model.encode(original_query)
+    except Exception as e:
+        logging.warning(f"Failed to encode query for cache lookup: {e}")
+    with trace_span("cache_lookup"):
+        cached_result = cache.get_similar(query_embedding, variant=variant)
+    if cached_result is not None:
+        logging.info(f"Response cache hit (semantic) for query '{cache_key[:100]}'.")
+    return cached_result, cache_key, query_embedding
+
+
+def store_response_cache(cache_key, result_data, status_code, query_embedding, variant):
+    cache = get_response_cache()
+    if cache is None or cache_key is None or status_code != 200:
+        return
+    # Answers built without a timed-out or circuit-broken expansion, or degraded without Gemini, are served
+    # but not cached, so a later request can do better
+    metadata = result_data.get("metadata", {})
+    expansion = metadata.get("expansion", {})
+    if expansion.get("timed_out", False) or expansion.get("reason") == "gemini_circuit_open" or metadata.get("degraded"):
+        return
+    cache.put(cache_key, result_data, query_embedding, variant=variant)
+    result_data.setdefault("metadata", {})["response_cache"] = "miss"
+
+
+def get_product_recommendation_cached(original_query: str, expand=None, mode=None, filters=None, extract_filters=None):
+    """Serves repeat and near-duplicate queries from the response cache, otherwise runs the RAG pipeline. Returns (dict, status_code)
+
+    Identical requests arriving while one is already running wait for it and share its result.
+    filters are the validated explicit filters; extract_filters (default FILTER_EXTRACTION) adds those stated in the query.
+    """
+    ranking_mode = parse_mode_option(mode)
+    expand_mode = parse_expand_option(expand)
+    if ranking_mode is None or expand_mode is None:
+        return get_product_recommendation_backend_robust(original_query, expand=expand, mode=mode) # Reports the invalid option
+    filters = resolve_filters(original_query, filters, extract_filters)
+
+    coalescer = get_request_coalescer()
+    if coalescer is None or not isinstance(original_query, str):
+        return _get_product_recommendation_cached(original_query, expand_mode, ranking_mode, filters)
+    (result_data, status_code), shared = coalescer.do(coalescing_key(original_query, expand_mode, response_variant(ranking_mode, filters)),
+                                                      lambda: _get_product_recommendation_cached(original_query, expand_mode, ranking_mode, filters))
+    if shared and status_code == 200:
+        # A new dict, so a shared cache hit does not keep the encoded body of its unmarked metadata
+        result_data = dict(result_data, metadata=dict(result_data.get("metadata", {}), coalesced=True))
+    return result_data, status_code
+
+
+def _get_product_recommendation_cached(original_query: str, expand_mode: str, ranking_mode: str, filters):
+    variant = response_variant(ranking_mode, filters)
+    cached_result, cache_key, query_embedding = lookup_response_cache(original_query, variant)
+    if cached_result is not None:
+        return cached_result, 200
+
+    result_data, status_code = get_product_recommendation_backend_robust(original_query, expand=expand_mode, query_embedding=query_embedding, mode=ranking_mode, filters=filters)
+    store_response_cache(cache_key, result_data, status_code, query_embedding, variant)
+    return result_data, status_code
+
+
+# --- Request Coalescing ---
+class SingleFlight:
+    """Collapses concurrent calls with the same key into one execution whose result every caller receives."""
+
+    class _Call:
+        __slots__ = ("done", "result", "error", "waiters")
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+            self.waiters = 0
+
+    def __init__(self):
+        self._calls = {} # key -> _Call in flight
+        self._lock = threading.Lock()
+        self.executions = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """Runs fn() unless a call with this key is already running, in which case waits for it. Returns (result, shared).
+
+        Waiters get a deep copy of the leader's result; an exception raised by fn() is re-raised in every caller.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = self._Call()
+                self.executions += 1
+                leader = True
+            else:
+                call.waiters += 1
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            metrics.inc("shl_coalesced_requests_total")
+            with trace_span("coalesced_wait"):
+                call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result), True
 
-# --- Initialize Clients (Global Scope) ---
-supabase_client = None
-embed_model = None
-gen_model = None
-initialization_error_message = None
-initialization_complete = False
-initialization_thread = None
+        result = None
+        try:
+            result = fn()
+            return result, False
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                waiters = call.waiters
+            if waiters and call.error is None:
+                # Snapshot before the leader's caller can modify its copy
+                call.result = copy.deepcopy(result)
+            call.done.set()
 
-# --- Flask App Definition ---
-app = Flask(__name__)
-app.config['JSONIFY_PRETTYPRINT_REGULAR'] = True
-app.config['JSON_SORT_KEYS'] = False  # Preserve the order of keys in the JSON response
-app.config['JSONIFY_MIMETYPE'] = 'application/json; charset=utf-8'  # Ensure proper content type
+    def stats(self):
+        with self._lock:
+            return {"enabled": True, "in_flight": len(self._calls), "executions": self.executions, "coalesced": self.coalesced}
 
-# --- Helper Function for Pretty JSON Response ---
-def pretty_json_response(data, status_code=200):
-    """Return a pretty-formatted JSON response with proper headers"""
-    try:
-        # Ensure data is serializable, handle potential errors during dump
-        pretty_json = json.dumps(data, indent=2, ensure_ascii=False) # Added ensure_ascii=False for broader char support
-    except TypeError as e:
-        logging.error(f"Failed to serialize data to JSON: {e}. Data: {data}")
-        pretty_json = json.dumps({"error": "Internal server error: Failed to serialize response.", "status": "internal_error"}, indent=2)
-        status_code = 500
 
-    response = Response(
-        response=pretty_json,
-        status=status_code,
-        mimetype='application/json; charset=utf-8'
-    )
-    return response
+def coalescing_key(original_query: str, expand_mode: str, variant: str) -> str:
+    """Requests coalesce only when the normalized query and every option that changes the answer match."""
+    return f"{expand_mode}:{response_cache_key(original_query, variant)}"
 
-# --- Async Initialization Function ---
-def async_initialize():
-    global supabase_client, embed_model, gen_model, initialization_error_message, initialization_complete
-    try:
-        logging.info("Initializing Supabase client...")
-        if not SUPABASE_URL or not SUPABASE_KEY:
-            raise ValueError("Supabase URL/Key missing in environment variables.")
-        supabase_client = create_client(SUPABASE_URL, SUPABASE_KEY)
-        logging.info("Supabase client initialized.")
-
-        logging.info(f"Loading embedding model '{EMBEDDING_MODEL_NAME}'...")
-        embed_model = SentenceTransformer(EMBEDDING_MODEL_NAME)
-        actual_dimension = embed_model.get_sentence_embedding_dimension()
-        if actual_dimension != EXPECTED_EMBEDDING_DIMENSION:
-            raise ValueError(f"Embedding model dimension mismatch! Expected {EXPECTED_EMBEDDING_DIMENSION}, but got {actual_dimension}.")
-        logging.info(f"Embedding model loaded.")
-
-        logging.info("Initializing Gemini client...")
-        if not GEMINI_API_KEY:
-            raise ValueError("Gemini API Key missing in environment variables.")
-        genai.configure(api_key=GEMINI_API_KEY)
-        # It's good practice to specify the model generation configuration here if needed
-        gen_model = genai.GenerativeModel(
-             model_name='gemini-2.5-pro-preview-03-25', # Using gemini-1.5-flash as 2.0 isn't a standard public name yet
-             # generation_config=genai.types.GenerationConfig(...) # Can be set here or per-call
-             # safety_settings=... # Consider configuring safety settings
-        )
-
-        logging.info("Gemini client initialized.")
-
-        initialization_complete = True
-        logging.info("Initialization completed successfully")
-    except Exception as e:
-        logging.critical(f"CRITICAL ERROR DURING INITIALIZATION: {e}", exc_info=True)
-        initialization_error_message = f"Server initialization failed: {e}"
-        # Ensure components are None if initialization failed
-        supabase_client = None
-        embed_model = None
-        gen_model = None
-        initialization_complete = False # Explicitly set to false on error
 
-# --- Start initialization in background thread ---
-def start_initialization():
-    global initialization_thread
-    # Prevent starting multiple threads if called again
-    if initialization_thread is None or not initialization_thread.is_alive():
-        logging.info("Starting initialization in background thread")
-        initialization_thread = threading.Thread(target=async_initialize)
-        initialization_thread.daemon = True # Ensure thread exits when main process exits
-        initialization_thread.start()
-    else:
-        logging.info("Initialization thread already running.")
+def get_request_coalescer():
+    global request_coalescer
+    if request_coalescer is None and COALESCE_REQUESTS:
+        request_coalescer = SingleFlight()
+    return request_coalescer
 
 
-# --- Helper Function for Embedding Text ---
-def get_embedding_text(product):
-    """Combines important fields for richer embedding context."""
-    # Improved handling for potentially missing or None values
-    parts = [
-        f"Product: {product.get('product_name', '')}",
-        f"Type: {', '.join(product.get('product_type', [])) if product.get('product_type') else ''}",
-        f"Solution Type: {product.get('solution_type', '')}",
-        f"Description: {product.get('description', '')}",
-        f"Measures: {', '.join(product.get('measured_constructs', [])) if product.get('measured_constructs') else ''}",
-        # Robust handling for job_roles and target_audience which might contain non-strings or None
-        f"Roles: {', '.join(str(item).strip() for item in product.get('job_roles', []) if item and isinstance(str(item).strip(), str) and str(item).strip())}",
-        f"Target Audience: {', '.join(str(item).strip() for item in product.get('target_audience', []) if item and isinstance(str(item).strip(), str) and str(item).strip())}"
-    ]
-    # Filter out parts that are empty after formatting (e.g., "Roles: ")
-    return " | ".join(part for part in parts if ': ' in part and len(part.split(': ', 1)) > 1 and part.split(': ', 1)[1].strip())
+# --- Streaming Recommendation Helpers ---
+def sse_event(event: str, data) -> str:
+    """Formats one Server-Sent Events message."""
+    return f"event: {event}\ndata: {encode_json(data).decode('utf-8')}\n\n"
 
 
-# --- Query Expansion Function ---
-def expand_query_with_llm(original_query: str) -> str:
-    """Uses Gemini to expand the user query with related terms for better retrieval."""
-    if not gen_model or not initialization_complete: # Also check initialization_complete
-        logging.error("Gemini client not available for query expansion.")
-        return original_query
+def extract_streamed_assessments(buffer: str):
+    """Returns the complete objects found so far in the 'recommended_assessments' array of a partial JSON text."""
+    key_pos = buffer.find('"recommended_assessments"')
+    if key_pos == -1:
+        return []
+    array_pos = buffer.find('[', key_pos)
+    if array_pos == -1:
+        return []
 
-    prompt = f"""Analyze the following user query about SHL assessments. Identify the core concepts, skills, or job roles mentioned. Generate a list of related keywords or synonyms that would be useful for searching a database of assessment product descriptions. Output ONLY the keywords, separated by commas. User Query: "{original_query}" Keywords only, comma-separated:"""
-    try:
-        logging.info(f"Expanding query: '{original_query}'")
-        response = gen_model.generate_content(
-            prompt,
-            generation_config=genai.types.GenerationConfig(temperature=GEMINI_QUERY_EXPANSION_TEMP)
-        )
+    objects = []
+    depth = 0
+    in_string = False
+    escaped = False
+    object_start = None
+    for pos in range(array_pos + 1, len(buffer)):
+        char = buffer[pos]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+            continue
+        if char == '"':
+            in_string = True
+        elif char == '{':
+            if depth == 0:
+                object_start = pos
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0 and object_start is not None:
+                try:
+                    objects.append(json.loads(buffer[object_start:pos + 1]))
+                except json.JSONDecodeError:
+                    pass
+                object_start = None
+        elif char == ']' and depth == 0:
+            break
+    return objects
 
-        # Check for content safely
-        if response.parts:
-            expanded_terms = response.text.strip()
-            if expanded_terms: # Ensure terms are not empty
-                combined_query = f"{original_query} | Relevant concepts: {expanded_terms}"
-                logging.info(f"Expanded query for search: '{combined_query}'")
-                return combined_query
-            else:
-                logging.warning("Query expansion resulted in empty terms. Falling back to original query.")
-                return original_query
-        # Handle blocked responses more explicitly
-        elif hasattr(response, 'prompt_feedback') and response.prompt_feedback and response.prompt_feedback.block_reason:
-             logging.warning(f"Query expansion failed. Reason: Response blocked ({response.prompt_feedback.block_reason}). Falling back.")
-             return original_query
-        else:
-            logging.warning(f"Query expansion failed. Unknown reason (empty response?). Falling back.")
-            return original_query
-    except Exception as e:
-        logging.error(f"Error during query expansion API call: {e}", exc_info=True)
-        return original_query
 
-# --- RAG Core Function ---
-def get_product_recommendation_backend_robust(original_query: str):
-    """Performs the enhanced RAG process: Expand -> Retrieve -> Select -> Generate JSON. Returns (dict, status_code)"""
-    # Check if initialization is complete or failed
-    if not initialization_complete:
-        if initialization_error_message:
-            logging.error(f"Initialization previously failed: {initialization_error_message}")
-            return {"error": f"Server is unavailable due to initialization failure: {initialization_error_message}", "status": "unavailable"}, 503
-        else:
-            logging.warning("Initialization not yet complete.")
-            return {"error": "Server is still initializing. Please try again shortly.", "status": "initializing"}, 503
+def extract_streamed_refs(buffer: str):
+    """Returns the complete refs found so far in the 'recommended' array of a partial compact answer."""
+    key_pos = buffer.find('"recommended"')
+    if key_pos == -1:
+        return []
+    array_pos = buffer.find('[', key_pos)
+    if array_pos == -1:
+        return []
+    array_end = buffer.find(']', array_pos)
+    pieces = buffer[array_pos + 1:].split(',') if array_end == -1 else buffer[array_pos + 1:array_end].split(',')
+    if array_end == -1:
+        pieces = pieces[:-1] # The last ref may still be arriving
+    refs = []
+    for piece in pieces:
+        try:
+            refs.append(json.loads(piece))
+        except json.JSONDecodeError:
+            continue
+    return refs
 
-    # Check required clients are available (belt-and-suspenders check)
-    if not supabase_client or not embed_model or not gen_model:
-         logging.critical("A required client (Supabase, Embed, Gemini) is None despite initialization supposedly complete.")
-         return {"error": "Internal server error: Core components missing.", "status": "internal_error"}, 500
 
-    if not original_query or not isinstance(original_query, str) or original_query.isspace():
-        logging.warning("Received invalid query.")
-        return {"error": "Query parameter is missing, empty, or not a string.", "status": "bad_request"}, 400
+def extract_streamed_recommendations(buffer: str, candidates):
+    """Assessments complete so far in a partial answer of GENERATION_PROMPT_STYLE, in answer order."""
+    if GENERATION_PROMPT_STYLE == "full":
+        return extract_streamed_assessments(buffer)
+    return [format_assessment(candidate) for candidate in resolve_candidate_refs(extract_streamed_refs(buffer), candidates)]
 
-    # Default responses defined once
-    default_error_response = {"error": "An internal error occurred during recommendation generation.", "status": "error"}
-    default_error_code = 500
-    no_match_json_response_dict = {
-        "status": "no_match",
-        "message": f"No products found matching the initial criteria for query: '{original_query}'. Try rephrasing or broadening your search.",
-        "recommended_assessments": []
-    }
 
-    try:
-        # 1. Expand Query
-        expanded_query = expand_query_with_llm(original_query)
+def stream_done_data(status_code, started, trace=None):
+    data = {"status_code": status_code, "processing_time": round(time.time() - started, 3)}
+    if trace is not None:
+        data["timings"] = trace.to_dict()
+    return data
 
-        # 2. Embed Expanded Query
-        logging.info(f"Embedding expanded query for retrieval...")
+
+def stream_product_recommendations(original_query: str, expand=None, mode=None, timings=False, filters=None, extract_filters=None):
+    """Generator of SSE messages: 'candidates' after retrieval, 'recommendation' per streamed pick, then 'result' and 'done'.
+
+    With timings=True the 'done' event carries the request trace.
+    """
+    with request_trace() as trace:
+        started = time.time()
+        ranking_mode = parse_mode_option(mode)
+        filters = resolve_filters(original_query, filters, extract_filters)
+        variant = response_variant(ranking_mode, filters)
+        cached_result, cache_key, query_embedding = lookup_response_cache(original_query, variant)
+        if cached_result is not None:
+            yield sse_event("result", cached_result)
+            yield sse_event("done", stream_done_data(200, started, trace if timings else None))
+            return
+
+        metadata = {}
         try:
-            query_embedding = embed_model.encode(expanded_query).tolist()
-        except Exception as e:
-            logging.error(f"Failed to encode query: {e}", exc_info=True)
-            return {"error": f"Failed to process query for embedding: {e}", "status": "embedding_error"}, 500
+            context_data_for_llm, error = retrieve_candidates(original_query, parse_expand_option(expand), query_embedding, metadata, filters)
+            if error:
+                error_data, status_code = error
+                yield sse_event("error", dict(error_data, status_code=status_code))
+                return
+            if not context_data_for_llm:
+                result_data = no_match_response(original_query, metadata)
+                store_response_cache(cache_key, result_data, 200, query_embedding, variant)
+                yield sse_event("result", result_data)
+                yield sse_event("done", stream_done_data(200, started, trace if timings else None))
+                return
 
+            candidates = [dict(format_assessment(candidate), similarity_score=candidate.get('similarity_score')) for candidate in context_data_for_llm]
+            yield sse_event("candidates", {"status": "candidates", "candidates": candidates, "metadata": metadata,
+                                           "retrieval_time": round(time.time() - started, 3)})
 
-        # 3. Query Supabase using Expanded Query Embedding
-        logging.info(f"Searching for top {DB_RETRIEVAL_COUNT} relevant products...")
-        matches = []
-        last_db_error = None
-        for attempt in range(MAX_QUERY_RETRIES):
+            if is_confident_retrieval(metadata) or effective_ranking_mode(ranking_mode, metadata) == "fast":
+                result_data, status_code = select_recommendations(original_query, context_data_for_llm, ranking_mode, metadata)
+                result_data["metadata"] = metadata
+                store_response_cache(cache_key, result_data, status_code, query_embedding, variant)
+                yield sse_event("result", result_data)
+                yield sse_event("done", stream_done_data(status_code, started, trace if timings else None))
+                return
+
+            metadata["ranking"] = {"mode": "llm"}
+            prompt, prompt_candidates = build_generation_prompt(original_query, context_data_for_llm)
+            logging.info(f"Streaming final generation from Gemini (asking for max {MAX_FINAL_RECOMMENDATIONS} results)...")
+            buffer = ""
+            emitted = 0
             try:
-                # Ensure supabase_client is valid before calling rpc
-                if not supabase_client:
-                     raise ConnectionError("Supabase client is not initialized.")
+                # The span covers the whole stream; the breaker only times the Gemini side, not waits on the client
+                with trace_span("generation"), gemini_breaker.guard() as call_timer:
+                    with call_timer.measure():
+                        gemini_stream = generate_with_structured_fallback(
+                            prompt,
+                            stream=True,
+                            request_options={"timeout": GENERATION_TIMEOUT_SECONDS}
+                        )
+                        chunks = iter(gemini_stream)
+                    while True:
+                        with call_timer.measure():
+                            chunk = next(chunks, None)
+                        if chunk is None:
+                            break
+                        try:
+                            buffer += chunk.text
+                        except ValueError:
+                            continue # Chunk without text parts (e.g. safety metadata only)
+                        assessments = extract_streamed_recommendations(buffer, prompt_candidates)
+                        for assessment in assessments[emitted:]:
+                            yield sse_event("recommendation", assessment)
+                        emitted = len(assessments)
+            except CircuitOpenError as e:
+                # The breaker opened (or another request took its half-open probe) after effective_ranking_mode
+                logging.warning(f"Streamed generation skipped, ranking locally: {e}")
+                metadata["degraded"] = "gemini_circuit_open"
+                with trace_span("rerank"):
+                    result_data, status_code = rank_recommendations_fast(original_query, context_data_for_llm, metadata)
+                result_data["metadata"] = metadata
+                yield sse_event("result", result_data)
+                yield sse_event("done", stream_done_data(status_code, started, trace if timings else None))
+                return
 
-                response = supabase_client.rpc(
-                    DB_FUNCTION_NAME,
-                    {
-                        'query_embedding': query_embedding,
-                        'match_threshold': DB_MATCH_THRESHOLD,
-                        'match_count': DB_RETRIEVAL_COUNT
-                    }
-                ).execute()
+            record_generation_tokens(prompt, gemini_stream)
+            if buffer.strip():
+                result_data, status_code = parse_generation_text(buffer, prompt_candidates)
+            else:
+                result_data, status_code = empty_generation_response(gemini_stream)
+            if status_code != 200:
+                yield sse_event("error", dict(result_data, status_code=status_code))
+                return
+            result_data["metadata"] = metadata
+            store_response_cache(cache_key, result_data, status_code, query_embedding, variant)
+            yield sse_event("result", result_data)
+            yield sse_event("done", stream_done_data(200, started, trace if timings else None))
 
-                # Check response structure (depends on Supabase client version)
-                if hasattr(response, 'data') and response.data is not None:
-                    matches = response.data
-                elif isinstance(response, list): # Handle cases where it might return a list directly
-                     matches = response
-                else:
-                     # Log unexpected response structure
-                     logging.warning(f"Supabase RPC returned unexpected response structure: {type(response)}, Content: {response}")
-                     matches = [] # Assume no matches if structure is wrong
+        except Exception as e:
+            logging.error(f"Unexpected error while streaming recommendations for query '{original_query}': {e}", exc_info=True)
+            yield sse_event("error", {"error": f"An error occurred while streaming recommendations: {e}", "status": "error", "status_code": 500})
 
-                logging.info(f"Initial retrieval found {len(matches)} candidates (Attempt {attempt + 1}).")
-                last_db_error = None # Reset error on success
-                break # Exit loop on success
-            except Exception as e:
-                last_db_error = e
-                logging.error(f"Supabase RPC error (Attempt {attempt + 1}/{MAX_QUERY_RETRIES}): {e}", exc_info=True)
-                if attempt < MAX_QUERY_RETRIES - 1:
-                    logging.info(f"Retrying Supabase query in {RETRY_QUERY_DELAY} seconds...")
-                    time.sleep(RETRY_QUERY_DELAY)
-                else:
-                    logging.error("Supabase search failed after all retries.")
-                    # Use last_db_error in the response
-                    return {"error": f"Database search failed after {MAX_QUERY_RETRIES} retries: {last_db_error}", "status": "db_error"}, 503
 
-        # If loop finished due to retries failing
-        if last_db_error:
-             return {"error": f"Database search failed: {last_db_error}", "status": "db_error"}, 503
+# --- Batch Recommendation ---
+def get_product_recommendations_batch(queries, expand=None, mode=None, filters=None, extract_filters=None):
+    """Recommendations for many queries with one batched encode and one matrix retrieval per stage.
 
+    Gemini calls (expansion and final generation) run with at most BATCH_LLM_CONCURRENCY in flight.
+    filters apply to every query, on top of any extracted from each query's text.
+    Yields (index, result dict, status_code) tuples in completion order, not input order.
+    """
+    expand_mode = parse_expand_option(expand)
+    if expand_mode is None:
+        for index in range(len(queries)):
+            yield index, {"error": "'expand' must be true, false or \"auto\".", "status": "bad_request"}, 400
+        return
+    ranking_mode = parse_mode_option(mode)
+    if ranking_mode is None:
+        for index in range(len(queries)):
+            yield index, {"error": "'mode' must be \"llm\" or \"fast\".", "status": "bad_request"}, 400
+        return
 
-        if not matches:
-            logging.warning(f"No candidates found matching threshold {DB_MATCH_THRESHOLD} for expanded query '{expanded_query}'.")
-            # Return the structured no-match response
-            return no_match_json_response_dict, 200 # It's not an error, just no matches found
+    pending = []
+    for index, original_query in enumerate(queries):
+        not_ready = check_pipeline_ready(original_query)
+        if not_ready:
+            yield (index,) + not_ready
+        else:
+            pending.append(index)
+    if not pending:
+        return
 
-        # 4. Format Context for Final LLM
-        logging.info(f"Preparing context with {len(matches)} candidates for AI selection...")
-        context_data_for_llm = []
-        seen_product_ids = set() # Avoid duplicates if DB returns them somehow
-        for match in matches:
-            if isinstance(match, dict) and match.get('product_id') not in seen_product_ids:
-                product_id = match.get('product_id') # Get product_id for the JSON output
-                if not product_id:
-                    logging.warning(f"Skipping match due to missing 'product_id': {match.get('product_name')}")
-                    continue
-
-                context_data_for_llm.append({
-                    # Ensure all required fields for the final JSON are present here
-                    "product_id": product_id, # Use product_id from the match
-                    "url": match.get('url'),
-                    "adaptive_irt": match.get('adaptive_irt'), # Keep boolean or source format
-                    "description": match.get('description'),
-                    "duration_minutes": match.get('duration_minutes'), # Keep number or None
-                    "remote_testing": match.get('remote_testing'), # Keep boolean or source format
-                    "product_type": match.get('product_type', []),
-                    "product_name": match.get('product_name'),
-                    # Include similarity score for context, though not required in final JSON
-                    "similarity_score": match.get('similarity')
-                })
-                seen_product_ids.add(product_id)
+    # 1. Exact cache hits need no embedding at all
+    cache = get_response_cache()
+    filters_by_index = {index: resolve_filters(queries[index], filters, extract_filters) for index in pending}
+    variants = {index: response_variant(ranking_mode, filters_by_index[index]) for index in pending}
+    cache_keys = {index: response_cache_key(queries[index], variants[index]) for index in pending}
+    if cache is not None:
+        still_pending = []
+        for index in pending:
+            cached_result = cache.get_exact(cache_keys[index])
+            if cached_result is not None:
+                yield index, cached_result, 200
             else:
-                if not isinstance(match, dict):
-                     logging.warning(f"Skipping unexpected match item format: {type(match)}, Content: {match}")
-                # else: duplicate product_id, already logged if needed
+                still_pending.append(index)
+        pending = still_pending
+        if not pending:
+            return
 
-        if not context_data_for_llm:
-             logging.warning("No valid candidates remaining after filtering for context.")
-             return no_match_json_response_dict, 200
+    # 2. One batched encode for every raw query
+    logging.info(f"Batch: encoding {len(pending)} queries...")
+    try:
+        with trace_span("encode"):
+            raw_embeddings = embed_model.encode([queries[index] for index in pending], batch_size=BATCH_ENCODE_SIZE)
+    except Exception as e:
+        logging.error(f"Batch: failed to encode queries: {e}", exc_info=True)
+        for index in pending:
+            yield index, {"error": f"Failed to process query for embedding: {e}", "status": "embedding_error"}, 500
+        return
+    raw_embedding_by_index = dict(zip(pending, raw_embeddings))
 
+    if cache is not None:
+        still_pending = []
+        for index in pending:
+            cached_result = cache.get_similar(raw_embedding_by_index[index], variant=variants[index])
+            if cached_result is not None:
+                yield index, cached_result, 200
+            else:
+                still_pending.append(index)
+        pending = still_pending
+        if not pending:
+            return
 
-        # 5. Construct Prompt for Final JSON Generation
-        context_json_string = json.dumps(context_data_for_llm, indent=2, ensure_ascii=False) # ensure_ascii=False here too
+    executor = ThreadPoolExecutor(max_workers=BATCH_LLM_CONCURRENCY, thread_name_prefix="batch")
+    try:
+        # 3. Lexical search per query, then query expansion with bounded concurrency (cached, and skipped per mode
+        #    or for queries that precisely name a product)
+        metadata_by_index = {index: {"filters": filters_by_index[index]} if filters_by_index[index] else {} for index in pending}
+        lexical_results = {index: lexical_candidates(queries[index], metadata_by_index[index], raw_embedding_by_index[index], filters_by_index[index])
+                           for index in pending}
+        expansions = dict(zip(pending, executor.map(lambda index: expand_query(queries[index], expand_mode, lexical_results[index][1]), pending)))
+        expanded_indices = [index for index in pending if expansions[index][0] != queries[index]]
 
-        # Updated prompt asking for specific conversion and explicit no-match JSON
-        prompt = f"""You are an AI assistant generating JSON recommendations for SHL assessments based on provided context.
-        Analyze the user's original query and the provided context, which contains potentially relevant products found in the database.
+        # 4. One batched encode for the expanded queries, then one retrieval pass over all vectors
+        embeddings = [raw_embedding_by_index[index] for index in pending]
+        if expanded_indices:
+            try:
+                with trace_span("encode"):
+                    embeddings.extend(embed_model.encode([expansions[index][0] for index in expanded_indices], batch_size=BATCH_ENCODE_SIZE))
+            except Exception as e:
+                logging.error(f"Batch: failed to encode expanded queries, using raw queries only: {e}", exc_info=True)
+                expanded_indices = []
+        logging.info(f"Batch: retrieving candidates for {len(embeddings)} query vectors...")
+        search_filters = [filters_by_index[index] for index in pending] + [filters_by_index[index] for index in expanded_indices]
+        search_results = search_products_batch(np.asarray(embeddings, dtype=np.float32), search_filters, retrieval_depth())
+        raw_results = dict(zip(pending, search_results[:len(pending)]))
+        expanded_results = dict(zip(expanded_indices, search_results[len(pending):]))
 
-        Original User Query: "{original_query}"
+        # 5. Final generation with bounded concurrency, yielding results as they complete
+        futures = {}
+        for index in pending:
+            metadata_by_index[index]["expansion"] = expansions[index][1]
+            lexical_matches = lexical_results[index][0]
+            raw_matches = raw_results[index]
+            expanded_matches = expanded_results.get(index)
+            last_db_error = raw_matches if isinstance(raw_matches, Exception) else expanded_matches
+            raw_matches = None if isinstance(raw_matches, Exception) else raw_matches
+            expanded_matches = None if isinstance(expanded_matches, Exception) else expanded_matches
+            if raw_matches is None and expanded_matches is None and not lexical_matches:
+                yield index, {"error": f"Database search failed after {MAX_QUERY_RETRIES} retries: {last_db_error}", "status": "db_error"}, 503
+                continue
 
-        Product Data Context (Top candidates retrieved, sorted by relevance):
-        ```json
-        {context_json_string}
-        ```
+            raw_matches, candidate_limit, confident = apply_retrieval_policy(queries[index], raw_matches, metadata_by_index[index], lexical_matches, lexical_results[index][1])
+            if confident:
+                matches = raw_matches
+            else:
+                matches = merge_candidate_lists(raw_matches, expanded_matches and expanded_matches[:candidate_limit], lexical_matches, candidate_limit)
+            context_data_for_llm = build_llm_context(matches) if matches else []
+            if not context_data_for_llm:
+                result_data = no_match_response(queries[index], metadata_by_index[index])
+                store_response_cache(cache_keys[index], result_data, 200, raw_embedding_by_index[index], variants[index])
+                yield index, result_data, 200
+                continue
+            if confident or effective_ranking_mode(ranking_mode, metadata_by_index[index]) == "fast":
+                # No LLM call to bound, so answer inline
+                result_data, status_code = select_recommendations(queries[index], context_data_for_llm, ranking_mode, metadata_by_index[index])
+                result_data["metadata"] = metadata_by_index[index]
+                store_response_cache(cache_keys[index], result_data, status_code, raw_embedding_by_index[index], variants[index])
+                yield index, result_data, status_code
+                continue
+            metadata_by_index[index]["ranking"] = {"mode": "llm"}
+            futures[executor.submit(generate_recommendations, queries[index], context_data_for_llm)] = index
 
-        Your Task:
-        1. Select the **BEST** and **MOST RELEVANT** products from the context that directly address the *original user query*.
-        2. Choose **AT MOST {MAX_FINAL_RECOMMENDATIONS}** products. Prioritize direct relevance to the original query over similarity score alone.
-        3. If the original query was broad (e.g., 'technical skills'), include products from the context that clearly fit that category (like specific coding tests, technical simulations), up to the limit of {MAX_FINAL_RECOMMENDATIONS}.
-        4. Generate **ONLY** a single, valid JSON object as your response. Do not include any text before or after the JSON object, including markdown fences like ```json or ```.
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                result_data, status_code = future.result()
+            except Exception as e:
+                logging.error(f"Batch: unexpected error generating recommendations for query {index}: {e}", exc_info=True)
+                result_data, status_code = {"error": "An internal error occurred during recommendation generation.", "status": "error"}, 500
+            if status_code == 200:
+                result_data["metadata"] = metadata_by_index[index]
+                store_response_cache(cache_keys[index], result_data, status_code, raw_embedding_by_index[index], variants[index])
+            yield index, result_data, status_code
+    finally:
+        # Drop queued work if the consumer stops early (e.g. the client disconnected)
+        executor.shutdown(wait=False, cancel_futures=True)
 
-        JSON Output Instructions:
-        - The JSON object MUST have a top-level key: "recommended_assessments", which is a JSON array.
-        - The array should contain **0 to {MAX_FINAL_RECOMMENDATIONS}** product objects, ordered by relevance to the original query.
-        - Each product object MUST have these keys IN THIS EXACT ORDER:
-          - "product_id": string (from context's 'product_id')
-          - "product_name": string (from context's 'product_name')
-          - "url": string (from context's 'url', ensure it's not null, use "" if missing)
-          - "adaptive_support": string ("Yes" if context 'adaptive_irt' is true/non-empty, otherwise "No")
-          - "description": string (from context's 'description')
-          - "duration": number or null (from context's 'duration_minutes')
-          - "remote_support": string ("Yes" if context 'remote_testing' is true/non-empty, otherwise "No")
-          - "test_type": array of strings (from context's 'product_type', ensure it's an array)
-        - Use ONLY data provided in the context. Convert boolean/source values for 'adaptive_support' and 'remote_support' to "Yes" or "No" strings. Ensure 'test_type' is always an array. Handle nulls appropriately for 'duration' and provide default "" for missing 'url'.
 
-        - **Crucially**: If *none* of the products in the provided context are a good match for the *original user query*, output EXACTLY this JSON object:
-          `{{"status": "no_relevant_match_in_context", "message": "While related products were retrieved, none closely matched the specific request.", "recommended_assessments": []}}`
+def ndjson_line(fields, result) -> bytes:
+    """One NDJSON line: fields plus "result". A cached result's memoized body is spliced in rather than re-encoded."""
+    body = serialize_response(result)[0] if isinstance(result, CachedResponse) else encode_json(result)
+    return encode_json(fields)[:-1] + b',"result":' + body + b"}\n"
 
-        Generate the JSON output now.
-        """
 
-        # 6. Call Gemini for Final JSON Generation
-        logging.info(f"Sending final generation prompt to Gemini (asking for max {MAX_FINAL_RECOMMENDATIONS} results)...")
-        try:
-            gemini_response = gen_model.generate_content(
-                prompt,
-                generation_config=genai.types.GenerationConfig(
-                    temperature=GEMINI_JSON_GENERATION_TEMP,
-                    # Explicitly ask for JSON output if the model supports it
-                    # response_mime_type="application/json" # Uncomment if using a model/version supporting this
-                )
-            )
-            # logging.debug(f"Raw Gemini Response Text: {gemini_response.text}") # Be cautious logging potentially large/sensitive raw responses
+# --- Admission Control ---
+class AdmissionController:
+    """Bounds the recommendation requests in progress in this process.
 
-            if gemini_response.parts:
-                recommendation_json_string = gemini_response.text
-                logging.info("Received text response from Gemini, attempting to parse as JSON.")
+    Up to max_concurrent run at once and up to max_queued wait (at most queue_timeout seconds) for a slot;
+    anything beyond that is rejected immediately so callers get a fast 429 instead of piling up.
+    """
 
-                # --- Robust JSON Cleaning ---
-                cleaned_json_string = recommendation_json_string.strip()
-                # Remove potential markdown fences (```json ... ``` or ``` ... ```)
-                if cleaned_json_string.startswith("```json"):
-                    cleaned_json_string = cleaned_json_string[7:]
-                elif cleaned_json_string.startswith("```"):
-                     cleaned_json_string = cleaned_json_string[3:]
+    def __init__(self, max_concurrent, max_queued, queue_timeout):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
 
-                if cleaned_json_string.endswith("```"):
-                    cleaned_json_string = cleaned_json_string[:-3]
+    def try_acquire(self):
+        """Returns True once a slot is held (the caller must release it), False if the request should be rejected."""
+        acquired = self._slots.acquire(blocking=False)
+        if not acquired:
+            with self._lock:
+                if self.waiting >= self.max_queued:
+                    self.rejected += 1
+                    return False
+                self.waiting += 1
+            acquired = self._slots.acquire(timeout=self.queue_timeout)
+            with self._lock:
+                self.waiting -= 1
+        with self._lock:
+            if not acquired:
+                self.rejected += 1
+                return False
+            self.active += 1
+            self.admitted += 1
+        return True
 
-                # Final strip after removing fences
-                cleaned_json_string = cleaned_json_string.strip()
-                # --- End JSON Cleaning ---
+    def release(self):
+        with self._lock:
+            self.active -= 1
+        self._slots.release()
 
-                logging.debug(f"Cleaned JSON string attempt: '{cleaned_json_string}'") # Log the cleaned string
+    def stats(self):
+        with self._lock:
+            return {
+                "max_concurrent": self.max_concurrent,
+                "max_queued": self.max_queued,
+                "queue_timeout_seconds": self.queue_timeout,
+                "active": self.active,
+                "waiting": self.waiting,
+                "admitted": self.admitted,
+                "rejected": self.rejected
+            }
 
-                if not cleaned_json_string:
-                     logging.error("Gemini response was empty after cleaning attempts.")
-                     return {"error": "AI model returned an empty response after cleaning.", "status": "ai_error"}, 502
 
-                try:
-                    # Attempt to parse the cleaned string
-                    parsed_json = json.loads(cleaned_json_string)
-                    logging.info("Response successfully parsed as JSON.")
-
-                    # --- Add status and message if missing (and recommendations exist) ---
-                    if "status" not in parsed_json:
-                        if isinstance(parsed_json.get("recommended_assessments"), list) and len(parsed_json["recommended_assessments"]) > 0:
-                             parsed_json["status"] = "success"
-                             parsed_json["message"] = "Successfully retrieved recommendations."
-                        else:
-                             # If recommendations array is missing or empty, assume no relevant match based on prompt instructions
-                             parsed_json["status"] = "no_relevant_match_in_context"
-                             parsed_json["message"] = parsed_json.get("message", "AI selected no relevant products from the provided context.")
-                             if "recommended_assessments" not in parsed_json:
-                                 parsed_json["recommended_assessments"] = []
-                    # --- End status handling ---
-
-                    # Validate structure minimally (presence of recommended_assessments array)
-                    if not isinstance(parsed_json.get("recommended_assessments"), list):
-                        logging.error(f"Parsed JSON lacks 'recommended_assessments' list. Parsed: {parsed_json}")
-                        raise json.JSONDecodeError("Parsed JSON missing 'recommended_assessments' list.", cleaned_json_string, 0)
-
-                    # Return the parsed dictionary and status code
-                    return parsed_json, 200
-
-                except json.JSONDecodeError as json_e:
-                    logging.error(f"Gemini did not return valid JSON after cleaning: {json_e}. Cleaned String: '{cleaned_json_string}'. Raw Response (start): '{recommendation_json_string[:200]}...'")
-                    # Return error dictionary
-                    return {"error": f"AI model returned text that could not be parsed as JSON after cleaning. Check logs for details.", "raw_start": recommendation_json_string[:200], "status": "ai_error"}, 502
-
-            # Handle blocked responses explicitly
-            elif hasattr(gemini_response, 'prompt_feedback') and gemini_response.prompt_feedback and gemini_response.prompt_feedback.block_reason:
-                 block_reason = gemini_response.prompt_feedback.block_reason
-                 logging.warning(f"Gemini response blocked. Reason: {block_reason}")
-                 # Return error dictionary
-                 return {"error": f"AI response blocked by content safety filter ({block_reason}). Try rephrasing query or check context.", "status": "ai_blocked"}, 400
-            else:
-                # Handle other unexpected empty responses
-                logging.warning("Gemini returned an empty or unexpected response structure.")
-                 # Return error dictionary
-                return {"error": "AI model returned an empty or unparseable response.", "status": "ai_error"}, 502
+def get_admission_controller():
+    global admission_controller
+    if admission_controller is None:
+        admission_controller = AdmissionController(MAX_CONCURRENT_REQUESTS, MAX_QUEUED_REQUESTS, QUEUE_TIMEOUT_SECONDS)
+    return admission_controller
 
-        except Exception as e:
-            # Catch potential errors during the API call itself
-            logging.error(f"Error calling Gemini API or processing its response: {e}", exc_info=True)
-            # Return error dictionary
-            return {"error": f"An error occurred communicating with the AI model: {e}", "status": "ai_error"}, 502
 
-    except Exception as e:
-        # Catch-all for unexpected errors in the main RAG flow
-        logging.error(f"Unexpected error in RAG process for query '{original_query}': {e}", exc_info=True)
-        # Return default error dictionary
-        return default_error_response, default_error_code
+def admission_controlled(view):
+    """Route decorator: holds an admission slot for the request, and for a streamed body until it is closed."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        controller = get_admission_controller()
+        if not controller.try_acquire():
+            logging.warning(f"Rejecting request to {request.path}: {controller.active} in progress, {controller.waiting} queued.")
+            metrics.inc("shl_rejected_requests_total", endpoint=request.path)
+            response = json_response({"error": "Server is at capacity. Please retry shortly.", "status": "overloaded"}, 429)
+            response.headers["Retry-After"] = str(OVERLOAD_RETRY_AFTER_SECONDS)
+            return response
+        try:
+            response = app.make_response(view(*args, **kwargs))
+        except Exception:
+            controller.release()
+            raise
+        if response.is_streamed:
+            # SSE/NDJSON bodies do their work while being sent; the WSGI server closes the response when done
+            response.call_on_close(controller.release)
+        else:
+            controller.release()
+        return response
+    return wrapper
 
 
 # --- Flask Routes ---
@@ -473,11 +3651,33 @@ def base_route():
                 "url": f"{APP_BASE_URL}/health",
                 "description": "Check the health and initialization status of the API components."
             },
+            "health_live": {
+                "method": "GET",
+                "url": f"{APP_BASE_URL}/health/live",
+                "description": "Liveness check that answers as soon as the server is listening, even while components initialize."
+            },
             "recommend": {
                 "method": "POST",
                 "url": f"{APP_BASE_URL}/recommend",
                 "description": "Get product recommendations based on a natural language query.",
+                "body_example": {"query": "assessment for collaborative software engineers", "expand": "auto", "mode": "llm"}
+            },
+            "recommend_stream": {
+                "method": "POST",
+                "url": f"{APP_BASE_URL}/recommend/stream",
+                "description": "Server-Sent Events variant of /recommend: emits retrieved candidates first, then the final recommendations.",
                 "body_example": {"query": "assessment for collaborative software engineers"}
+            },
+            "recommend_batch": {
+                "method": "POST",
+                "url": f"{APP_BASE_URL}/recommend/batch",
+                "description": "Recommendations for many queries at once, streamed back as NDJSON (one line per query, in completion order).",
+                "body_example": {"queries": ["java developer", "sales manager personality test"], "expand": "auto"}
+            },
+            "metrics": {
+                "method": "GET",
+                "url": f"{APP_BASE_URL}/metrics",
+                "description": "Prometheus metrics: per-stage latency histograms, request counts, retries, LLM blocks and cache statistics."
             }
         },
         "version": "1.0.0" # Optional: Add an API version
@@ -493,11 +3693,11 @@ def base_route():
             response_data["message"] = "SHL Recommendation API is running, but backend components are still initializing. Functionality may be limited."
             status_code = 503 # Service Unavailable as it's not ready
 
-    return pretty_json_response(response_data, status_code)
+    return json_response(response_data, status_code)
 
 
-@app.route('/recommend', methods=['POST'])
-def recommend_assessments():
+def initialization_pending_response():
+    """Starts initialization if needed; returns a 503 response while the backend is not ready, otherwise None."""
     # Start initialization only if needed and not already running/finished
     if not initialization_complete and (initialization_thread is None or not initialization_thread.is_alive()):
         start_initialization()
@@ -505,43 +3705,288 @@ def recommend_assessments():
     # Check status *after* potentially starting initialization
     if not initialization_complete:
         if initialization_error_message:
-            # Use the pretty_json_response helper
-            return pretty_json_response({"error": initialization_error_message, "status": "unavailable"}, 503)
+            # Use the json_response helper
+            return json_response({"error": initialization_error_message, "status": "unavailable"}, 503)
         else:
             # Still initializing
-            return pretty_json_response({"error": "Server is initializing. Please try again shortly.", "status": "initializing"}, 503)
+            return json_response({"error": "Server is initializing. Please try again shortly.", "status": "initializing"}, 503)
+    return None
 
-    start_time = time.time()
-    request_id = os.urandom(4).hex() # Simple request ID for logging correlation
-    logging.info(f"[Req ID: {request_id}] Received request on /recommend endpoint.")
 
+def parse_recommend_request(request_id):
+    """Validates a recommendation request body. Returns (options dict, None) or (None, error response)."""
     if not request.is_json:
         logging.warning(f"[Req ID: {request_id}] Request content type is not application/json.")
-        return pretty_json_response({"error": "Request must be JSON.", "status": "bad_request"}, 415) # Use 415 Unsupported Media Type
+        return None, json_response({"error": "Request must be JSON.", "status": "bad_request"}, 415) # Use 415 Unsupported Media Type
 
-    data = request.json
-    if not data or 'query' not in data:
+    options, error = validate_recommend_body(request.json, request.args, request_id)
+    if error:
+        return None, json_response(*error)
+    return options, None
+
+
+def parse_pipeline_options(data, request_id):
+    """Validates the optional pipeline settings shared by the recommend endpoints. Returns (options dict, None) or (None, error response)."""
+    options, error = validate_pipeline_options(data, request.args, request_id)
+    if error:
+        return None, json_response(*error)
+    return options, None
+
+
+def validate_recommend_body(data, query_args, request_id):
+    """Validates a parsed /recommend body (shared with asgi.py). Returns (options dict, None) or (None, (error dict, status_code))."""
+    if not data or not isinstance(data, dict) or 'query' not in data:
         logging.warning(f"[Req ID: {request_id}] Request JSON missing 'query' parameter.")
-        return pretty_json_response({"error": "Missing 'query' in JSON request body.", "status": "bad_request"}, 400)
+        return None, ({"error": "Missing 'query' in JSON request body.", "status": "bad_request"}, 400)
 
     original_query = data['query']
 
     # Basic validation of the query itself
     if not isinstance(original_query, str) or not original_query.strip():
          logging.warning(f"[Req ID: {request_id}] Invalid 'query' provided (not a non-empty string).")
-         return pretty_json_response({"error": "'query' must be a non-empty string.", "status": "bad_request"}, 400)
+         return None, ({"error": "'query' must be a non-empty string.", "status": "bad_request"}, 400)
+
+    options, error = validate_pipeline_options(data, query_args, request_id)
+    if error:
+        return None, error
+    options["query"] = original_query
+    return options, None
+
+
+def validate_pipeline_options(data, query_args, request_id):
+    """Validates expand/mode/filters/timings from a request body (and ?timings=1). Returns (options dict, None) or (None, (error dict, status_code))."""
+    expand = data.get('expand')
+    if expand is not None and parse_expand_option(expand) is None:
+        logging.warning(f"[Req ID: {request_id}] Invalid 'expand' option provided: {expand!r}")
+        return None, ({"error": "'expand' must be true, false or \"auto\".", "status": "bad_request"}, 400)
+
+    mode = data.get('mode')
+    if mode is not None and parse_mode_option(mode) is None:
+        logging.warning(f"[Req ID: {request_id}] Invalid 'mode' option provided: {mode!r}")
+        return None, ({"error": "'mode' must be \"llm\" or \"fast\".", "status": "bad_request"}, 400)
+
+    filters, filters_error = parse_filters_option(data.get('filters'))
+    if filters_error:
+        logging.warning(f"[Req ID: {request_id}] Invalid 'filters' option provided: {data.get('filters')!r}")
+        return None, ({"error": filters_error, "status": "bad_request"}, 400)
+
+    extract_filters = data.get('extract_filters')
+    if extract_filters is not None and not isinstance(extract_filters, bool):
+        logging.warning(f"[Req ID: {request_id}] Invalid 'extract_filters' option provided: {extract_filters!r}")
+        return None, ({"error": "'extract_filters' must be true or false.", "status": "bad_request"}, 400)
+
+    # Per-stage timings in the response: {"timings": true} in the body or ?timings=1
+    timings = data.get('timings', False)
+    if not isinstance(timings, bool):
+        logging.warning(f"[Req ID: {request_id}] Invalid 'timings' option provided: {timings!r}")
+        return None, ({"error": "'timings' must be true or false.", "status": "bad_request"}, 400)
+    timings = timings or query_args.get('timings', '').lower() in ("1", "true")
+
+    return {"expand": expand, "mode": mode, "filters": filters, "extract_filters": extract_filters, "timings": timings}, None
+
+
+@app.route('/recommend', methods=['POST'])
+@admission_controlled
+def recommend_assessments():
+    pending = initialization_pending_response()
+    if pending:
+        return pending
+
+    start_time = time.time()
+    request_id = os.urandom(4).hex() # Simple request ID for logging correlation
+    logging.info(f"[Req ID: {request_id}] Received request on /recommend endpoint.")
+
+    options, error_response = parse_recommend_request(request_id)
+    if error_response:
+        return error_response
+    original_query = options["query"]
 
     logging.info(f"[Req ID: {request_id}] Processing original query: '{original_query[:100]}...'")
 
-    # Call the backend function which now returns (dict, status_code)
-    result_data, status_code = get_product_recommendation_backend_robust(original_query)
+    # Call the backend function (through the response cache) which returns (dict, status_code)
+    with request_trace() as trace:
+        result_data, status_code = get_product_recommendation_cached(original_query, expand=options["expand"], mode=options["mode"],
+                                                                       filters=options["filters"], extract_filters=options["extract_filters"])
+    if options["timings"]:
+        result_data = dict(result_data, timings=trace.to_dict())
 
     end_time = time.time()
     processing_time = end_time - start_time
     logging.info(f"[Req ID: {request_id}] Request processed in {processing_time:.2f} seconds. Status code: {status_code}. Result status: {result_data.get('status', 'N/A')}")
 
-    # Use the pretty_json_response helper for consistent output
-    return pretty_json_response(result_data, status_code)
+    # Use the json_response helper for consistent output
+    return json_response(result_data, status_code)
+
+
+@app.route('/recommend/stream', methods=['POST'])
+@admission_controlled
+def recommend_assessments_stream():
+    """Server-Sent Events variant of /recommend: candidates first, then the final recommendations."""
+    pending = initialization_pending_response()
+    if pending:
+        return pending
+
+    request_id = os.urandom(4).hex()
+    logging.info(f"[Req ID: {request_id}] Received request on /recommend/stream endpoint.")
+
+    options, error_response = parse_recommend_request(request_id)
+    if error_response:
+        return error_response
+    original_query = options["query"]
+
+    not_ready = check_pipeline_ready(original_query)
+    if not_ready:
+        return json_response(*not_ready)
+
+    logging.info(f"[Req ID: {request_id}] Streaming recommendations for query: '{original_query[:100]}...'")
+    return Response(
+        stream_with_context(stream_product_recommendations(original_query, expand=options["expand"], mode=options["mode"], timings=options["timings"],
+                                                          filters=options["filters"], extract_filters=options["extract_filters"])),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"} # Stop proxies from buffering the stream
+    )
+
+
+@app.route('/recommend/batch', methods=['POST'])
+@admission_controlled
+def recommend_assessments_batch():
+    """Batch variant of /recommend. Streams one NDJSON line per query as results complete."""
+    pending = initialization_pending_response()
+    if pending:
+        return pending
+
+    request_id = os.urandom(4).hex()
+    logging.info(f"[Req ID: {request_id}] Received request on /recommend/batch endpoint.")
+
+    if not request.is_json:
+        logging.warning(f"[Req ID: {request_id}] Request content type is not application/json.")
+        return json_response({"error": "Request must be JSON.", "status": "bad_request"}, 415)
+
+    data = request.json
+    queries = data.get('queries') if isinstance(data, dict) else None
+    if not isinstance(queries, list) or not queries:
+        logging.warning(f"[Req ID: {request_id}] Request JSON missing a non-empty 'queries' list.")
+        return json_response({"error": "'queries' must be a non-empty list of strings.", "status": "bad_request"}, 400)
+    if len(queries) > BATCH_MAX_QUERIES:
+        logging.warning(f"[Req ID: {request_id}] Batch of {len(queries)} queries exceeds the limit of {BATCH_MAX_QUERIES}.")
+        return json_response({"error": f"At most {BATCH_MAX_QUERIES} queries are allowed per batch.", "status": "bad_request"}, 413)
+
+    options, error_response = parse_pipeline_options(data, request_id)
+    if error_response:
+        return error_response
+
+    def generate_lines():
+        start_time = time.time()
+        completed = 0
+        for index, result_data, status_code in get_product_recommendations_batch(queries, expand=options["expand"], mode=options["mode"],
+                                                                                   filters=options["filters"], extract_filters=options["extract_filters"]):
+            completed += 1
+            yield ndjson_line({"index": index, "query": queries[index], "status_code": status_code}, result_data)
+        logging.info(f"[Req ID: {request_id}] Batch of {completed} queries processed in {time.time() - start_time:.2f} seconds.")
+
+    return Response(stream_with_context(generate_lines()), mimetype='application/x-ndjson')
+
+
+def admin_auth_error():
+    """Returns an error response unless the request carries the configured admin key, otherwise None."""
+    if not ADMIN_API_KEY:
+        return json_response({"error": "Admin endpoints are disabled (ADMIN_API_KEY not set).", "status": "forbidden"}, 403)
+    provided_key = request.headers.get("X-Admin-Key", "")
+    if not hmac.compare_digest(provided_key, ADMIN_API_KEY):
+        return json_response({"error": "Invalid or missing admin key.", "status": "unauthorized"}, 401)
+    return None
+
+
+@app.route('/admin/ingest', methods=['POST'])
+def admin_ingest():
+    """Starts a background catalogue ingestion from a JSON body {"products": [...], "dry_run": false} or NDJSON lines."""
+    auth_error = admin_auth_error()
+    if auth_error:
+        return auth_error
+    pending = initialization_pending_response()
+    if pending:
+        return pending
+
+    dry_run = request.args.get("dry_run", "false").lower() == "true"
+    try:
+        if request.mimetype in ("application/x-ndjson", "application/jsonl"):
+            records = [json.loads(line) for line in request.get_data(as_text=True).splitlines() if line.strip()]
+        else:
+            data = request.get_json(silent=True)
+            records = data.get("products") if isinstance(data, dict) else data
+            dry_run = dry_run or (isinstance(data, dict) and data.get("dry_run") is True)
+    except json.JSONDecodeError as e:
+        return json_response({"error": f"Invalid NDJSON body: {e}", "status": "bad_request"}, 400)
+    if not isinstance(records, list) or not records:
+        return json_response({"error": "Body must contain a non-empty 'products' list.", "status": "bad_request"}, 400)
+
+    if not start_ingestion_job(records, dry_run=dry_run):
+        return json_response({"error": "An ingestion job is already running.", "status": "conflict", "job": ingestion_status}, 409)
+    return json_response({"status": "accepted", "message": f"Ingestion of {len(records)} records started.", "job": ingestion_status}, 202)
+
+
+@app.route('/admin/ingest/status', methods=['GET'])
+def admin_ingest_status():
+    auth_error = admin_auth_error()
+    if auth_error:
+        return auth_error
+    return json_response({"status": "ok", "job": ingestion_status}, 200)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    started = getattr(g, "request_started", None)
+    if started is not None and request.url_rule is not None:
+        endpoint = request.url_rule.rule
+        metrics.observe("shl_request_duration_seconds", time.perf_counter() - started, endpoint=endpoint)
+        metrics.inc("shl_requests_total", endpoint=endpoint, status_code=str(response.status_code))
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus scrape endpoint: stage/request latency histograms, pipeline counters and cache statistics."""
+    if not METRICS_ENABLED:
+        return json_response({"error": "Metrics are disabled (METRICS_ENABLED=false).", "status": "not_found"}, 404)
+    gauges = []
+    cache = get_response_cache()
+    if cache is not None:
+        cache_stats = cache.stats()
+        gauges.extend([
+            ("shl_response_cache_hits_total", "Response cache hits, by lookup kind.", cache_stats["exact_hits"], {"kind": "exact"}),
+            ("shl_response_cache_hits_total", "Response cache hits, by lookup kind.", cache_stats["semantic_hits"], {"kind": "semantic"}),
+            ("shl_response_cache_misses_total", "Response cache lookups that missed.", cache_stats["misses"], {}),
+            ("shl_response_cache_evictions_total", "Response cache LRU evictions.", cache_stats["evictions"], {}),
+            ("shl_response_cache_entries", "Live response cache entries.", cache_stats["entries"], {})
+        ])
+    expansion_stats = get_expansion_cache().stats()
+    gauges.extend([
+        ("shl_expansion_cache_hits_total", "Query expansion cache hits.", expansion_stats["hits"], {}),
+        ("shl_expansion_cache_misses_total", "Query expansion cache misses.", expansion_stats["misses"], {}),
+        ("shl_local_index_size", "Products in the local vector index.", len(vector_index) if vector_index is not None else 0, {}),
+        ("shl_initialization_complete", "1 once the retrieval pipeline can serve requests.", int(initialization_complete), {})
+    ])
+    admission_stats = get_admission_controller().stats()
+    gauges.extend([
+        ("shl_requests_in_progress", "Admitted recommendation requests still running.", admission_stats["active"], {}),
+        ("shl_requests_queued", "Recommendation requests waiting for an admission slot.", admission_stats["waiting"], {})
+    ])
+    for breaker in (supabase_breaker, gemini_breaker):
+        gauges.append(("shl_circuit_open", "1 while the dependency's circuit breaker is open or half-open.", int(breaker.state != "closed"), {"dependency": breaker.name}))
+    for component, seconds in list(import_timings.items()):
+        gauges.append(("shl_import_seconds", "Time taken to import the backend module and each lazily imported library.", seconds, {"component": component}))
+    return Response(metrics.render(gauges), status=200, mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.route('/health/live', methods=['GET'])
+def liveness_check():
+    """Answers as soon as the process serves HTTP, without touching any component. /health reports readiness."""
+    return json_response({"status": "alive", "initialization_complete": initialization_complete, "pid": os.getpid()})
 
 
 @app.route('/health', methods=['GET'])
@@ -550,7 +3995,7 @@ def health_check():
     if not initialization_complete and (initialization_thread is None or not initialization_thread.is_alive()):
         start_initialization()
 
-    status_code = 503 # Default to unhealthy/initializing
+    status_code = 503 # Default to unhealthy/initializing: this is the readiness check, liveness probes use /health/live
     response_data = {
         "status": "initializing",
         "message": "Server components are currently initializing.",
@@ -563,17 +4008,42 @@ def health_check():
             "gen_model_ready": gen_model is not None
         }
     }
+    response_data["retrieval"] = {
+        "mode": RETRIEVAL_MODE,
+        "local_index_ready": vector_index is not None and vector_index.ready,
+        "local_index_size": len(vector_index) if vector_index is not None else 0,
+        "local_index_age_seconds": round(time.time() - vector_index.loaded_at, 1) if vector_index is not None and vector_index.loaded_at else None,
+        "embedding_backend": getattr(embed_model, "backend", "torch") if embed_model is not None else None
+    }
+    cache = get_response_cache()
+    response_data["response_cache"] = cache.stats() if cache is not None else {"enabled": False}
+    response_data["expansion_cache"] = dict(get_expansion_cache().stats(), mode=QUERY_EXPANSION_MODE)
+    coalescer = get_request_coalescer()
+    response_data["request_coalescing"] = coalescer.stats() if coalescer is not None else {"enabled": False}
+    response_data["circuit_breakers"] = {breaker.name: breaker.stats() for breaker in (supabase_breaker, gemini_breaker)}
+
+    response_data["initialization_stages"] = dict(initialization_stages)
+    response_data["import_timings"] = dict(import_timings)
+    response_data["serving"] = dict(get_admission_controller().stats(), pid=os.getpid())
 
     if initialization_error_message:
         status_code = 503
         response_data["status"] = "unhealthy"
         response_data["message"] = f"Initialization failed: {initialization_error_message}"
     elif initialization_complete:
-        # All components should be ready if initialization_complete is True
-        if supabase_client and embed_model and gen_model:
+        # Retrieval components must be ready if initialization_complete is True; Gemini may still be missing
+        if embed_model and (supabase_client or (vector_index is not None and vector_index.ready)):
             status_code = 200
-            response_data["status"] = "healthy"
-            response_data["message"] = "All components initialized successfully."
+            open_breakers = [name for name, breaker in response_data["circuit_breakers"].items() if breaker["state"] != "closed"]
+            if gen_model and open_breakers:
+                response_data["status"] = "degraded"
+                response_data["message"] = f"Circuit breaker open for {', '.join(open_breakers)}; failing fast to cached, local-index and LLM-free results."
+            elif gen_model:
+                response_data["status"] = "healthy"
+                response_data["message"] = "All components initialized successfully."
+            else:
+                response_data["status"] = "degraded"
+                response_data["message"] = f"Serving retrieval with LLM-free ranking; Gemini is {'unavailable: ' + gemini_error_message.rstrip('.') if gemini_error_message else 'still initializing'}."
         else:
              # This case indicates a potential logic error in initialization reporting
              status_code = 500
@@ -587,11 +4057,11 @@ def health_check():
     response_data["components"]["gen_model_ready"] = gen_model is not None
 
 
-    return pretty_json_response(response_data, status_code)
+    return json_response(response_data, status_code)
 
 
 # --- Run Flask App ---
-if __name__ == '__main__':
+def run_server():
     # Start initialization in background immediately when script runs directly
     start_initialization()
 
@@ -602,5 +4072,49 @@ if __name__ == '__main__':
     # Set debug=False for production-like behavior even in direct run (Gunicorn ignores this).
     # Consider using Waitress or another production-grade server if not using Gunicorn.
     logging.info(f"Starting Flask development server on host 0.0.0.0 port {port}")
-    logging.warning("Running with Flask's development server. Use Gunicorn or another WSGI server for production.")
+    logging.warning("Running with Flask's development server. For production use `gunicorn -c gunicorn.conf.py backend:app`.")
     app.run(debug=False, host='0.0.0.0', port=port)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SHL recommendation backend.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("serve", help="Run the API server (default).")
+    snapshot_parser = subparsers.add_parser("build-snapshot", help="Build the warm-start artifact (model weights + catalogue embeddings).")
+    snapshot_parser.add_argument("--output-dir", default=WARM_START_DIR, help=f"Artifact directory (default: {WARM_START_DIR}).")
+    onnx_parser = subparsers.add_parser("export-onnx", help="Export the embedding model to ONNX (fp32 and dynamically quantized int8).")
+    onnx_parser.add_argument("--output-dir", default=ONNX_MODEL_DIR, help=f"ONNX model directory (default: {ONNX_MODEL_DIR}).")
+    check_parser = subparsers.add_parser("check-embeddings", help="Parity check and microbenchmark of an embedding backend against torch.")
+    check_parser.add_argument("--backend", default="onnx-int8", choices=["torch", "onnx", "onnx-int8"])
+    check_parser.add_argument("--iterations", type=int, default=50)
+    ingest_parser = subparsers.add_parser("ingest", help="Upsert a product file into Supabase, re-embedding only changed rows.")
+    ingest_parser.add_argument("path", help="Product records as a JSON array, {\"products\": [...]} or JSON Lines (.jsonl/.ndjson).")
+    ingest_parser.add_argument("--encode-batch-size", type=int, default=INGEST_ENCODE_BATCH_SIZE)
+    ingest_parser.add_argument("--upsert-chunk-size", type=int, default=INGEST_UPSERT_CHUNK_SIZE)
+    ingest_parser.add_argument("--dry-run", action="store_true", help="Compute what would change without writing.")
+    args = parser.parse_args(argv)
+
+    if args.command == "build-snapshot":
+        build_warm_start_artifact(args.output_dir)
+        return 0
+    if args.command == "export-onnx":
+        export_onnx_embedding_model(args.output_dir)
+        return 0
+    if args.command == "check-embeddings":
+        return 0 if check_embedding_backend(args.backend, args.iterations) else 1
+    if args.command == "ingest":
+        _init_supabase()
+        _init_embedding_model()
+        stats = ingest_products(iter_product_records(args.path), args.encode_batch_size, args.upsert_chunk_size, args.dry_run)
+        print(json.dumps(stats, indent=2))
+        return 0
+    run_server()
+    return 0
+
+
+import_timings["backend"] = round(time.perf_counter() - _import_started, 3)
+logging.info(f"Imported backend in {import_timings['backend']:.2f} seconds; heavy libraries load in the initialization stages.")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,578 @@
+# -*- coding: utf-8 -*-
+"""Offline benchmark and load test for backend.py.
+
+Runs the real Flask app in-process against local stand-ins for Supabase and Gemini (configurable latency,
+failure and block rates), a synthetic catalogue and a synthetic query corpus, so throughput and latency can
+be measured on any Linux box without network access or API keys:
+
+    python benchmark.py                                  # every scenario, default settings
+    python benchmark.py --scenarios fast-local,llm-local --concurrency 16 --requests 500
+    python benchmark.py --json results.json --max-p95-ms 1500   # CI: exit 1 if any scenario's p95 is above 1.5s
+
+Pass --url to drive an already running server instead; the stand-ins then do not apply.
+"""
+import argparse
+import json
+import logging
+import math
+import random
+import re
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import numpy as np
+
+import backend
+
+
+# --- Scenarios ---
+SCENARIOS = {
+    "fast-local": {"endpoint": "/recommend", "retrieval": "local", "mode": "fast", "expand": False},
+    "llm-local": {"endpoint": "/recommend", "retrieval": "local", "mode": "llm", "expand": False},
+    "llm-local-auto": {"endpoint": "/recommend", "retrieval": "local", "mode": "llm", "expand": "auto"},
+    "llm-local-expand": {"endpoint": "/recommend", "retrieval": "local", "mode": "llm", "expand": True},
+    "llm-rpc-expand": {"endpoint": "/recommend", "retrieval": "rpc", "mode": "llm", "expand": True},
+    "stream-llm-local": {"endpoint": "/recommend/stream", "retrieval": "local", "mode": "llm", "expand": "auto"},
+    "batch-fast-local": {"endpoint": "/recommend/batch", "retrieval": "local", "mode": "fast", "expand": False},
+}
+
+# --- Synthetic Catalogue and Queries ---
+SKILLS = ["Java", "Python", "SQL", ".NET", "JavaScript", "Excel", "numerical reasoning", "verbal reasoning",
+          "inductive reasoning", "personality", "situational judgement", "leadership", "teamwork", "communication",
+          "customer service", "sales", "attention to detail", "cognitive ability", "typing", "data entry"]
+ROLES = ["Java developer", "Python developer", "data analyst", "sales manager", "customer service agent", "accountant",
+         "project manager", "graduate trainee", "call centre agent", "software tester", "HR business partner",
+         "bank cashier", "store manager", "nurse", "administrative assistant", "team leader"]
+PRODUCT_TYPES = ["Knowledge & Skills", "Personality & Behavior", "Ability & Aptitude", "Simulations",
+                 "Biodata & Situational Judgement", "Competencies", "Development & 360"]
+NAME_SUFFIXES = ["Test", "Assessment", "Simulation", "(New)", "Short Form", "Interactive"]
+QUERY_TEMPLATES = [
+    "{skill}",
+    "{skill} test for a {role}",
+    "assessment for a {role}",
+    "I am hiring a {role} and need to check {skill} and {skill2}",
+    "We are recruiting graduate {role}s and want an assessment of {skill}, {skill2} and general problem solving that takes under {duration} minutes",
+]
+
+
+def build_catalogue(size, rng):
+    """Synthetic product rows shaped like the products table (without embeddings)."""
+    products = []
+    for i in range(size):
+        skill = SKILLS[i % len(SKILLS)]
+        role = ROLES[(i * 7) % len(ROLES)]
+        product_type = PRODUCT_TYPES[(i * 3) % len(PRODUCT_TYPES)]
+        name = f"{skill} {NAME_SUFFIXES[(i // len(SKILLS)) % len(NAME_SUFFIXES)]}"
+        if i >= len(SKILLS) * len(NAME_SUFFIXES):
+            name = f"{name} v{i // (len(SKILLS) * len(NAME_SUFFIXES)) + 1}"
+        products.append({
+            "product_id": f"bench-{i:05d}",
+            "product_name": name,
+            "url": f"https://example.com/products/bench-{i:05d}/",
+            "description": f"Measures {skill} for candidates applying as {role}. Suitable for screening and selection.",
+            "product_type": [product_type],
+            "job_roles": [role, rng.choice(ROLES)],
+            "measured_constructs": [skill, rng.choice(SKILLS)],
+            "duration_minutes": rng.choice([None, 5, 10, 15, 20, 25, 30, 45, 60]),
+            "remote_testing": rng.random() < 0.9,
+            "adaptive_irt": rng.random() < 0.4,
+        })
+    return products
+
+
+def build_queries(count, rng):
+    queries = []
+    for _ in range(count):
+        skill, skill2 = rng.sample(SKILLS, 2)
+        template = rng.choice(QUERY_TEMPLATES)
+        queries.append(template.format(skill=skill, skill2=skill2, role=rng.choice(ROLES), duration=rng.choice([20, 30, 45])))
+    return queries
+
+
+# --- Local Stand-ins ---
+class HashingEncoder:
+    """Deterministic bag-of-words feature-hashing encoder with the SentenceTransformer encode() interface.
+
+    Costs microseconds per text, so the benchmark measures the pipeline rather than the model; use
+    --embedding model to include the configured embedding backend.
+    """
+
+    def __init__(self, dimension=backend.EXPECTED_EMBEDDING_DIMENSION):
+        self.dimension = dimension
+        self.backend = "hashing" # Reported as the embedding backend on /health
+
+    def get_sentence_embedding_dimension(self):
+        return self.dimension
+
+    def _encode_one(self, text):
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        for token in re.findall(r"[a-z0-9]+", text.lower()):
+            digest = hash_token(token)
+            vector[digest % self.dimension] += 1.0 if (digest >> 16) & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def encode(self, sentences, batch_size=32, **kwargs):
+        if isinstance(sentences, str):
+            return self._encode_one(sentences)
+        return np.stack([self._encode_one(text) for text in sentences]) if sentences else np.zeros((0, self.dimension), dtype=np.float32)
+
+
+def hash_token(token):
+    # Stable across processes, unlike hash()
+    value = 2166136261
+    for byte in token.encode("utf-8"):
+        value = ((value ^ byte) * 16777619) & 0xFFFFFFFF
+    return value
+
+
+class FaultInjector:
+    """Samples latency (base + uniform jitter) and injected failures for one fake service."""
+
+    def __init__(self, latency_ms, jitter_ms, failure_rate, seed):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample(self):
+        """Returns (delay_seconds, fail)."""
+        with self._lock:
+            delay = (self.latency_ms + self._rng.uniform(0, self.jitter_ms)) / 1000.0
+            return delay, self._rng.random() < self.failure_rate
+
+    def chance(self, rate):
+        with self._lock:
+            return self._rng.random() < rate
+
+
+class _FakeResult:
+    def __init__(self, data):
+        self.data = data
+
+
+class _FakeRpcCall:
+    def __init__(self, client, params):
+        self._client = client
+        self._params = params
+
+    def execute(self):
+        delay, fail = self._client.faults.sample()
+        time.sleep(delay)
+        if fail:
+            raise ConnectionError("Injected Supabase RPC failure.")
+        query = np.asarray(self._params["query_embedding"], dtype=np.float32)
+        norm = np.linalg.norm(query)
+        similarities = self._client.matrix @ (query / norm if norm else query)
+        order = np.argsort(-similarities)[:self._params["match_count"]]
+        return _FakeResult([dict(self._client.rows[idx], similarity=float(similarities[idx]))
+                            for idx in order if similarities[idx] > self._params["match_threshold"]])
+
+
+class _FakeTableQuery:
+    def __init__(self, rows):
+        self._rows = rows
+        self._range = (0, len(rows) - 1)
+
+    def select(self, columns="*"):
+        return self
+
+    def range(self, start, end):
+        self._range = (start, end)
+        return self
+
+    def execute(self):
+        return _FakeResult(self._rows[self._range[0]:self._range[1] + 1])
+
+
+class FakeSupabaseClient:
+    """Serves match_products from an in-memory matrix and the products table from the same rows."""
+
+    def __init__(self, rows, embeddings, faults):
+        self.rows = rows
+        self.matrix = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        self.faults = faults
+        self._table_rows = [dict(row, **{backend.DB_EMBEDDING_COLUMN: embedding.tolist()}) for row, embedding in zip(rows, embeddings)]
+
+    def rpc(self, name, params):
+        if name != backend.DB_FUNCTION_NAME:
+            raise ValueError(f"Unknown RPC {name!r}.")
+        return _FakeRpcCall(self, params)
+
+    def table(self, name):
+        return _FakeTableQuery(self._table_rows)
+
+
+class _FakeFeedback:
+    def __init__(self, block_reason=None):
+        self.block_reason = block_reason
+
+
+class _FakeGeminiResponse:
+    def __init__(self, text, block_reason=None):
+        self.text = text
+        self.parts = [text] if text else []
+        self.prompt_feedback = _FakeFeedback(block_reason)
+
+
+class _FakeGeminiStream:
+    def __init__(self, text, chunk_delay, chunk_size=80):
+        self.prompt_feedback = _FakeFeedback()
+        self._chunks = [text[pos:pos + chunk_size] for pos in range(0, len(text), chunk_size)]
+        self._chunk_delay = chunk_delay
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            time.sleep(self._chunk_delay)
+            yield _FakeGeminiResponse(chunk)
+
+
+class FakeGenerationConfig:
+    """genai.types.GenerationConfig stand-in that keeps its settings as attributes."""
+
+    def __init__(self, **settings):
+        self.__dict__.update(settings)
+
+
+# Stand-in for the google.generativeai module, which backend imports only in _init_gemini
+FAKE_GENAI = SimpleNamespace(types=SimpleNamespace(GenerationConfig=FakeGenerationConfig))
+
+
+class FakeGeminiModel:
+    """generate_content stand-in: keyword lists for expansion prompts, the top candidates (as refs or JSON) for generation prompts."""
+
+    def __init__(self, expansion_faults, generation_faults, block_rate, malformed_rate):
+        self.expansion_faults = expansion_faults
+        self.generation_faults = generation_faults
+        self.block_rate = block_rate
+        self.malformed_rate = malformed_rate
+
+    def generate_content(self, prompt, generation_config=None, stream=False, request_options=None, **kwargs):
+        is_expansion = "Keywords only" in prompt
+        faults = self.expansion_faults if is_expansion else self.generation_faults
+        delay, fail = faults.sample()
+        if fail:
+            time.sleep(delay)
+            raise RuntimeError("Injected Gemini failure.")
+        if faults.chance(self.block_rate):
+            time.sleep(delay)
+            return _FakeGeminiResponse("", block_reason="SAFETY")
+
+        if is_expansion:
+            text = ", ".join(random.Random(prompt).sample(SKILLS, 4))
+        else:
+            text = self._answer(prompt, faults)
+        if stream:
+            chunks = max(1, math.ceil(len(text) / 80))
+            return _FakeGeminiStream(text, delay / chunks)
+        time.sleep(delay)
+        return _FakeGeminiResponse(text)
+
+    def _answer(self, prompt, faults):
+        text = self._well_formed_answer(prompt)
+        if faults.chance(self.malformed_rate):
+            # Cut off mid-answer; the backend repairs what it can
+            return text[:random.Random(prompt).randint(1, len(text) - 1)]
+        return text
+
+    def _well_formed_answer(self, prompt):
+        refs = re.findall(r"^(\d+)\|", prompt, re.M)
+        if refs:
+            # Compact prompt: answer with candidate refs only
+            return json.dumps({"recommended": [int(ref) for ref in refs[:backend.MAX_FINAL_RECOMMENDATIONS]]})
+        candidates = []
+        context = re.search(r"```json\s*(.*?)```", prompt, re.S)
+        if context:
+            try:
+                candidates = json.loads(context.group(1))
+            except json.JSONDecodeError:
+                candidates = []
+        picks = [backend.format_assessment(candidate) for candidate in candidates[:backend.MAX_FINAL_RECOMMENDATIONS]]
+        return json.dumps({"recommended_assessments": picks}, ensure_ascii=False)
+
+
+def install_stand_ins(args):
+    """Points the backend at the fake clients and a freshly built catalogue, as if initialization had finished."""
+    rng = random.Random(args.seed)
+    if args.embedding == "model":
+        logging.info(f"Loading embedding backend '{backend.EMBEDDING_BACKEND}'...")
+        encoder = backend.load_embedding_model(backend.EMBEDDING_BACKEND)
+    else:
+        encoder = HashingEncoder()
+    rows = build_catalogue(args.catalogue_size, rng)
+    embeddings = np.asarray(encoder.encode([backend.get_embedding_text(row) for row in rows], batch_size=backend.INGEST_ENCODE_BATCH_SIZE), dtype=np.float32)
+
+    backend.supabase_client = FakeSupabaseClient(rows, embeddings, FaultInjector(args.rpc_latency_ms, args.rpc_jitter_ms, args.rpc_failure_rate, args.seed))
+    backend.embed_model = encoder
+    backend.genai = FAKE_GENAI
+    backend.gen_model = FakeGeminiModel(
+        FaultInjector(args.expansion_latency_ms, args.llm_jitter_ms, args.llm_failure_rate, args.seed + 1),
+        FaultInjector(args.generation_latency_ms, args.llm_jitter_ms, args.llm_failure_rate, args.seed + 2),
+        args.llm_block_rate, args.llm_malformed_rate)
+    backend.vector_index = backend.LocalVectorIndex()
+    backend.vector_index.load_matrix(embeddings.copy(), rows)
+    backend.DB_MATCH_THRESHOLD = args.match_threshold
+    backend.RESPONSE_CACHE_ENABLED = args.response_cache
+    backend.initialization_complete = True
+    return build_queries(args.query_corpus_size, rng)
+
+
+def reset_backend_caches(scenario):
+    backend.RETRIEVAL_MODE = scenario["retrieval"]
+    backend.response_cache = None
+    backend.expansion_cache = None
+
+
+def start_local_server():
+    """Serves backend.app on an ephemeral localhost port from a daemon thread. Returns (base_url, server)."""
+    from werkzeug.serving import make_server
+    server = make_server("127.0.0.1", 0, backend.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True, name="benchmark-server").start()
+    return f"http://127.0.0.1:{server.server_port}", server
+
+
+# --- Load Driver ---
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+# Ranking modes a scenario's answers may report; 'direct' is the adaptive retrieval early exit (no generation needed)
+EXPECTED_RANKING_MODES = {"llm": ("llm", "direct"), "fast": ("fast",)}
+
+
+def answer_problem(scenario, result):
+    """Why a 200 result is not a proper answer for the scenario (degraded, or ranked in another mode), or None."""
+    metadata = result.get("metadata") if isinstance(result, dict) else None
+    if not isinstance(metadata, dict):
+        return None
+    if metadata.get("degraded"):
+        return f"degraded:{metadata['degraded']}"
+    ranking_mode = (metadata.get("ranking") or {}).get("mode")
+    if ranking_mode is not None and ranking_mode not in EXPECTED_RANKING_MODES[scenario["mode"]]:
+        return f"ranking_mode:{ranking_mode}"
+    return None
+
+
+def send_request(base_url, scenario, queries, timeout):
+    """Sends one request for the scenario.
+
+    Returns (latency_seconds, failure reason or None, status_code, stage timings dict or None, retrieval policy
+    decisions of its queries). A 200 answer that is degraded or ranked in another mode than requested is a failure.
+    """
+    endpoint = scenario["endpoint"]
+    payload = {"mode": scenario["mode"], "expand": scenario["expand"]}
+    if endpoint == "/recommend/batch":
+        payload["queries"] = queries
+    else:
+        payload["query"] = queries[0]
+        payload["timings"] = True
+    request = urllib.request.Request(base_url + endpoint, data=json.dumps(payload).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"}, method="POST")
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            body = response.read()
+            status_code = response.status
+    except urllib.error.HTTPError as e:
+        e.read()
+        return time.perf_counter() - started, f"http_{e.code}", e.code, None, []
+    except Exception as e:
+        return time.perf_counter() - started, type(e).__name__, None, None, []
+    latency = time.perf_counter() - started
+
+    text = body.decode("utf-8")
+    if endpoint == "/recommend/stream":
+        # Success means a 'result' event arrived and the 'done' event (or 'error' in its place) reports 200
+        done = re.search(r"event: (?:done|error)\ndata: (.*)\n", text)
+        done_data = json.loads(done.group(1)) if done else {}
+        result = re.search(r"event: result\ndata: (.*)\n", text)
+        result_data = json.loads(result.group(1)) if result else {}
+        if result is None or done_data.get("status_code") != 200:
+            error = f"stream_{done_data.get('status_code')}"
+        else:
+            error = answer_problem(scenario, result_data)
+        return latency, error, status_code, done_data.get("timings"), retrieval_policies([result_data] if result else [])
+    if endpoint == "/recommend/batch":
+        lines = [json.loads(line) for line in text.splitlines() if line.strip()]
+        results = [line.get("result") or {} for line in lines]
+        error = None
+        if len(lines) != len(queries):
+            error = "batch_incomplete"
+        elif any(line["status_code"] != 200 for line in lines):
+            error = "batch_query_failed"
+        else:
+            error = next(filter(None, (answer_problem(scenario, result) for result in results)), None)
+        return latency, error, status_code, None, retrieval_policies(results)
+    data = json.loads(text)
+    return latency, answer_problem(scenario, data), status_code, data.get("timings"), retrieval_policies([data])
+
+
+def retrieval_policies(results):
+    """Adaptive retrieval decisions reported in response metadata (absent for cache hits and errors)."""
+    return [result["metadata"]["retrieval"]["policy"] for result in results
+            if isinstance(result.get("metadata"), dict) and "retrieval" in result["metadata"]]
+
+
+def run_scenario(base_url, name, scenario, queries, args):
+    rng = random.Random(f"{args.seed}:{name}")
+    per_request = args.batch_size if scenario["endpoint"] == "/recommend/batch" else 1
+    workload = [[rng.choice(queries) for _ in range(per_request)] for _ in range(args.requests)]
+
+    for request_queries in workload[:args.warmup]:
+        send_request(base_url, scenario, request_queries, args.timeout)
+
+    latencies = []
+    failure_reasons = {}
+    status_codes = {}
+    stage_totals = {}
+    policy_counts = {}
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for latency, error, status_code, timings, policies in executor.map(lambda qs: send_request(base_url, scenario, qs, args.timeout), workload):
+            latencies.append(latency)
+            if error:
+                failure_reasons[error] = failure_reasons.get(error, 0) + 1
+            status_codes[str(status_code)] = status_codes.get(str(status_code), 0) + 1
+            for span in (timings or {}).get("spans", []):
+                totals = stage_totals.setdefault(span["stage"], [0.0, 0])
+                totals[0] += span["duration_ms"]
+                totals[1] += 1
+            for policy in policies:
+                policy_counts[policy] = policy_counts.get(policy, 0) + 1
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    to_ms = lambda value: round(value * 1000, 1) if value is not None else None
+    return {
+        "scenario": name,
+        **scenario,
+        "requests": len(workload),
+        "queries_per_request": per_request,
+        "concurrency": args.concurrency,
+        "failures": sum(failure_reasons.values()),
+        "failure_reasons": dict(sorted(failure_reasons.items())),
+        "status_codes": status_codes,
+        "requests_per_second": round(len(workload) / elapsed, 2) if elapsed else None,
+        "queries_per_second": round(len(workload) * per_request / elapsed, 2) if elapsed else None,
+        "p50_ms": to_ms(percentile(latencies, 0.50)),
+        "p95_ms": to_ms(percentile(latencies, 0.95)),
+        "p99_ms": to_ms(percentile(latencies, 0.99)),
+        "max_ms": to_ms(latencies[-1] if latencies else None),
+        # Mean time per occurrence of each traced stage (/recommend and /recommend/stream only)
+        "stage_mean_ms": {stage: round(total / count, 1) for stage, (total, count) in sorted(stage_totals.items())},
+        # Adaptive retrieval decisions (confident / flat / default) over the queries that ran the pipeline
+        "retrieval_policies": dict(sorted(policy_counts.items())),
+    }
+
+
+def print_report(results):
+    columns = ["scenario", "requests", "failures", "requests_per_second", "queries_per_second", "p50_ms", "p95_ms", "p99_ms", "max_ms"]
+    headers = ["scenario", "reqs", "fail", "req/s", "q/s", "p50 ms", "p95 ms", "p99 ms", "max ms"]
+    table = [headers] + [[str(result[column]) for column in columns] for result in results]
+    widths = [max(len(row[idx]) for row in table) for idx in range(len(headers))]
+    for row in table:
+        print("  ".join(cell.ljust(width) if idx == 0 else cell.rjust(width) for idx, (cell, width) in enumerate(zip(row, widths))))
+    for result in results:
+        if result["failure_reasons"]:
+            reasons = ", ".join(f"{reason} {count}" for reason, count in result["failure_reasons"].items())
+            print(f"  {result['scenario']} failures: {reasons}")
+        if result["stage_mean_ms"]:
+            stages = ", ".join(f"{stage} {value}" for stage, value in result["stage_mean_ms"].items())
+            print(f"  {result['scenario']} stage means (ms): {stages}")
+        if result["retrieval_policies"]:
+            policies = ", ".join(f"{policy} {count}" for policy, count in result["retrieval_policies"].items())
+            print(f"  {result['scenario']} retrieval policies: {policies}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark and load test for the SHL recommendation backend.")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"Comma-separated subset of: {', '.join(SCENARIOS)}.")
+    parser.add_argument("--requests", type=int, default=200, help="Measured requests per scenario.")
+    parser.add_argument("--warmup", type=int, default=10, help="Unmeasured requests sent before each scenario.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight at once.")
+    parser.add_argument("--batch-size", type=int, default=20, help="Queries per /recommend/batch request.")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Client timeout per request, seconds.")
+    parser.add_argument("--url", help="Benchmark a running server at this base URL instead of an in-process one with stand-ins.")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--json", dest="json_path", help="Also write the results to this file.")
+    parser.add_argument("--max-p95-ms", type=float, help="Exit with status 1 if any scenario's p95 latency exceeds this.")
+    stand_ins = parser.add_argument_group("stand-ins (ignored with --url)")
+    stand_ins.add_argument("--catalogue-size", type=int, default=500)
+    stand_ins.add_argument("--query-corpus-size", type=int, default=300, help="Distinct synthetic queries to sample from.")
+    stand_ins.add_argument("--embedding", choices=["hashing", "model"], default="hashing",
+                           help="'hashing' (fast, no model download) or 'model' (EMBEDDING_BACKEND).")
+    stand_ins.add_argument("--match-threshold", type=float, default=0.1,
+                           help="DB_MATCH_THRESHOLD override; hashing-encoder similarities run lower than MiniLM's.")
+    stand_ins.add_argument("--response-cache", action="store_true", help="Keep the response cache on (off by default so every request runs the pipeline).")
+    stand_ins.add_argument("--rpc-latency-ms", type=float, default=40.0)
+    stand_ins.add_argument("--rpc-jitter-ms", type=float, default=20.0)
+    stand_ins.add_argument("--rpc-failure-rate", type=float, default=0.0)
+    stand_ins.add_argument("--expansion-latency-ms", type=float, default=400.0)
+    stand_ins.add_argument("--generation-latency-ms", type=float, default=1200.0)
+    stand_ins.add_argument("--llm-jitter-ms", type=float, default=300.0)
+    stand_ins.add_argument("--llm-failure-rate", type=float, default=0.0)
+    stand_ins.add_argument("--llm-block-rate", type=float, default=0.0)
+    stand_ins.add_argument("--llm-malformed-rate", type=float, default=0.0, help="Share of generation answers cut off at a random point (truncated JSON).")
+    stand_ins.add_argument("--log-level", default="WARNING", help="Backend log level while benchmarking.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    names = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        print(f"Unknown scenario(s): {', '.join(unknown)}", file=sys.stderr)
+        return 2
+    logging.getLogger().setLevel(args.log_level.upper())
+    logging.getLogger("werkzeug").setLevel(args.log_level.upper()) # Per-request access log lines
+
+    server = None
+    if args.url:
+        base_url = args.url.rstrip("/")
+        queries = build_queries(args.query_corpus_size, random.Random(args.seed))
+    else:
+        queries = install_stand_ins(args)
+        base_url, server = start_local_server()
+
+    results = []
+    try:
+        for name in names:
+            if server is not None:
+                reset_backend_caches(SCENARIOS[name])
+            results.append(run_scenario(base_url, name, SCENARIOS[name], queries, args))
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    print_report(results)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=2)
+    # Every llm answer could come from the adaptive early exit, but a scenario with no generation at all means
+    # Gemini was never reached (degraded or misconfigured), so its latencies say nothing about the LLM path
+    no_generation = [result["scenario"] for result in results
+                     if result["mode"] == "llm" and result["endpoint"] != "/recommend/batch" and "generation" not in result["stage_mean_ms"]]
+    if no_generation:
+        print(f"No generation span recorded in llm scenario(s): {', '.join(no_generation)}", file=sys.stderr)
+        return 1
+    if args.max_p95_ms is not None:
+        slow = [result["scenario"] for result in results if result["p95_ms"] is None or result["p95_ms"] > args.max_p95_ms]
+        if slow:
+            print(f"p95 latency above {args.max_p95_ms} ms: {', '.join(slow)}", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""Production serving configuration: gunicorn -c gunicorn.conf.py backend:app
+
+The app module is preloaded in the master; importing backend is fast (heavy libraries load in the
+initialization stages), so workers are forked at once and each loads the embedding model, the warm-start
+catalogue and its own Supabase/Gemini clients in the background. Workers use gthread: the pipeline is I/O bound
+(Gemini, Supabase), so one process serves many requests on threads while the admission controller bounds how
+many run at once and answers 429 beyond the queue limit.
+
+Set PRELOAD_SHARED_STATE=true to load the model and catalogue once in the master instead
+(backend.preload_shared_state), so forked workers share them copy-on-write. That saves one model copy per
+worker, but no worker is forked, and nothing answers on the port, until the load finishes.
+"""
+import os
+
+import backend
+
+bind = f"0.0.0.0:{os.getenv('PORT', '7860')}"
+workers = int(os.getenv("WEB_CONCURRENCY", 2))
+worker_class = "gthread"
+# One thread per admitted or queued request, plus headroom so /health, /metrics and 429s are always answered
+threads = backend.MAX_CONCURRENT_REQUESTS + backend.MAX_QUEUED_REQUESTS + 4
+preload_app = True
+preload_shared_state = os.getenv("PRELOAD_SHARED_STATE", "false").lower() == "true" # Opt in: load the model in the master for copy-on-write sharing
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120)) # Must exceed the slowest request (queue wait + generation)
+graceful_timeout = 30
+keepalive = 5
+
+
+def when_ready(server):
+    # Runs in the master after the app is imported and before any worker is forked
+    if preload_shared_state:
+        backend.preload_shared_state()
+
+
+def post_fork(server, worker):
+    backend.start_initialization()
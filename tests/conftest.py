@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for the pure pipeline logic in backend.py; no Supabase, Gemini or embedding model is needed."""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import backend
+
+CANDIDATES = [{"product_id": product_id, "product_name": product_id.title()} for product_id in ("java", "python", "opq", "verbal", "sales")]
+
+
+@pytest.fixture(autouse=True)
+def max_recommendations(monkeypatch):
+    monkeypatch.setattr(backend, "MAX_FINAL_RECOMMENDATIONS", 3)
+
+
+def ids(candidates):
+    return [candidate["product_id"] for candidate in candidates]
+
+
+@pytest.mark.parametrize("refs, expected", [
+    ([1, 3], ["java", "opq"]),
+    ([3, 1], ["opq", "java"]), # Answer order is kept
+    # Out of range: 1-based, so 0 and len + 1 are unknown
+    ([0, 2, 6, -1], ["python"]),
+    ([99], []),
+    # Repeats are dropped, however they are spelled
+    ([2, 2, "2", " python "], ["python"]),
+    # Numeric strings
+    (["1", " 4 "], ["java", "verbal"]),
+    (["1.5", "", "two"], []),
+    # product_ids, mixed with positions
+    (["opq", 1, "sales"], ["opq", "java", "sales"]),
+    (["opq", 3], ["opq"]), # Same candidate by id, then by position
+    (["unknown-id", "verbal"], ["verbal"]),
+    # Neither ints nor strings
+    ([True, 2.0, None, [1], {"ref": 1}], []),
+    # At most MAX_FINAL_RECOMMENDATIONS, counted after skipping bad refs
+    ([9, 1, 2, 2, 3, 4, 5], ["java", "python", "opq"]),
+    ([], []),
+])
+def test_resolve_candidate_refs(refs, expected):
+    assert ids(backend.resolve_candidate_refs(refs, CANDIDATES)) == expected
+
+
+def test_product_id_wins_over_position():
+    candidates = [{"product_id": "2"}, {"product_id": "other"}]
+    assert ids(backend.resolve_candidate_refs(["2", 2], candidates)) == ["2", "other"]
+
+
+@pytest.mark.parametrize("text, expected, status_code", [
+    ('{"recommended": [2, "opq"]}', ["python", "opq"], 200),
+    ('{"recommended": [42]}', [], 200),
+    ('{"recommended": "1"}', None, 502),
+])
+def test_parse_compact_recommendation_text(text, expected, status_code):
+    result, status = backend.parse_compact_recommendation_text(text, CANDIDATES)
+    assert status == status_code
+    if expected is not None:
+        assert [assessment["product_id"] for assessment in result["recommended_assessments"]] == expected
+
+
+@pytest.mark.parametrize("buffer, refs", [
+    ('{"recomm', []),
+    ('{"recommended": [', []),
+    ('{"recommended": [3, 1', [3]), # The last ref may still be arriving
+    ('{"recommended": [3, 1]', [3, 1]),
+    ('{"recommended": ["opq", "ja', ["opq"]),
+])
+def test_extract_streamed_refs(buffer, refs):
+    assert backend.extract_streamed_refs(buffer) == refs
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import backend
+
+
+@pytest.fixture(autouse=True)
+def small_window(monkeypatch):
+    monkeypatch.setattr(backend, "CIRCUIT_WINDOW_SIZE", 4)
+    monkeypatch.setattr(backend, "CIRCUIT_MIN_CALLS", 3)
+    monkeypatch.setattr(backend, "CIRCUIT_FAILURE_RATE", 0.5)
+    monkeypatch.setattr(backend, "CIRCUIT_OPEN_SECONDS", 30)
+
+
+def make_breaker(enabled=True, slow_call_seconds=10):
+    return backend.CircuitBreaker("test", slow_call_seconds, enabled)
+
+
+def attempt(breaker, fail=False):
+    """Runs one guarded call. Returns 'ok', 'failed' or 'rejected'."""
+    try:
+        with breaker.guard():
+            if fail:
+                raise RuntimeError("dependency error")
+    except backend.CircuitOpenError:
+        return "rejected"
+    except RuntimeError:
+        return "failed"
+    return "ok"
+
+
+def expire_open_period(breaker):
+    breaker.opened_at -= backend.CIRCUIT_OPEN_SECONDS
+
+
+@pytest.mark.parametrize("calls, states", [
+    # Fewer than CIRCUIT_MIN_CALLS calls never open the breaker
+    ("FF", ["closed", "closed"]),
+    ("FFF", ["closed", "closed", "open"]),
+    ("SSF", ["closed", "closed", "closed"]),
+    # 2 of the last 4 calls failed: CIRCUIT_FAILURE_RATE reached
+    ("SSFSF", ["closed", "closed", "closed", "closed", "open"]),
+    # The window slides: old failures drop out
+    ("FSSSSF", ["closed"] * 6),
+])
+def test_breaker_opens_on_failure_rate(calls, states):
+    breaker = make_breaker()
+    observed = []
+    for call in calls:
+        attempt(breaker, fail=call == "F")
+        observed.append(breaker.state)
+    assert observed == states
+
+
+def test_open_breaker_rejects_without_calling():
+    breaker = make_breaker()
+    for _ in range(3):
+        attempt(breaker, fail=True)
+    assert breaker.state == "open"
+    assert not breaker.available()
+    assert attempt(breaker) == "rejected"
+    assert breaker.rejected == 1
+    assert breaker.stats()["retry_in_seconds"] > 0
+
+
+@pytest.mark.parametrize("probe_fails, state, times_opened", [
+    (False, "closed", 1),
+    (True, "open", 2),
+])
+def test_half_open_probe(probe_fails, state, times_opened):
+    breaker = make_breaker()
+    for _ in range(3):
+        attempt(breaker, fail=True)
+    expire_open_period(breaker)
+    assert breaker.available()
+    assert attempt(breaker, fail=probe_fails) == ("failed" if probe_fails else "ok")
+    assert breaker.state == state
+    assert breaker.times_opened == times_opened
+    assert breaker.stats()["window_calls"] == 0
+
+
+def test_half_open_allows_a_single_probe():
+    breaker = make_breaker()
+    for _ in range(3):
+        attempt(breaker, fail=True)
+    expire_open_period(breaker)
+    with breaker.guard():
+        assert breaker.state == "half_open"
+        assert not breaker.available()
+        assert attempt(breaker) == "rejected"
+    assert breaker.state == "closed"
+
+
+def test_cancelled_probe_gives_no_verdict():
+    breaker = make_breaker()
+    for _ in range(3):
+        attempt(breaker, fail=True)
+    expire_open_period(breaker)
+    with pytest.raises(KeyboardInterrupt):
+        with breaker.guard():
+            raise KeyboardInterrupt
+    # Still half-open, and the next call is the probe
+    assert breaker.state == "half_open"
+    assert breaker.available()
+    assert attempt(breaker) == "ok"
+    assert breaker.state == "closed"
+
+
+def test_slow_calls_count_as_failures():
+    breaker = make_breaker(slow_call_seconds=-1) # Every call is slower than this
+    for _ in range(3):
+        assert attempt(breaker) == "ok"
+    assert breaker.state == "open"
+
+
+def test_calls_started_before_opening_are_ignored():
+    breaker = make_breaker()
+    with breaker.guard(): # In flight while the breaker opens
+        for _ in range(3):
+            attempt(breaker, fail=True)
+        assert breaker.state == "open"
+    assert breaker.state == "open"
+    assert breaker.stats()["window_calls"] == 0
+
+
+def test_disabled_breaker_never_opens():
+    breaker = make_breaker(enabled=False)
+    for _ in range(10):
+        assert attempt(breaker, fail=True) == "failed"
+    assert breaker.state == "closed"
+
+
+@pytest.mark.parametrize("samples, expected", [
+    ([0.1] * 19, None), # Fewer than HEDGE_MIN_SAMPLES
+    ([0.001] * 20, 0.02), # Never below HEDGE_MIN_DELAY_SECONDS
+    ([0.1] * 18 + [0.5, 0.9], 0.9),
+    ([0.1] * 95 + [1.0] * 5, 1.0),
+])
+def test_hedge_delay(monkeypatch, samples, expected):
+    monkeypatch.setattr(backend, "HEDGE_MIN_SAMPLES", 20)
+    monkeypatch.setattr(backend, "HEDGE_QUANTILE", 0.95)
+    monkeypatch.setattr(backend, "HEDGE_MIN_DELAY_SECONDS", 0.02)
+    breaker = make_breaker()
+    for seconds in samples:
+        breaker._record(True, seconds, False)
+    assert breaker.hedge_delay() == expected
+
+
+def test_call_dependency_hedges_a_slow_call(monkeypatch):
+    monkeypatch.setattr(backend, "HEDGED_DEPENDENCIES", {"test"})
+    monkeypatch.setattr(backend, "HEDGE_MIN_SAMPLES", 1)
+    breaker = make_breaker()
+    breaker._record(True, 0.001, False)
+    hedge_done = threading.Event()
+    calls = []
+
+    def call():
+        calls.append(None)
+        if len(calls) == 1:
+            hedge_done.wait(5) # The first call hangs until the hedge has answered
+            return "first"
+        hedge_done.set()
+        return "hedge"
+
+    assert backend.call_dependency(breaker, call) == "hedge"
+    assert (breaker.hedged, breaker.hedge_wins) == (1, 1)
+
+
+def test_call_dependency_fails_fast_when_open():
+    breaker = make_breaker()
+    for _ in range(3):
+        attempt(breaker, fail=True)
+    with pytest.raises(backend.CircuitOpenError):
+        backend.call_dependency(breaker, lambda: pytest.fail("called through an open breaker"))
+
+
+def test_guard_records_only_measured_time():
+    breaker = make_breaker(slow_call_seconds=0.05)
+    for _ in range(3):
+        with breaker.guard() as call_timer:
+            with call_timer.measure():
+                pass
+            time.sleep(0.06) # Waiting on something other than the dependency
+    assert breaker.state == "closed"
+    assert max(breaker._latencies) < 0.05
+
+
+def test_guard_without_measurement_records_the_whole_block():
+    breaker = make_breaker(slow_call_seconds=0.01)
+    with breaker.guard():
+        time.sleep(0.02)
+    assert breaker._latencies[0] >= 0.02
+
+
+@pytest.fixture
+def llm_stream(monkeypatch):
+    """Drives stream_product_recommendations to its streamed generation step with one stand-in candidate."""
+    candidate = {"product_id": "p1", "product_name": "Java 8", "url": "https://example.com/p1", "similarity_score": 0.5}
+    monkeypatch.setattr(backend, "lookup_response_cache", lambda query, variant: (None, None, None))
+    monkeypatch.setattr(backend, "retrieve_candidates", lambda *args: ([candidate], None))
+    monkeypatch.setattr(backend, "is_confident_retrieval", lambda metadata: False)
+    monkeypatch.setattr(backend, "effective_ranking_mode", lambda mode, metadata: mode)
+    monkeypatch.setattr(backend, "build_generation_prompt", lambda query, candidates: ("prompt", candidates))
+    monkeypatch.setattr(backend, "record_generation_tokens", lambda prompt, response: None)
+    monkeypatch.setattr(backend, "parse_generation_text", lambda text, candidates: ({"recommended_assessments": []}, 200))
+    monkeypatch.setattr(backend, "store_response_cache", lambda *args: None)
+    monkeypatch.setattr(backend, "rank_recommendations_fast",
+                        lambda query, candidates, metadata: ({"recommended_assessments": [], "fast": True}, 200))
+    return lambda: backend.stream_product_recommendations("java developer", mode="llm")
+
+
+def test_stream_does_not_time_the_client(monkeypatch, llm_stream):
+    breaker = make_breaker(slow_call_seconds=0.05)
+    monkeypatch.setattr(backend, "gemini_breaker", breaker)
+    chunks = [SimpleNamespace(text='{"recommended_assessments": [') for _ in range(3)]
+    monkeypatch.setattr(backend, "generate_with_structured_fallback", lambda prompt, **kwargs: iter(chunks))
+    monkeypatch.setattr(backend, "extract_streamed_recommendations", lambda buffer, candidates: [{}] * buffer.count("["))
+    for event in llm_stream():
+        if event.startswith("event: recommendation"):
+            time.sleep(0.03) # A slow reader: 0.09s in total, longer than slow_call_seconds
+    assert len(breaker._latencies) == 1
+    assert breaker._latencies[0] < 0.05
+
+
+def test_stream_degrades_when_the_breaker_opens(monkeypatch, llm_stream):
+    breaker = make_breaker()
+    for _ in range(3):
+        attempt(breaker, fail=True)
+    monkeypatch.setattr(backend, "gemini_breaker", breaker)
+    monkeypatch.setattr(backend, "generate_with_structured_fallback", lambda prompt, **kwargs: pytest.fail("called through an open breaker"))
+    events = [event.split("\n") for event in llm_stream()]
+    assert [event[0] for event in events] == ["event: candidates", "event: result", "event: done"]
+    result = json.loads(events[1][1][len("data: "):])
+    assert result["fast"]
+    assert result["metadata"]["degraded"] == "gemini_circuit_open"
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+import backend
+
+
+@pytest.mark.parametrize("value, expected", [
+    (None, {}),
+    ({}, {}),
+    ({"max_duration": 30}, {"max_duration": 30}),
+    ({"max_duration": 12.5, "remote": True, "adaptive": False}, {"max_duration": 12.5, "remote": True, "adaptive": False}),
+    ({"test_type": " Personality & Behavior "}, {"test_type": ["Personality & Behavior"]}),
+    ({"test_type": ["Simulations", "Ability & Aptitude", "Simulations"]}, {"test_type": ["Ability & Aptitude", "Simulations"]}),
+    ({"remote": None}, {}),
+])
+def test_parse_filters_option_accepts(value, expected):
+    assert backend.parse_filters_option(value) == (expected, None)
+
+
+@pytest.mark.parametrize("value, message", [
+    ([], "'filters' must be an object."),
+    ({"colour": "red"}, "Unknown filter(s): colour."),
+    ({"max_duration": 0}, "'filters.max_duration' must be a positive number of minutes."),
+    ({"max_duration": True}, "'filters.max_duration' must be a positive number of minutes."),
+    ({"max_duration": "30"}, "'filters.max_duration' must be a positive number of minutes."),
+    ({"remote": "yes"}, "'filters.remote' must be true or false."),
+    ({"test_type": []}, "'filters.test_type' must be a non-empty string or list of strings."),
+    ({"test_type": ["Simulations", " "]}, "'filters.test_type' must be a non-empty string or list of strings."),
+])
+def test_parse_filters_option_rejects(value, message):
+    filters, error = backend.parse_filters_option(value)
+    assert filters is None
+    assert error.startswith(message)
+
+
+@pytest.mark.parametrize("query, expected", [
+    # Constraint phrasing
+    ("tests under 30 minutes", {"max_duration": 30}),
+    ("within 1 hour", {"max_duration": 60}),
+    ("no more than 45 mins", {"max_duration": 45}),
+    ("under 40 minutes, at most 25 minutes", {"max_duration": 25}),
+    ("remote testing for java developers", {"remote": True}),
+    ("a test that can be taken remotely", {"remote": True}),
+    ("must be adaptive", {"adaptive": True}),
+    ("IRT numerical test", {"adaptive": True}),
+    ("computer-adaptive test for graduates", {"adaptive": True}),
+    # Words describing the job, not the assessment
+    ("managing remote teams", {}),
+    ("remote work skills", {}),
+    ("adaptive leadership", {}),
+    ("candidates who can finish in 20 minutes", {}),
+    ("personality test", {}),
+])
+def test_extract_query_filters(query, expected):
+    assert backend.extract_query_filters(query) == expected
+
+
+def test_resolve_filters_follows_filter_extraction(monkeypatch):
+    monkeypatch.setattr(backend, "FILTER_EXTRACTION", False)
+    assert backend.resolve_filters("tests under 30 minutes") == {}
+    assert backend.resolve_filters("tests under 30 minutes", extract=True) != {}
+    monkeypatch.setattr(backend, "FILTER_EXTRACTION", True)
+    assert backend.resolve_filters("tests under 30 minutes") != {}
+    assert backend.resolve_filters("tests under 30 minutes", extract=False) == {}
+    monkeypatch.setattr(backend, "FILTER_EXTRACTION", False)
+    assert backend.resolve_filters("tests under 30 minutes") == {}
+    assert backend.resolve_filters("tests under 30 minutes", {"remote": True}) == {"remote": True}
+
+
+def test_resolve_filters_explicit_filters_win():
+    assert backend.resolve_filters("remote testing under 30 minutes", {"max_duration": 20, "remote": False}, extract=True) == \
+        {"max_duration": 20, "remote": False}
+
+
+def test_resolve_filters_extracted_duration_keeps_unknown_durations():
+    assert backend.resolve_filters("tests under 30 minutes", extract=True) == \
+        {"max_duration": 30, backend.EXTRACTED_DURATION_KEY: True}
+
+
+ROWS = [
+    {"duration_minutes": 10, "remote_testing": True, "adaptive_irt": False, "product_type": ["Simulations"]},
+    {"duration_minutes": None, "remote_testing": False, "adaptive_irt": True, "product_type": ["Personality & Behavior"]},
+    {"duration_minutes": 60, "remote_testing": True, "adaptive_irt": True, "product_type": ["Simulations", "Ability & Aptitude"]},
+]
+
+
+@pytest.mark.parametrize("filters, expected", [
+    ({"max_duration": 30}, [True, False, False]),
+    ({"max_duration": 30, backend.EXTRACTED_DURATION_KEY: True}, [True, True, False]),
+    ({"remote": True}, [True, False, True]),
+    ({"adaptive": False}, [True, False, False]),
+    ({"test_type": ["ability & aptitude"]}, [False, False, True]),
+    ({"test_type": ["Simulations", "Personality & Behavior"], "remote": True}, [True, False, True]),
+    ({"test_type": ["Unknown Type"]}, [False, False, False]),
+])
+def test_filter_columns_mask(filters, expected):
+    assert backend.FilterColumns(ROWS).mask(filters).tolist() == expected
+
+
+def test_filter_columns_mask_without_filters():
+    assert backend.FilterColumns(ROWS).mask({}) is None
+    assert backend.filter_rows(ROWS, {}) is ROWS
+    assert backend.filter_rows(ROWS, {"remote": False}) == [ROWS[1]]
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import backend
+
+
+@pytest.mark.parametrize("text, expected", [
+    # Cut off inside a list: close the open brackets
+    ('{"recommended": [1, 2, 3', {"recommended": [1, 2, 3]}),
+    ('{"recommended": [1, 2, 3]', {"recommended": [1, 2, 3]}),
+    # Cut off inside an object: back up to the last complete element
+    ('{"recommended_assessments": [{"product_id": "p1", "name": "A"}, {"product_id": "p2", "na',
+     {"recommended_assessments": [{"product_id": "p1", "name": "A"}, {"product_id": "p2"}]}),
+    ('{"recommended": [1, 2,', {"recommended": [1, 2]}),
+    # Escaped quotes do not end the string
+    ('{"a": "esc \\" quote", "b": [1,', {"a": 'esc " quote', "b": [1]}),
+    # Nothing complete to keep: commas and brackets inside a string are not cut points
+    ('{"a": "text with , and ] inside', None),
+])
+def test_close_truncated_json(text, expected):
+    assert backend.close_truncated_json(text) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ('Here you go: {"recommended": [2, 1]} hope it helps', {"recommended": [2, 1]}),
+    ('{"recommended": [1, 2, 3,]}', {"recommended": [1, 2, 3]}),
+    ('{"recommended_assessments": [{"product_id": "p1"}, {"product_id": "p2"}],}',
+     {"recommended_assessments": [{"product_id": "p1"}, {"product_id": "p2"}]}),
+    ('prefix {"recommended": [4, 5', {"recommended": [4, 5]}),
+    ("no json here", None),
+    ("", None),
+])
+def test_repair_json_text(text, expected):
+    assert backend.repair_json_text(text) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ('```json\n{"recommended": [4]}\n```', {"recommended": [4]}),
+    ('```json\n{"recommended": [4, 5\n```', {"recommended": [4, 5]}),
+    ('{"recommended": []}', {"recommended": []}),
+])
+def test_load_model_json_parses_or_repairs(text, expected):
+    assert backend.load_model_json(text) == (expected, None)
+
+
+@pytest.mark.parametrize("text", ["nonsense", "```json\n```", "[1, 2"])
+def test_load_model_json_reports_unusable_answers(text):
+    value, (error, status_code) = backend.load_model_json(text)
+    assert value is None
+    assert status_code == 502
+    assert error["status"] == "ai_error"
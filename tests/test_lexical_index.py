@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import math
+
+import numpy as np
+import pytest
+
+import backend
+
+ROWS = [
+    {"product_id": "java", "product_name": "Java 8 Programming", "description": "Multiple choice questions on Java language features.", "duration_minutes": 30},
+    {"product_id": "core-java", "product_name": "Core Java Advanced Level", "description": "Java collections, Java streams and Java concurrency.", "duration_minutes": 45},
+    {"product_id": "opq", "product_name": "OPQ32r Occupational Personality Questionnaire", "description": "Workplace behavioural styles.", "duration_minutes": 25},
+    {"product_id": "verbal", "product_name": "Verbal Reasoning", "description": "Reading comprehension, including Java documentation excerpts.", "duration_minutes": 20},
+    {"product_id": "service", "product_name": "Customer Service Phone Simulation", "description": "Call handling simulation for contact centres.", "duration_minutes": 15},
+    {"product_id": "sales", "product_name": "Sales Manager Solution", "description": "Personality and reasoning for sales managers.", "duration_minutes": 60},
+]
+
+
+@pytest.fixture(autouse=True)
+def lexical_settings(monkeypatch):
+    for name, value in {"BM25_K1": 1.2, "BM25_B": 0.75, "LEXICAL_NAME_BOOST": 3, "LEXICAL_PREFIX_MIN_CHARS": 3,
+                        "LEXICAL_PREFIX_MAX_TERMS": 5, "LEXICAL_PRECISE_MAX_DOC_RATIO": 0.2}.items():
+        monkeypatch.setattr(backend, name, value)
+
+
+def document(row):
+    name_terms = backend.lexical_terms(row["product_name"])
+    return backend.lexical_terms(backend.get_embedding_text(row)) + name_terms * (backend.LEXICAL_NAME_BOOST - 1)
+
+
+def brute_force_bm25(rows, query):
+    """Textbook BM25 scores of every row, computed term by term."""
+    documents = [document(row) for row in rows]
+    average_length = sum(len(terms) for terms in documents) / len(documents)
+    scores = [0.0] * len(rows)
+    for term in set(backend.lexical_terms(query)):
+        frequency = sum(term in terms for terms in documents)
+        if not frequency:
+            continue
+        idf = math.log(1 + (len(rows) - frequency + 0.5) / (frequency + 0.5))
+        for position, terms in enumerate(documents):
+            count = terms.count(term)
+            length_norm = backend.BM25_K1 * (1 - backend.BM25_B + backend.BM25_B * len(terms) / average_length)
+            scores[position] += idf * count * (backend.BM25_K1 + 1) / (count + length_norm)
+    return scores
+
+
+@pytest.mark.parametrize("query", ["java", "java programming", "personality questionnaire", "customer service simulation",
+                                   "reasoning for sales", "sales manager java"])
+def test_search_matches_brute_force_bm25(query):
+    expected = brute_force_bm25(ROWS, query)
+    hits = backend.LexicalIndex(ROWS).search(query, len(ROWS))
+    assert [position for position, _ in hits] == sorted((p for p in range(len(ROWS)) if expected[p] > 0), key=lambda p: -expected[p])
+    for position, score in hits:
+        assert score == pytest.approx(expected[position], rel=1e-5)
+
+
+def test_repeated_terms_rank_higher():
+    # 'core-java' says Java four times; 'verbal' mentions it once in its description
+    ranking = [ROWS[position]["product_id"] for position, _ in backend.LexicalIndex(ROWS).search("java", 3)]
+    assert ranking == ["core-java", "java", "verbal"]
+
+
+@pytest.mark.parametrize("boost, expected", [(3, ["zebra", "alpha"]), (1, None)])
+def test_name_terms_are_boosted(monkeypatch, boost, expected):
+    monkeypatch.setattr(backend, "LEXICAL_NAME_BOOST", boost)
+    rows = [{"product_id": "alpha", "product_name": "Alpha Report", "description": "Includes zebra."},
+            {"product_id": "zebra", "product_name": "Zebra Report", "description": "Includes alpha."}]
+    (first, first_score), (second, second_score) = backend.LexicalIndex(rows).search("zebra", 2)
+    if expected is None:
+        # Without the boost both documents hold the term once and have the same length
+        assert first_score == pytest.approx(second_score)
+    else:
+        assert [rows[first]["product_id"], rows[second]["product_id"]] == expected
+        assert first_score > second_score
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("opq32", ["opq"]), # Unknown term prefixing 'opq32r'
+    ("op", []), # Shorter than LEXICAL_PREFIX_MIN_CHARS
+    ("the assessment for", []), # Stopwords only
+    ("kotlin", []),
+])
+def test_search_terms(query, expected):
+    hits = backend.LexicalIndex(ROWS).search(query, 5)
+    assert [ROWS[position]["product_id"] for position, _ in hits] == expected
+
+
+def test_search_respects_mask():
+    mask = np.array([row["product_id"] != "core-java" for row in ROWS])
+    hits = backend.LexicalIndex(ROWS).search("java", 5, mask)
+    assert [ROWS[position]["product_id"] for position, _ in hits] == ["java", "verbal"]
+
+
+@pytest.mark.parametrize("query, product_id, precise", [
+    ("OPQ32r questionnaire", "opq", True),
+    ("opq32", "opq", True), # Prefix of the rare name term
+    ("java programming", "java", True), # 'programming' is rare even though 'java' is not
+    ("java", "core-java", False), # Every keyword matches, but none is rare
+    ("java developer", "java", False), # 'developer' is not in the name
+    ("reasoning", "verbal", False), # Name term also in another product's text
+    ("the for", "java", False), # No keywords
+])
+def test_is_precise_match(query, product_id, precise):
+    position = [row["product_id"] for row in ROWS].index(product_id)
+    assert backend.LexicalIndex(ROWS).is_precise_match(query, position) == precise
+
+
+@pytest.fixture
+def vector_index(monkeypatch):
+    """Local index over ROWS with one-hot embeddings: a query vector picks a single product with similarity 1."""
+    monkeypatch.setattr(backend, "EXPECTED_EMBEDDING_DIMENSION", len(ROWS))
+    monkeypatch.setattr(backend, "LEXICAL_SEARCH_ENABLED", True)
+    for name, value in {"ADAPTIVE_RETRIEVAL": True, "ADAPTIVE_MAX_RETRIEVAL_COUNT": 12, "DB_RETRIEVAL_COUNT": 6,
+                        "CONFIDENT_MIN_SIMILARITY": 0.75, "CONFIDENT_MIN_MARGIN": 0.1, "FLAT_MAX_SPREAD": 0.05}.items():
+        monkeypatch.setattr(backend, name, value)
+    index = backend.LocalVectorIndex()
+    index.load_matrix(np.eye(len(ROWS), dtype=np.float32), [dict(row) for row in ROWS])
+    return index
+
+
+@pytest.mark.parametrize("query, vector_pick, policy, overridden", [
+    # The query names the OPQ32r, but the vector search is confident about another product
+    ("OPQ32r questionnaire", "service", "default", True),
+    # The named product is the vector pick: confidence stands
+    ("OPQ32r questionnaire", "opq", "confident", False),
+    # Not a precise name match: no override
+    ("java", "service", "confident", False),
+])
+def test_precise_name_match_overrides_policy(vector_index, query, vector_pick, policy, overridden):
+    query_embedding = np.eye(len(ROWS), dtype=np.float32)[[row["product_id"] for row in ROWS].index(vector_pick)]
+    raw_matches = vector_index.search(query_embedding, 0.4, 12)
+    lexical_matches, lexical_match = vector_index.lexical_search(query, 6, query_embedding)
+    metadata = {}
+    backend.apply_retrieval_policy(query, raw_matches, metadata, lexical_matches, lexical_match)
+    assert metadata["retrieval"]["policy"] == policy
+    assert ("overridden_by" in metadata["retrieval"]) == overridden
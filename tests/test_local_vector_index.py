@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+import json
+
+import numpy as np
+import pytest
+
+import backend
+
+DIMENSION = 16
+TEST_TYPES = ["Knowledge & Skills", "Personality & Behavior", "Ability & Aptitude"]
+
+
+def make_rows(count=60, seed=7):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for position in range(count):
+        rows.append({
+            "product_id": f"p{position}",
+            "product_name": f"Product {position}",
+            "url": f"https://example.com/p{position}",
+            "description": f"Assessment number {position}.",
+            "duration_minutes": None if position % 7 == 0 else int(rng.integers(5, 90)),
+            "remote_testing": bool(position % 2),
+            "adaptive_irt": position % 3 == 0,
+            "product_type": [TEST_TYPES[position % 3]] + ([TEST_TYPES[(position + 1) % 3]] if position % 5 == 0 else []),
+        })
+    return rows, rng.normal(size=(count, DIMENSION)).astype(np.float32)
+
+
+ROWS, EMBEDDINGS = make_rows()
+QUERIES = np.random.default_rng(11).normal(size=(4, DIMENSION)).astype(np.float32)
+
+
+@pytest.fixture(autouse=True)
+def small_dimension(monkeypatch):
+    monkeypatch.setattr(backend, "EXPECTED_EMBEDDING_DIMENSION", DIMENSION)
+
+
+@pytest.fixture
+def index():
+    index = backend.LocalVectorIndex()
+    index.load_matrix(EMBEDDINGS.copy(), [dict(row) for row in ROWS])
+    return index
+
+
+def passes(row, filters):
+    """Filter semantics, one row at a time."""
+    duration = row["duration_minutes"]
+    if "max_duration" in filters:
+        if duration is None:
+            if not filters.get(backend.EXTRACTED_DURATION_KEY):
+                return False
+        elif duration > filters["max_duration"]:
+            return False
+    if "remote" in filters and row["remote_testing"] != filters["remote"]:
+        return False
+    if "adaptive" in filters and row["adaptive_irt"] != filters["adaptive"]:
+        return False
+    if "test_type" in filters and not {t.lower() for t in row["product_type"]} & {t.lower() for t in filters["test_type"]}:
+        return False
+    return True
+
+
+def match_products(query, threshold, count, filters=None):
+    """Brute-force match_products: cosine similarity above the threshold, best first, top count."""
+    matches = []
+    for row, embedding in zip(ROWS, EMBEDDINGS):
+        similarity = float(np.dot(query, embedding) / (np.linalg.norm(query) * np.linalg.norm(embedding)))
+        if similarity > threshold and passes(row, filters or {}):
+            matches.append((row["product_id"], similarity))
+    matches.sort(key=lambda match: -match[1])
+    return matches[:count]
+
+
+def as_pairs(candidates):
+    return [(candidate.get("product_id"), candidate.get("similarity")) for candidate in candidates]
+
+
+def assert_same_matches(candidates, expected):
+    assert [product_id for product_id, _ in as_pairs(candidates)] == [product_id for product_id, _ in expected]
+    assert [similarity for _, similarity in as_pairs(candidates)] == pytest.approx([similarity for _, similarity in expected], abs=1e-5)
+
+
+@pytest.mark.parametrize("threshold, count, filters", [
+    (-1.0, 5, None),
+    (-1.0, 100, None), # More than the catalogue holds
+    (0.2, 60, None), # The threshold cuts the list
+    (0.99, 5, None),
+    (-1.0, 8, {"max_duration": 30}),
+    (-1.0, 60, {"max_duration": 30, backend.EXTRACTED_DURATION_KEY: True}),
+    (-1.0, 6, {"remote": True}),
+    (0.1, 60, {"adaptive": False, "remote": False}),
+    (-1.0, 10, {"test_type": ["personality & behavior"]}),
+    (-1.0, 10, {"test_type": ["Ability & Aptitude", "Knowledge & Skills"], "max_duration": 45}),
+    (-1.0, 10, {"test_type": ["Simulation"]}), # Nothing has this type
+])
+@pytest.mark.parametrize("query_index", range(len(QUERIES)))
+def test_search_matches_brute_force(index, query_index, threshold, count, filters):
+    query = QUERIES[query_index]
+    assert_same_matches(index.search(query, threshold, count, filters), match_products(query, threshold, count, filters))
+
+
+def test_search_is_scale_invariant(index):
+    assert_same_matches(index.search(QUERIES[0] * 25, -1.0, 10), as_pairs(index.search(QUERIES[0], -1.0, 10)))
+
+
+def test_zero_query_matches_nothing(index):
+    assert index.search(np.zeros(DIMENSION, dtype=np.float32), -1.0, 10) == []
+
+
+def test_search_batch_matches_single_searches(index):
+    filters_list = [None, {"remote": True}, {"max_duration": 20}, None]
+    batch = index.search_batch(QUERIES, 0.0, 7, filters_list)
+    assert len(batch) == len(QUERIES)
+    for query, filters, candidates in zip(QUERIES, filters_list, batch):
+        assert_same_matches(candidates, as_pairs(index.search(query, 0.0, 7, filters)))
+
+
+def test_candidates_read_like_rpc_rows(index):
+    best = index.search(EMBEDDINGS[3], 0.5, 1)[0]
+    assert best.get("product_id") == "p3"
+    assert best.get("similarity") == pytest.approx(1.0)
+    assert best.get("similarity_score") == best.get("similarity")
+    assert best.get("product_name") == "Product 3"
+    assert best.get(backend.DB_EMBEDDING_COLUMN) is None
+
+
+def test_search_before_load_fails():
+    with pytest.raises(RuntimeError):
+        backend.LocalVectorIndex().search(QUERIES[0], 0.0, 5)
+
+
+def test_load_parses_and_skips_embeddings():
+    rows = [dict(row, **{backend.DB_EMBEDDING_COLUMN: json.dumps(EMBEDDINGS[position].tolist())}) for position, row in enumerate(ROWS[:3])]
+    rows.append(dict(ROWS[3], **{backend.DB_EMBEDDING_COLUMN: EMBEDDINGS[3].tolist()}))
+    rows.append(dict(ROWS[4], **{backend.DB_EMBEDDING_COLUMN: [0.1] * (DIMENSION - 1)})) # Wrong dimension
+    rows.append(dict(ROWS[5], **{backend.DB_EMBEDDING_COLUMN: "not a vector"}))
+    rows.append(dict(ROWS[6], **{backend.DB_EMBEDDING_COLUMN: None}))
+    index = backend.LocalVectorIndex()
+    assert index.load(rows) == 4
+    assert len(index) == 4
+    assert [candidate.get("product_id") for candidate in index.search(EMBEDDINGS[3], -1.0, 10)][0] == "p3"
+
+
+@pytest.mark.parametrize("rows, matrix", [
+    (ROWS[:2], np.zeros((3, DIMENSION), dtype=np.float32)),
+    (ROWS[:2], np.zeros((2, DIMENSION + 1), dtype=np.float32)),
+])
+def test_load_matrix_rejects_bad_shapes(rows, matrix):
+    with pytest.raises(ValueError):
+        backend.LocalVectorIndex().load_matrix(matrix, rows)
+
+
+def test_load_without_usable_embeddings_fails():
+    with pytest.raises(ValueError):
+        backend.LocalVectorIndex().load([dict(ROWS[0], **{backend.DB_EMBEDDING_COLUMN: None})])
+
+
+@pytest.fixture
+def no_global_index(monkeypatch):
+    monkeypatch.setattr(backend, "vector_index", None)
+
+
+def test_snapshot_round_trip(tmp_path, index, no_global_index):
+    path = tmp_path / "catalogue.npz"
+    index.save(str(path))
+    assert backend.load_catalogue_snapshot(str(path)) == len(ROWS)
+    assert backend.vector_index.ready
+    for query in QUERIES:
+        assert_same_matches(backend.vector_index.search(query, 0.0, 10, {"remote": False}), match_products(query, 0.0, 10, {"remote": False}))
+
+
+def test_snapshot_from_another_model_is_rejected(tmp_path, index, no_global_index, monkeypatch):
+    path = tmp_path / "catalogue.npz"
+    index.save(str(path))
+    monkeypatch.setattr(backend, "EMBEDDING_MODEL_NAME", "another-model")
+    with pytest.raises(ValueError):
+        backend.load_catalogue_snapshot(str(path))
+    assert backend.vector_index is None
+
+
+def test_refresh_swaps_in_a_new_snapshot(monkeypatch, no_global_index):
+    monkeypatch.setattr(backend, "supabase_client", object())
+    table_rows = [dict(row, **{backend.DB_EMBEDDING_COLUMN: embedding.tolist()}) for row, embedding in zip(ROWS, EMBEDDINGS)]
+    monkeypatch.setattr(backend, "fetch_catalogue_rows", lambda: table_rows[:10])
+    assert backend.refresh_vector_index()
+    index = backend.vector_index
+    assert len(index) == 10
+
+    monkeypatch.setattr(backend, "fetch_catalogue_rows", lambda: table_rows)
+    assert backend.refresh_vector_index()
+    assert backend.vector_index is index # Swapped in place, so readers holding the index see the new snapshot
+    assert len(index) == len(ROWS)
+    assert_same_matches(index.search(QUERIES[0], 0.0, 10), match_products(QUERIES[0], 0.0, 10))
+
+
+def test_failed_refresh_keeps_the_previous_snapshot(monkeypatch, index):
+    monkeypatch.setattr(backend, "vector_index", index)
+    monkeypatch.setattr(backend, "supabase_client", object())
+
+    def fail():
+        raise ConnectionError("Supabase is down")
+
+    monkeypatch.setattr(backend, "fetch_catalogue_rows", fail)
+    assert not backend.refresh_vector_index()
+    assert backend.vector_index is index
+    assert len(index) == len(ROWS)
+
+
+def test_refresh_without_supabase(monkeypatch, no_global_index):
+    monkeypatch.setattr(backend, "supabase_client", None)
+    assert not backend.refresh_vector_index()
+    assert backend.vector_index is None
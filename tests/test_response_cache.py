@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+import math
+import time
+
+import numpy as np
+import pytest
+
+import backend
+
+
+class FakeClock:
+    """Stands in for the time module in backend: time() is set by the test, everything else is the real module."""
+
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(backend, "time", clock)
+    return clock
+
+
+def make_cache(max_entries=4, ttl_seconds=60, similarity_threshold=0.9):
+    return backend.ResponseCache(max_entries, ttl_seconds, similarity_threshold)
+
+
+def at_angle(cosine, scale=1.0):
+    """A 3-d embedding whose cosine similarity to [1, 0, 0] is the given value."""
+    return np.array([cosine, math.sqrt(1 - cosine ** 2), 0.0], dtype=np.float32) * scale
+
+
+BASE = np.array([1.0, 0.0, 0.0], dtype=np.float32)
+
+
+def result(name):
+    return {"recommended_assessments": [{"product_id": name}], "status": "success"}
+
+
+def test_exact_hit_is_a_cached_response(clock):
+    cache = make_cache()
+    cache.put("llm:java", result("java"), BASE, "llm")
+    hit = cache.get_exact("llm:java")
+    assert isinstance(hit, backend.CachedResponse)
+    assert hit["recommended_assessments"] == [{"product_id": "java"}]
+    assert hit["metadata"] == {"response_cache": "exact"}
+    assert cache.get_exact("llm:python") is None
+    assert cache.stats()["exact_hits"] == 1
+
+
+def test_stored_result_is_a_copy(clock):
+    cache = make_cache()
+    original = result("java")
+    cache.put("llm:java", original)
+    original["recommended_assessments"].append({"product_id": "changed"})
+    assert cache.get_exact("llm:java")["recommended_assessments"] == [{"product_id": "java"}]
+
+
+@pytest.mark.parametrize("elapsed, alive", [(0, True), (59.9, True), (60, False), (3600, False)])
+def test_ttl_expiry(clock, elapsed, alive):
+    cache = make_cache(ttl_seconds=60)
+    cache.put("llm:java", result("java"), BASE, "llm")
+    clock.advance(elapsed)
+    assert (cache.get_similar(BASE, "llm") is not None) == alive
+    assert (cache.get_exact("llm:java") is not None) == alive
+    assert cache.stats()["entries"] == (1 if alive else 0)
+
+
+def test_put_refreshes_ttl(clock):
+    cache = make_cache(ttl_seconds=60)
+    cache.put("llm:java", result("old"))
+    clock.advance(50)
+    cache.put("llm:java", result("new"))
+    clock.advance(50)
+    assert cache.get_exact("llm:java")["recommended_assessments"] == [{"product_id": "new"}]
+
+
+def test_lru_eviction(clock):
+    cache = make_cache(max_entries=2)
+    cache.put("llm:a", result("a"))
+    cache.put("llm:b", result("b"))
+    cache.put("llm:c", result("c"))
+    assert cache.get_exact("llm:a") is None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_lookups_refresh_recency(clock):
+    cache = make_cache(max_entries=2)
+    cache.put("llm:a", result("a"), BASE, "llm")
+    cache.put("llm:b", result("b"), at_angle(0.0), "llm")
+    assert cache.get_similar(BASE, "llm")["recommended_assessments"] == [{"product_id": "a"}] # Touches a
+    cache.put("llm:c", result("c"))
+    assert cache.get_exact("llm:b") is None
+    assert cache.get_exact("llm:a") is not None
+    # Evicted entries leave the semantic index too
+    assert cache.get_similar(at_angle(0.0), "llm") is None
+
+
+@pytest.mark.parametrize("cosine, scale, hit", [
+    (1.0, 1.0, True),
+    (0.95, 1.0, True),
+    (0.95, 7.5, True), # Similarity is cosine: query length does not matter
+    (0.9001, 1.0, True),
+    (0.8999, 1.0, False),
+    (0.5, 1.0, False),
+    (-1.0, 1.0, False),
+    (1.0, 0.0, False), # A zero embedding matches nothing
+])
+def test_similarity_threshold(clock, cosine, scale, hit):
+    cache = make_cache(similarity_threshold=0.9)
+    cache.put("llm:java", result("java"), BASE * 3, "llm")
+    found = cache.get_similar(at_angle(cosine, scale), "llm")
+    assert (found is not None) == hit
+    if hit:
+        assert found["metadata"] == {"response_cache": "semantic"}
+
+
+def test_semantic_lookup_returns_the_nearest_entry(clock):
+    cache = make_cache(similarity_threshold=0.8)
+    cache.put("llm:a", result("a"), at_angle(0.85), "llm")
+    cache.put("llm:b", result("b"), at_angle(0.99), "llm")
+    cache.put("llm:c", result("c"), None, "llm") # No embedding: exact lookups only
+    assert cache.get_similar(BASE, "llm")["recommended_assessments"] == [{"product_id": "b"}]
+
+
+def test_fast_entry_never_answers_an_llm_request(clock):
+    cache = make_cache()
+    fast_key = backend.response_cache_key("Java developer", "fast")
+    cache.put(fast_key, result("fast"), BASE, "fast")
+    llm_key = backend.response_cache_key("java developer.", "llm")
+    assert llm_key != fast_key
+    assert cache.get_exact(llm_key) is None
+    assert cache.get_similar(BASE, "llm") is None
+    assert cache.get_similar(BASE, None) is None
+    assert cache.get_similar(BASE, "fast") is not None
+
+
+def test_semantic_lookup_skips_other_variants(clock):
+    cache = make_cache(similarity_threshold=0.8)
+    cache.put("fast:a", result("fast"), BASE, "fast")
+    cache.put("llm:b", result("llm"), at_angle(0.9), "llm")
+    filtered = backend.response_variant("llm", {"remote": True})
+    cache.put(f"{filtered}:c", result("filtered"), BASE, filtered)
+    assert cache.get_similar(BASE, "llm")["recommended_assessments"] == [{"product_id": "llm"}]
+    assert cache.get_similar(BASE, filtered)["recommended_assessments"] == [{"product_id": "filtered"}]
+
+
+def test_stats(clock):
+    cache = make_cache()
+    cache.put("llm:java", result("java"), BASE, "llm")
+    cache.get_exact("llm:java")
+    cache.get_similar(BASE, "llm")
+    cache.get_similar(at_angle(0.0), "llm")
+    stats = cache.stats()
+    assert (stats["exact_hits"], stats["semantic_hits"], stats["misses"]) == (1, 1, 1)
+    assert stats["hit_rate"] == round(2 / 3, 4)
+
+
+@pytest.mark.parametrize("result_data, status_code, stored", [
+    ({"status": "success"}, 200, True),
+    ({"status": "error"}, 502, False),
+    ({"metadata": {"degraded": "gemini_circuit_open"}}, 200, False),
+    ({"metadata": {"expansion": {"timed_out": True}}}, 200, False),
+    ({"metadata": {"expansion": {"reason": "gemini_circuit_open"}}}, 200, False),
+])
+def test_store_response_cache_skips_unfit_answers(monkeypatch, clock, result_data, status_code, stored):
+    cache = make_cache()
+    monkeypatch.setattr(backend, "response_cache", cache)
+    backend.store_response_cache("llm:java", result_data, status_code, BASE, "llm")
+    assert (cache.get_exact("llm:java") is not None) == stored
+    assert (result_data.get("metadata", {}).get("response_cache") == "miss") == stored
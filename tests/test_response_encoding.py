@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+import gzip
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import backend
+
+LARGE = {"recommended_assessments": [{"product_id": f"p{index}", "description": "x" * 100} for index in range(20)], "status": "success"}
+
+
+@pytest.fixture(autouse=True)
+def encoding_settings(monkeypatch):
+    monkeypatch.setattr(backend, "RESPONSE_COMPRESSION_MIN_BYTES", 1024)
+    monkeypatch.setattr(backend, "RESPONSE_CACHE_CONTROL", "no-cache")
+
+
+@pytest.fixture
+def with_brotli(monkeypatch):
+    monkeypatch.setattr(backend, "brotli", SimpleNamespace(compress=lambda body, quality: b"br:" + body))
+
+
+def test_json_etag():
+    etag = backend.json_etag(b'{"a":1}')
+    assert etag.startswith('W/"') and etag.endswith('"')
+    assert etag == backend.json_etag(b'{"a":1}')
+    assert etag != backend.json_etag(b'{"a":2}')
+
+
+@pytest.mark.parametrize("if_none_match, matches", [
+    (None, False),
+    ("", False),
+    ('W/"abc"', True),
+    ('"abc"', True), # Weak comparison ignores the W/ prefix
+    ('"other", W/"abc"', True),
+    ('"other",W/"abc"', True),
+    ("*", True),
+    ('W/"abcd"', False),
+    ("abc", False), # Unquoted
+])
+def test_etag_matches(if_none_match, matches):
+    assert backend.etag_matches(if_none_match, 'W/"abc"') == matches
+
+
+@pytest.mark.parametrize("accept_encoding, size, expected", [
+    (None, 2000, None),
+    ("", 2000, None),
+    ("gzip", 2000, "gzip"),
+    ("gzip", 1023, None), # Below RESPONSE_COMPRESSION_MIN_BYTES
+    ("GZIP", 2000, "gzip"),
+    ("gzip, deflate, br", 2000, "gzip"), # br is not offered without the brotli package
+    ("gzip;q=0", 2000, None),
+    ("gzip; q=0.5", 2000, "gzip"),
+    ("gzip;q=abc", 2000, None), # A malformed weight refuses the coding
+    ("*", 2000, "gzip"),
+    ("*;q=0", 2000, None),
+    ("*;q=0, gzip", 2000, "gzip"),
+    ("gzip;q=0, *", 2000, None), # An explicit weight beats the wildcard
+    ("identity", 2000, None),
+    ("deflate", 2000, None),
+])
+def test_negotiate_encoding(accept_encoding, size, expected):
+    assert backend.negotiate_encoding(accept_encoding, size) == expected
+
+
+@pytest.mark.parametrize("accept_encoding, expected", [
+    ("gzip, br", "br"), # Equal weights: br is preferred
+    ("br;q=0.5, gzip", "gzip"),
+    ("br, gzip;q=0.9", "br"),
+    ("*", "br"),
+    ("*;q=0.1, br;q=0", "gzip"),
+    ("br;q=0", None),
+    ("br;q=0, gzip;q=0", None),
+])
+def test_negotiate_encoding_with_brotli(with_brotli, accept_encoding, expected):
+    assert backend.negotiate_encoding(accept_encoding, 2000) == expected
+
+
+def test_compress_response_uses_the_memo():
+    body = backend.encode_json(LARGE)
+    memo = {}
+    compressed, encoding = backend.compress_response(body, "gzip", memo)
+    assert encoding == "gzip"
+    assert gzip.decompress(compressed) == body
+    memo["gzip"] = b"memoized"
+    assert backend.compress_response(body, "gzip", memo) == (b"memoized", "gzip")
+    assert backend.compress_response(b"{}", "gzip", memo) == (b"{}", None)
+
+
+def test_serialize_response_memo():
+    cached = backend.CachedResponse({"status": "success"}, "exact", {})
+    body, etag, memo = backend.serialize_response(cached)
+    assert memo is cached.encodings
+    assert (memo["identity"], memo["etag"]) == (body, etag)
+    memo["identity"], memo["etag"] = b"memoized", 'W/"memo"'
+    assert backend.serialize_response(cached)[:2] == (b"memoized", 'W/"memo"')
+    # Pretty output is not memoized, nor is an uncached dict
+    pretty_body, _, pretty_memo = backend.serialize_response(cached, pretty=True)
+    assert pretty_memo is None and b"\n" in pretty_body
+    assert backend.serialize_response(dict(cached))[2] is None
+
+
+@pytest.mark.parametrize("method, status_code, if_none_match, expected_status", [
+    ("GET", 200, "match", 304),
+    ("HEAD", 200, "match", 304),
+    ("GET", 200, "*", 304),
+    ("GET", 200, '"stale"', 200),
+    ("GET", 200, None, 200),
+    ("POST", 200, "match", 200), # Only safe methods revalidate
+    ("GET", 404, "match", 404),
+])
+def test_json_response_conditional_get(method, status_code, if_none_match, expected_status):
+    data = {"status": "success"}
+    etag = backend.json_etag(backend.encode_json(data))
+    headers = {"If-None-Match": etag if if_none_match == "match" else if_none_match} if if_none_match else {}
+    with backend.app.test_request_context("/", method=method, headers=headers):
+        response = backend.json_response(data, status_code)
+    assert response.status_code == expected_status
+    assert response.headers["ETag"] == etag
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert response.headers["Cache-Control"] == ("no-store" if status_code >= 400 else "no-cache")
+    if expected_status == 304:
+        assert response.get_data() == b""
+
+
+def test_json_response_compresses_large_bodies():
+    with backend.app.test_request_context("/", headers={"Accept-Encoding": "gzip"}):
+        response = backend.json_response(LARGE)
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert json.loads(gzip.decompress(response.get_data())) == LARGE
+
+
+@pytest.fixture
+def cached_hit(monkeypatch):
+    """Makes /recommend answer with one response cache hit whose memo the tests can inspect."""
+    hit = backend.CachedResponse({"recommended_assessments": [], "status": "success"}, "exact", {})
+    monkeypatch.setattr(backend, "initialization_pending_response", lambda: None)
+    monkeypatch.setattr(backend, "get_product_recommendation_cached", lambda *args, **kwargs: (hit, 200))
+    return hit
+
+
+def post_recommend(query_string=""):
+    return backend.app.test_client().post(f"/recommend{query_string}", json={"query": "java developer"})
+
+
+def test_cache_hit_is_served_from_the_memo(cached_hit):
+    first = post_recommend()
+    assert first.get_data() == cached_hit.encodings["identity"]
+    cached_hit.encodings["identity"] = b'{"memoized":true}'
+    assert post_recommend().get_json() == {"memoized": True}
+
+
+@pytest.mark.parametrize("query_string, check", [
+    ("?timings=1", lambda body: "timings" in json.loads(body)),
+    ("?pretty=1", lambda body: body.startswith(b"{\n")),
+])
+def test_cache_hit_with_options_bypasses_the_memo(cached_hit, query_string, check):
+    compact = post_recommend().get_data()
+    response = post_recommend(query_string)
+    assert response.status_code == 200
+    assert check(response.get_data())
+    assert cached_hit.encodings["identity"] == compact # The memo still holds the plain compact body
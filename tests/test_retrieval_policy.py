@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import backend
+
+
+@pytest.fixture(autouse=True)
+def policy_settings(monkeypatch):
+    for name, value in {"ADAPTIVE_RETRIEVAL": True, "ADAPTIVE_MAX_RETRIEVAL_COUNT": 12, "DB_RETRIEVAL_COUNT": 6,
+                        "MAX_FINAL_RECOMMENDATIONS": 3, "DB_MATCH_THRESHOLD": 0.4, "CONFIDENT_MIN_SIMILARITY": 0.75,
+                        "CONFIDENT_MIN_MARGIN": 0.1, "FLAT_MAX_SPREAD": 0.05}.items():
+        monkeypatch.setattr(backend, name, value)
+
+
+def matches(*scores):
+    return [{"product_id": f"p{position}", "similarity": score} for position, score in enumerate(scores)]
+
+
+FULL_TAIL = [0.5] * 9 # Pads a list to the full fetch depth of 12
+
+
+@pytest.mark.parametrize("scores, decision, k", [
+    ([], "default", 6),
+    # One clear leader
+    ([0.9, 0.7] + [0.6] * 10, "confident", 1),
+    # The widest gap decides how many picks are returned
+    ([0.9, 0.88, 0.86, 0.6] + [0.55] * 8, "confident", 3),
+    ([0.92, 0.8, 0.79, 0.78] + [0.7] * 8, "confident", 1),
+    # Margin exactly at CONFIDENT_MIN_MARGIN
+    ([0.85, 0.75] + [0.7] * 10, "confident", 1),
+    ([0.85, 0.76] + [0.7] * 10, "default", 6),
+    # Picks must all score CONFIDENT_MIN_SIMILARITY: a big gap after a weak third pick does not count
+    ([0.8, 0.78, 0.74, 0.3], "default", 6),
+    ([0.74, 0.3], "default", 6),
+    # A short list means nothing else cleared DB_MATCH_THRESHOLD, so the next score is the threshold
+    ([0.8], "confident", 1),
+    ([0.9, 0.9, 0.9], "confident", 3),
+    # A full list says nothing about what follows its last score
+    ([0.9] * 12, "flat", 12),
+    # Flat: the top 6 within FLAT_MAX_SPREAD, and more than 6 fetched
+    ([0.6, 0.59, 0.58, 0.57, 0.56, 0.55] + [0.4] * 6, "flat", 12),
+    ([0.6, 0.59, 0.58, 0.57, 0.56, 0.54] + [0.4] * 6, "default", 6),
+    ([0.5] * 6, "default", 6),
+])
+def test_retrieval_policy(scores, decision, k):
+    assert backend.retrieval_policy(matches(*scores))[:2] == (decision, k)
+
+
+def test_retrieval_policy_stats():
+    decision, k, stats = backend.retrieval_policy(matches(0.9, 0.7, *FULL_TAIL, 0.5))
+    assert stats == {"top_similarity": 0.9, "margin": 0.2, "spread": 0.4}
+
+
+def test_retrieval_depth(monkeypatch):
+    assert backend.retrieval_depth() == 12
+    monkeypatch.setattr(backend, "ADAPTIVE_RETRIEVAL", False)
+    assert backend.retrieval_depth() == 6
+
+
+@pytest.mark.parametrize("scores, kept, limit, confident", [
+    ([0.9, 0.7] + [0.6] * 10, 1, 6, True),
+    ([0.6] * 12, 12, 12, False),
+    ([0.7, 0.6, 0.5, 0.45, 0.44, 0.43, 0.42, 0.41], 6, 6, False),
+])
+def test_apply_retrieval_policy(scores, kept, limit, confident):
+    metadata = {}
+    raw = matches(*scores)
+    kept_matches, candidate_limit, is_confident = backend.apply_retrieval_policy("query", raw, metadata)
+    assert (kept_matches, candidate_limit, is_confident) == (raw[:kept], limit, confident)
+    assert metadata["retrieval"]["k"] == kept
+    assert metadata["retrieval"]["fetched"] == len(scores)
+    assert backend.is_confident_retrieval(metadata) == confident
+
+
+def test_lexical_match_outside_the_picks_overrides_confidence():
+    metadata = {}
+    raw = matches(0.9, 0.7, *FULL_TAIL, 0.5)
+    kept, limit, confident = backend.apply_retrieval_policy("query", raw, metadata, lexical_matches=[{"product_id": "named"}], lexical_match=True)
+    assert (kept, limit, confident) == (raw[:6], 6, False)
+    assert metadata["retrieval"]["policy"] == "default"
+    assert metadata["retrieval"]["overridden_by"] == "lexical_match"
+
+
+def test_lexical_match_among_the_picks_keeps_confidence():
+    metadata = {}
+    raw = matches(0.9, 0.7, *FULL_TAIL, 0.5)
+    assert backend.apply_retrieval_policy("query", raw, metadata, lexical_matches=[{"product_id": "p0"}], lexical_match=True)[2]
+
+
+def test_policy_disabled_or_without_matches(monkeypatch):
+    metadata = {}
+    assert backend.apply_retrieval_policy("query", [], metadata) == ([], 6, False)
+    monkeypatch.setattr(backend, "ADAPTIVE_RETRIEVAL", False)
+    raw = matches(0.9, 0.7)
+    assert backend.apply_retrieval_policy("query", raw, metadata) == (raw, 6, False)
+    assert metadata == {}
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+import pytest
+
+import backend
+
+FOLLOWERS = 4
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+def run_concurrently(flight, key, fn, followers=FOLLOWERS):
+    """Calls flight.do(key, fn) from a leader thread and `followers` more threads that join it while fn runs.
+
+    fn receives nothing and is released only once every follower is waiting. Returns the outcome of each
+    call, leader first: ("ok", result, shared) or ("error", exception).
+    """
+    release = threading.Event()
+    outcomes = [None] * (followers + 1)
+
+    def blocked():
+        release.wait(5)
+        return fn()
+
+    def call(slot):
+        try:
+            result, shared = flight.do(key, blocked)
+            outcomes[slot] = ("ok", result, shared)
+        except Exception as e:
+            outcomes[slot] = ("error", e)
+
+    threads = [threading.Thread(target=call, args=(0,))]
+    threads[0].start()
+    wait_for(lambda: flight.stats()["in_flight"] == 1)
+    for slot in range(1, followers + 1):
+        threads.append(threading.Thread(target=call, args=(slot,)))
+        threads[-1].start()
+    wait_for(lambda: flight.coalesced == followers)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    return outcomes
+
+
+def test_identical_keys_compute_once():
+    flight = backend.SingleFlight()
+    computations = []
+
+    def compute():
+        computations.append(None)
+        return {"recommended_assessments": [{"product_id": "p1"}]}, 200
+
+    outcomes = run_concurrently(flight, "java", compute)
+    assert len(computations) == 1
+    assert [outcome[2] for outcome in outcomes] == [False] + [True] * FOLLOWERS
+    assert all(outcome[1] == outcomes[0][1] for outcome in outcomes)
+    assert flight.stats() == {"enabled": True, "in_flight": 0, "executions": 1, "coalesced": FOLLOWERS}
+
+
+def test_followers_get_independent_copies():
+    flight = backend.SingleFlight()
+    outcomes = run_concurrently(flight, "java", lambda: {"metadata": {}, "items": [1]})
+    results = [outcome[1] for outcome in outcomes]
+    for index, result in enumerate(results):
+        result["metadata"]["caller"] = index
+        result["items"].append(index)
+    assert [result["metadata"]["caller"] for result in results] == list(range(FOLLOWERS + 1))
+    assert [result["items"] for result in results] == [[1, index] for index in range(FOLLOWERS + 1)]
+
+
+def test_leader_exception_reaches_every_caller():
+    flight = backend.SingleFlight()
+    error = RuntimeError("pipeline failed")
+
+    def fail():
+        raise error
+
+    outcomes = run_concurrently(flight, "java", fail)
+    assert outcomes == [("error", error)] * (FOLLOWERS + 1)
+    assert flight.stats()["in_flight"] == 0
+    # The failed call is not remembered: the next one runs again
+    assert flight.do("java", lambda: "retried") == ("retried", False)
+
+
+def test_different_keys_do_not_coalesce():
+    flight = backend.SingleFlight()
+    release = threading.Event()
+    results = {}
+
+    def call(key):
+        results[key] = flight.do(key, lambda: release.wait(5) and key)
+
+    threads = [threading.Thread(target=call, args=(key,)) for key in ("java", "python")]
+    for thread in threads:
+        thread.start()
+    wait_for(lambda: flight.stats()["in_flight"] == 2)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == {"java": ("java", False), "python": ("python", False)}
+    assert (flight.executions, flight.coalesced) == (2, 0)
+
+
+def test_sequential_calls_are_not_coalesced():
+    flight = backend.SingleFlight()
+    assert flight.do("java", lambda: 1) == (1, False)
+    assert flight.do("java", lambda: 2) == (2, False)
+    assert (flight.executions, flight.coalesced) == (2, 0)
+
+
+def test_coalesced_counter_is_exported(monkeypatch):
+    counts = []
+    monkeypatch.setattr(backend.metrics, "inc", lambda name, *args, **labels: counts.append(name))
+    run_concurrently(backend.SingleFlight(), "java", lambda: "result", followers=2)
+    assert counts.count("shl_coalesced_requests_total") == 2
+
+
+@pytest.mark.parametrize("followers", [1, 8])
+def test_follower_count(followers):
+    flight = backend.SingleFlight()
+    outcomes = run_concurrently(flight, "java", lambda: "result", followers)
+    assert [outcome[:2] for outcome in outcomes] == [("ok", "result")] * (followers + 1)
+    assert flight.coalesced == followers